@@ -0,0 +1,41 @@
+import base64
+import binascii
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError
+
+
+class TransactionsCursor(BaseModel):
+    """
+    The position of a client in the paginated transactions report. Sent to clients as an opaque string.
+    """
+    # The time range of the report the cursor belongs to, so a cursor can not be used to paginate a different report
+    start_timestamp: datetime
+    end_timestamp: datetime
+    # Transactions from this timestamp on are not included in the report. A bit before the first page was requested,
+    # so every transaction of the report was committed (transactions are committed shortly after their timestamp)
+    snapshot_timestamp: datetime
+    # The (timestamp, id) of the last transaction of the previous page, None for the first page
+    after_timestamp: Optional[datetime]
+    after_transaction_id: Optional[int]
+    # The total number of transactions in the report, counted once on the first page
+    total_items: Optional[int]
+
+    def get_report_end_timestamp(self) -> datetime:
+        """The end of the report (not included): the end of its time range, or its snapshot if it is earlier"""
+        return min(self.end_timestamp, self.snapshot_timestamp)
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(self.json().encode()).decode()
+
+    @classmethod
+    def decode(cls, cursor: str) -> 'TransactionsCursor':
+        """
+        Parses a cursor created by TransactionsCursor.encode
+        :raises ValueError: If the cursor is invalid
+        """
+        try:
+            return cls.parse_raw(base64.urlsafe_b64decode(cursor.encode()))
+        except (binascii.Error, ValidationError) as e:
+            raise ValueError(f'Invalid cursor: {cursor}') from e
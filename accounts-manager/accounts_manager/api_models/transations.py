@@ -2,7 +2,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Optional, List
 
-from pydantic import BaseModel, PositiveFloat, Field
+from pydantic import BaseModel, PositiveFloat, Field, conlist
 
 
 class TransactionDirection(str, Enum):
@@ -30,6 +30,13 @@ class TransactionRequest(BaseModel):
     direction: TransactionDirection
 
 
+# The maximum number of transfers that can be requested in a single batch request
+MAX_TRANSACTIONS_BATCH_SIZE = 10000
+
+# A request to create a batch of new transactions, which are performed in the given order
+TransactionsBatchRequest = conlist(TransactionRequest, min_items=1, max_items=MAX_TRANSACTIONS_BATCH_SIZE)
+
+
 class Transaction(BaseModel):
     """Money transaction"""
     transaction_id: str = Field(alias="id")
@@ -40,14 +47,121 @@ class Transaction(BaseModel):
     direction: TransactionDirection
     status: TransactionStatus
     reason: Optional[str]
+    # Why the transaction happened, only present for bank transactions
+    description: Optional[str]
 
     class Config:
         orm_mode = True
 
 
+class PaginationMode(str, Enum):
+    """
+    How the transactions report is paginated.
+    page - pages are selected by their number (page & limit). Simple, but deep pages are slow & the results can change
+           while paginating
+    cursor - every page returns a cursor to the next page. Every page costs the same, & the report is a snapshot of the
+             transactions that existed when the first page was requested (excluding the last report_snapshot_lag
+             seconds, which may not be committed yet)
+    """
+    page = 'page'
+    cursor = 'cursor'
+
+
+class ReportCountStrategy(str, Enum):
+    """
+    How the total number of transactions in the report is counted.
+    exact - counted exactly, once per report (when paginating with cursors) or cached for a short while
+    estimate - estimated by the database statistics, which is fast no matter how big the report is
+    none - not counted at all
+    """
+    exact = 'exact'
+    estimate = 'estimate'
+    none = 'none'
+
+
 class TransactionsPage(BaseModel):
     items: List[Transaction]
-    page: int
     limit: int
-    total_items: int
-    number_of_pages: int
+    # Only present when paginating by page numbers
+    page: Optional[int]
+    # Not present when the report is not counted
+    total_items: Optional[int]
+    number_of_pages: Optional[int]
+    # Only present when paginating with cursors. The cursor of the next page, or null if this is the last page
+    next_cursor: Optional[str]
+
+
+class AccountTransactions(BaseModel):
+    """The latest transactions of a single account, newest first"""
+    account_id: str
+    items: List[Transaction]
+    limit: int
+
+
+class TransactionsSummaryGroup(BaseModel):
+    """The totals of the transactions with the same status & direction"""
+    status: TransactionStatus
+    direction: TransactionDirection
+    transactions_count: int
+    amount_sum: float
+
+
+class FailureReasonSummary(BaseModel):
+    """The number of transactions that failed for the same reason"""
+    # The failure category: insufficient_funds, account_not_found, same_account, unexpected_error or other
+    reason: str
+    transactions_count: int
+
+
+class TransactionsSummary(BaseModel):
+    """The totals of the transactions in a time range"""
+    start_timestamp: datetime
+    end_timestamp: datetime
+    transactions_count: int
+    amount_sum: float
+    groups: List[TransactionsSummaryGroup]
+    # The failure reasons of the failed transactions, most common first
+    failure_reasons: List[FailureReasonSummary]
+
+
+class AccountBalance(BaseModel):
+    """The current balance of a bank account"""
+    account_id: str
+    balance: float
+
+
+class BankTransactionRequest(BaseModel):
+    """A request to give money to an account from the bank, or take money from an account to the bank"""
+
+    dst_account_id: str
+    amount: PositiveFloat
+    # debit - take the money from the account, credit - give the money to the account
+    direction: TransactionDirection
+    # Why the transaction happened, can be used for tracking (for example: "Advance payment week 3")
+    reason: Optional[str]
+
+
+class BankTransactionsBatchItem(BankTransactionRequest):
+    """A single bank transaction in a batch of bank transactions"""
+
+    # A unique key of the bank transaction, just like the Idempotency-Key header of a single bank transaction.
+    # Retrying a batch with the same keys returns the original transactions instead of transferring the funds again
+    idempotency_key: Optional[str]
+
+
+# A request to perform a batch of bank transactions
+BankTransactionsBatchRequest = conlist(BankTransactionsBatchItem, min_items=1, max_items=MAX_TRANSACTIONS_BATCH_SIZE)
+
+
+class BankTransaction(BaseModel):
+    """Money transaction between the bank & an account"""
+    transaction_id: str
+    timestamp: datetime
+    dst_account_id: str
+    amount: PositiveFloat
+    direction: TransactionDirection
+    status: TransactionStatus
+    # The reason the transaction failed. only present when the transaction failed
+    reason: Optional[str]
+    # Why the transaction happened
+    description: Optional[str]
@@ -5,9 +5,16 @@ from structlog import get_logger
 
 from settings import Settings
 from configure_logging import configure_logging
-from middlewares.request_logging.middleware import add_log_context
+from middlewares.request_logging.middleware import RequestLoggingMiddleware
 from routes.transactions import get_router as get_transactions_router
+from routes.transactions_async import get_router as get_async_transactions_router
+from routes.accounts import get_router as get_accounts_router
+from routes.bank_transactions import get_router as get_bank_transactions_router
+from routes.metrics import get_router as get_metrics_router
 from dal.dal import Dal
+from dal.async_dal import AsyncDal
+from partition_maintenance import PartitionMaintenanceThread
+from transaction_rollups import TransactionRollupsThread
 
 logger = get_logger()
 
@@ -24,18 +31,80 @@ def get_app() -> FastAPI:
     configure_logging(settings)
 
     logger.info('Connecting to database')
-    dal = Dal()
+    dal = Dal(max_transfer_attempts=settings.transfer_max_attempts,
+              transfer_retry_base_delay=settings.transfer_retry_base_delay,
+              transfers_batch_chunk_size=settings.transfers_batch_chunk_size,
+              report_count_cache_ttl=settings.report_count_cache_ttl,
+              bank_account_id=settings.bank_account_id,
+              idempotency_cache_size=settings.idempotency_cache_size,
+              account_balance_cache_ttl=settings.account_balance_cache_ttl)
 
     # Required for paths that return a paginated list of results
     add_pagination(app)
 
-    app.middleware("http")(add_log_context)
-
-    app.include_router(get_transactions_router(dal=dal))
+    app.add_middleware(RequestLoggingMiddleware,
+                       sample_rate=settings.request_log_sample_rate,
+                       slow_request_threshold=settings.slow_request_threshold)
+
+    async_dal = None
+    if settings.async_request_path:
+        logger.info('Serving the transactions routes with the async request path')
+        async_dal = AsyncDal(max_transfer_attempts=settings.transfer_max_attempts,
+                             transfer_retry_base_delay=settings.transfer_retry_base_delay,
+                             report_count_cache_ttl=settings.report_count_cache_ttl,
+                             idempotency_cache_size=settings.idempotency_cache_size,
+                             on_account_balances_changed=dal.invalidate_account_balances)
+        # Included first, so the async routes take precedence over the matching sync routes
+        app.include_router(get_async_transactions_router(dal=async_dal,
+                                                         report_snapshot_lag=settings.report_snapshot_lag))
+
+    app.include_router(get_transactions_router(dal=dal,
+                                               export_chunk_size=settings.export_chunk_size,
+                                               report_snapshot_lag=settings.report_snapshot_lag))
+    app.include_router(get_accounts_router(dal=dal, balance_max_age=settings.account_balance_cache_ttl))
+    app.include_router(get_bank_transactions_router(dal=dal))
+    app.include_router(get_metrics_router())
+
+    partition_maintenance_thread = None
+    if settings.partition_maintenance_interval:
+        partition_maintenance_thread = PartitionMaintenanceThread(dal=dal, settings=settings)
+    transaction_rollups_thread = None
+    if settings.transaction_rollups_interval:
+        transaction_rollups_thread = TransactionRollupsThread(dal=dal, settings=settings)
 
     @app.on_event("startup")
     def on_startup():
-        dal.initiate_connection(settings.db_connection_string.get_secret_value())
+        dal.initiate_connection(settings.db_connection_string.get_secret_value(),
+                                engine_profile=settings.get_db_engine_profile())
+
+        # Partitions for the incoming transactions must exist before serving requests, archiving is left to the
+        # background maintenance
+        dal.maintain_transaction_partitions(interval=settings.transactions_partition_interval,
+                                            premake=settings.transactions_partitions_premake)
+        if partition_maintenance_thread:
+            partition_maintenance_thread.start()
+        if transaction_rollups_thread:
+            transaction_rollups_thread.start()
+
+        if settings.bank_account_id:
+            try:
+                dal.stripe_account(account_id=settings.bank_account_id, stripes=settings.bank_account_stripes)
+            except ValueError as e:
+                logger.warning('Could not set the stripes of the bank account', reason=str(e))
+
+        if async_dal:
+            async_dal.initiate_connection(settings.db_connection_string.get_secret_value(),
+                                          async_driver=settings.async_db_driver,
+                                          engine_profile=settings.get_db_engine_profile())
+
+    @app.on_event("shutdown")
+    async def on_shutdown():
+        if partition_maintenance_thread:
+            partition_maintenance_thread.stop()
+        if transaction_rollups_thread:
+            transaction_rollups_thread.stop()
+        if async_dal:
+            await async_dal.close_connection()
 
     @app.get('/')
     def root() -> str:
@@ -1,16 +1,52 @@
 """Configures the logging of the application"""
 
+import atexit
 import os.path
 import logging
 import logging.config
+import logging.handlers
+import queue
+from typing import Optional
 
 import structlog
 
 
 from settings import Settings
 
+# The logger holding the handlers that write the logs, when logging is non-blocking
+WRITER_LOGGER_NAME = 'log_writer'
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the log records to a background writer thread (see logging.handlers.QueueListener) without waiting for it.
+    Records are queued as they are, so formatting & rendering them is done by the writer thread as well.
+    If the queue is full the record is dropped, so a slow disk never slows down the requests.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped_records = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The default implementation formats the record in the calling thread, & the structlog formatters need the
+        # event dict (the msg of the record) as is
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+
+def configure_logging(settings: Settings) -> Optional[logging.handlers.QueueListener]:
+    """
+    Configures structlog & the standard logging module.
+    :return: The listener writing the logs in the background when non-blocking logging is enabled, otherwise None.
+        The listener is stopped (& the remaining records are written) when the process exits
+    """
 
-def configure_logging(settings: Settings):
     # Processors that will apply to all log records, no matter if they were created by stdlib logging or structlog
     shared_processors = [
         # Add structlog context variables to log lines
@@ -25,23 +61,29 @@ def configure_logging(settings: Settings):
         structlog.stdlib.add_log_level,
         # Perform old school %-style formatting. on the log msg/event
         structlog.stdlib.PositionalArgumentsFormatter(),
-        # Adds parameters about where in the source code the log function called from (file, line...)
-        structlog.processors.CallsiteParameterAdder(
+    ]
+    if settings.log_callsite:
+        # Adds parameters about where in the source code the log function called from (file, line...).
+        # Walks the stack on every log call, so it can be turned off where logging is hot
+        shared_processors.append(structlog.processors.CallsiteParameterAdder(
             [
                 # The name of the function that the log is in
                 structlog.processors.CallsiteParameter.FUNC_NAME,
                 # The line number of the log
                 structlog.processors.CallsiteParameter.LINENO,
             ],
-        ),
-        # If the log record contains a string in byte format, this will automatically convert it into a utf-8 string
-        structlog.processors.UnicodeDecoder(),
-    ]
+        ))
+    # If the log record contains a string in byte format, this will automatically convert it into a utf-8 string
+    shared_processors.append(structlog.processors.UnicodeDecoder())
 
     # Processors that will only apply to records generated by structlog
     structlog_only_processors = [
         structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
     ]
+    if settings.log_non_blocking:
+        # The records are rendered by the writer thread, where the exception being handled is not available anymore,
+        # so the traceback is formatted by the logging thread
+        structlog_only_processors.insert(0, structlog.processors.format_exc_info)
 
     processors = shared_processors + structlog_only_processors
 
@@ -57,6 +99,59 @@ def configure_logging(settings: Settings):
         wrapper_class=structlog.stdlib.BoundLogger,
     )
 
+    writer_handlers = ["flat_line_file", "json_file"]
+    if settings.log_to_console:
+        writer_handlers.insert(0, "console")
+
+    handlers = {
+        # Output logs to console
+        "console": {
+            "class": "logging.StreamHandler",
+            "formatter": "plain_console",
+        },
+        # Output logs to file in json format
+        "json_file": {
+            "class": "logging.handlers.WatchedFileHandler",
+            "filename": os.path.join(settings.logs_dir, 'json.log'),
+            "formatter": "json_formatter",
+        },
+        # Output logs to file in a simple "key1=value1 key2=value2" format
+        "flat_line_file": {
+            "class": "logging.handlers.WatchedFileHandler",
+            "filename": os.path.join(settings.logs_dir, "flat_line.log"),
+            "formatter": "key_value",
+        },
+    }
+    loggers = {
+        # Output all log of level debug or above to the console and to the two formats of log files
+        "": {
+            "handlers": writer_handlers,
+            "level": "DEBUG",
+        },
+    }
+
+    log_queue = None
+    if settings.log_non_blocking:
+        # The logs are only queued by the logging threads, & the handlers writing them are attached to a logger that is
+        # not used by the application, only by the background listener.
+        # Note: the shared processors of records created by stdlib logging (not structlog) run in the listener thread
+        log_queue = queue.Queue(maxsize=settings.log_queue_size)
+        handlers["queue"] = {
+            "()": NonBlockingQueueHandler,
+            "log_queue": log_queue,
+        }
+        loggers = {
+            "": {
+                "handlers": ["queue"],
+                "level": "DEBUG",
+            },
+            WRITER_LOGGER_NAME: {
+                "handlers": writer_handlers,
+                "level": "DEBUG",
+                "propagate": False,
+            },
+        }
+
     # Configure standard logging module
     logging.config.dictConfig({
         "version": 1,
@@ -81,30 +176,15 @@ def configure_logging(settings: Settings):
                 "foreign_pre_chain": shared_processors
             },
         },
-        "handlers": {
-            # Output logs to console
-            "console": {
-                "class": "logging.StreamHandler",
-                "formatter": "plain_console",
-            },
-            # Output logs to file in json format
-            "json_file": {
-                "class": "logging.handlers.WatchedFileHandler",
-                "filename": os.path.join(settings.logs_dir, 'json.log'),
-                "formatter": "json_formatter",
-            },
-            # Output logs to file in a simple "key1=value1 key2=value2" format
-            "flat_line_file": {
-                "class": "logging.handlers.WatchedFileHandler",
-                "filename": os.path.join(settings.logs_dir, "flat_line.log"),
-                "formatter": "key_value",
-            },
-        },
-        "loggers": {
-            # Output all log of level debug or above to the console and to the two formats of log files
-            "": {
-                "handlers": ["console", "flat_line_file", "json_file"],
-                "level": "DEBUG",
-            },
-        }
+        "handlers": handlers,
+        "loggers": loggers,
     })
+
+    if log_queue is None:
+        return None
+
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger(WRITER_LOGGER_NAME).handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
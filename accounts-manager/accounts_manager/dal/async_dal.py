@@ -0,0 +1,428 @@
+import asyncio
+from datetime import datetime
+import random
+import time
+from typing import Optional, Tuple, Callable, TypeVar, Awaitable, Any, List, Iterable
+
+from pydantic import PositiveFloat
+import structlog
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from dal import dal_models
+from dal.cache import TTLCache
+from dal.idempotency import StoredResponse, get_request_fingerprint, build_idempotency_key, to_stored_response, \
+    check_stored_response, is_duplicate_key_error
+from dal.transfers import get_paying_and_receiving_account_ids, get_denial_reason
+from dal.sqlalchemy.configuration import get_async_sqlalchemy_engine, get_pool_stats, EngineProfile
+from dal.sqlalchemy.errors import get_sqlstate, is_retryable_db_error
+from dal.sqlalchemy.statements import move_funds_statement, lock_accounts_statement, account_stripes_statement, \
+    transactions_in_range_statement, transactions_keyset_page_statement, \
+    count_transactions_statement, explain_transactions_in_range_statement, get_estimated_rows
+from dal.sqlalchemy import models as sqlalchemy_models
+
+
+logger = structlog.get_logger()
+
+T = TypeVar('T')
+
+
+def _to_account_id(account_id: str) -> Any:
+    """
+    Async drivers do not let the database cast query parameters, so account IDs are converted to the type of the
+    column. IDs that are not numbers are kept as is, & fail as invalid parameters.
+    """
+    try:
+        return int(account_id)
+    except ValueError:
+        return account_id
+
+
+class AsyncDal:
+    """
+    An asyncio implementation of the hot paths of the Dal (performing transactions & the transactions report).
+    The database schema is created by the sync Dal, which must be connected as well.
+    """
+
+    __engine = None
+    __session_maker = None
+
+    def __init__(self,
+                 max_transfer_attempts: int = 5,
+                 transfer_retry_base_delay: float = 0.05,
+                 report_count_cache_ttl: float = 30,
+                 idempotency_cache_size: int = 10000,
+                 on_account_balances_changed: Optional[Callable[[Iterable[str]], None]] = None):
+        """
+        :param max_transfer_attempts: The maximum number of times a money transfer is attempted when it conflicts with
+            concurrent transfers (deadlocks / serialization failures), before giving up
+        :param transfer_retry_base_delay: The base delay (seconds) of the exponential backoff between transfer attempts
+        :param report_count_cache_ttl: How long (seconds) the total count of a transactions report is cached for
+        :param idempotency_cache_size: The number of recently used idempotency keys kept in memory
+        :param on_account_balances_changed: Called with the IDs of the accounts whose balance changed, after the change
+            commits (used to evict the balances cached by the sync Dal)
+        """
+        self.__max_transfer_attempts = max_transfer_attempts
+        self.__transfer_retry_base_delay = transfer_retry_base_delay
+        self.__transactions_count_cache: TTLCache[int] = TTLCache(max_size=1024, ttl=report_count_cache_ttl)
+        self.__idempotency_cache: TTLCache[StoredResponse] = TTLCache(max_size=idempotency_cache_size)
+        self.__on_account_balances_changed = on_account_balances_changed
+
+    async def _get_session(self) -> AsyncSession:
+        """
+        Generates a new session object for a single unit of work, & checks out its connection from the pool straight
+        away so the time spent waiting for a free connection is logged along with the pool usage.
+        :return: AsyncSession instance
+        """
+        if not self.__session_maker:
+            raise ValueError('The session maker is missing. are you sure you initiated the database connection?')
+
+        session = self.__session_maker()
+
+        checkout_start_time = time.perf_counter()
+        await session.connection()
+        logger.debug('Database connection checked out',
+                     pool_wait=time.perf_counter() - checkout_start_time,
+                     **get_pool_stats(self.__engine.sync_engine))
+
+        return session
+
+    def initiate_connection(self,
+                            connection_string: str,
+                            async_driver: str = 'asyncpg',
+                            engine_profile: Optional[EngineProfile] = None) -> None:
+        """
+        Setup the async connection pool to the database. This function must be called before using the db
+        :param connection_string: The connection string to the database we are connecting to, in SQLAlchemy format.
+            The driver in the connection string is replaced by the async driver
+        :param async_driver: The asyncio database driver to use
+        :param engine_profile: The options of the database engine (connection pool...).
+            Defaults to the production profile
+        :return: None
+        """
+
+        logger.debug('Creating async sql alchemy engine')
+        self.__engine = get_async_sqlalchemy_engine(connection_string,
+                                                    async_driver=async_driver,
+                                                    profile=engine_profile)
+
+        self.__session_maker = async_sessionmaker(bind=self.__engine)
+
+    async def close_connection(self) -> None:
+        """Closes all the pooled connections to the database"""
+        if self.__engine:
+            await self.__engine.dispose()
+
+    async def _retry_on_contention(self, operation: Callable[[], Awaitable[T]]) -> Tuple[T, int]:
+        """
+        Async version of Dal._retry_on_contention. The backoff between attempts does not block the event loop.
+        :param operation: A function performing (& committing) a single database transaction
+        :return: (result, attempts) A tuple containing the result of the operation & the number of attempts it took
+        """
+
+        for attempt in range(1, self.__max_transfer_attempts + 1):
+            try:
+                result = await operation()
+            except DBAPIError as e:
+                if not is_retryable_db_error(e) or attempt >= self.__max_transfer_attempts:
+                    raise
+
+                # Full jitter exponential backoff, so that conflicting transfers do not retry in lock step
+                retry_delay = random.uniform(0, self.__transfer_retry_base_delay * 2 ** (attempt - 1))
+                logger.warning('Money transfer conflicted with a concurrent transfer, retrying',
+                               attempt=attempt,
+                               max_attempts=self.__max_transfer_attempts,
+                               retry_delay=retry_delay,
+                               sqlstate=get_sqlstate(e))
+                await asyncio.sleep(retry_delay)
+            else:
+                logger.debug('Money transfer committed', attempts=attempt)
+                return result, attempt
+
+    async def perform_transaction(
+            self,
+            src_account_id: str,
+            dst_account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            idempotency_key: Optional[str] = None) -> dal_models.DalTransaction:
+        """
+        Async version of Dal.perform_transaction. Transfers the funds between the given bank accounts & creates the
+        matching Transaction record in a single database transaction, or creates a failed Transaction record if the
+        transfer was denied. If a transaction was already created with the idempotency key, it is returned instead.
+        :return: The created Transaction record, with a status specifying if the transfer was successful or not
+        :raises IdempotencyKeyReusedError: If the idempotency key was already used for a different transfer
+        """
+
+        request_fingerprint = get_request_fingerprint('transaction', src_account_id, dst_account_id, amount,
+                                                      direction.value)
+        return await self._perform_idempotently(
+            idempotency_key=idempotency_key,
+            request_fingerprint=request_fingerprint,
+            operation=lambda: self._perform_transaction(src_account_id=src_account_id,
+                                                        dst_account_id=dst_account_id,
+                                                        timestamp=timestamp,
+                                                        amount=amount,
+                                                        direction=direction,
+                                                        idempotency_key=idempotency_key,
+                                                        request_fingerprint=request_fingerprint))
+
+    async def _perform_idempotently(
+            self,
+            idempotency_key: Optional[str],
+            request_fingerprint: str,
+            operation: Callable[[], Awaitable[dal_models.DalTransaction]]) -> dal_models.DalTransaction:
+        """Async version of Dal._perform_idempotently"""
+
+        if idempotency_key is None:
+            return await operation()
+
+        stored_response = (self.__idempotency_cache.get(idempotency_key)
+                           or await self._get_stored_response(idempotency_key))
+        if stored_response is not None:
+            logger.info('Replaying the transaction of an idempotency key', idempotency_key=idempotency_key)
+            return check_stored_response(idempotency_key=idempotency_key,
+                                         request_fingerprint=request_fingerprint,
+                                         stored_response=stored_response,
+                                         cache=self.__idempotency_cache)
+
+        try:
+            dal_transaction = await operation()
+        except IntegrityError as e:
+            stored_response = await self._get_stored_response(idempotency_key) if is_duplicate_key_error(e) else None
+            if stored_response is None:
+                raise
+
+            logger.info('A concurrent request with the same idempotency key completed first',
+                        idempotency_key=idempotency_key)
+            return check_stored_response(idempotency_key=idempotency_key,
+                                         request_fingerprint=request_fingerprint,
+                                         stored_response=stored_response,
+                                         cache=self.__idempotency_cache)
+
+        self.__idempotency_cache.set(idempotency_key, (request_fingerprint, dal_transaction))
+        return dal_transaction
+
+    async def _get_stored_response(self, idempotency_key: str) -> Optional[StoredResponse]:
+        """Reads the stored response of the idempotency key from the database (None if the key was not used)"""
+        async with await self._get_session() as session:
+            return to_stored_response(await session.get(sqlalchemy_models.IdempotencyKey, idempotency_key))
+
+    @staticmethod
+    def _add_idempotency_key(session: AsyncSession,
+                             idempotency_key: Optional[str],
+                             request_fingerprint: Optional[str],
+                             dal_transaction: dal_models.DalTransaction) -> None:
+        """Adds the idempotency key (if given) to the session, so it is committed along with its Transaction"""
+        if idempotency_key is not None:
+            session.add(build_idempotency_key(idempotency_key=idempotency_key,
+                                              request_fingerprint=request_fingerprint,
+                                              dal_transaction=dal_transaction,
+                                              created_at=dal_transaction.timestamp))
+
+    async def _perform_transaction(
+            self,
+            src_account_id: str,
+            dst_account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            idempotency_key: Optional[str],
+            request_fingerprint: str) -> dal_models.DalTransaction:
+        """Performs the transfer (see perform_transaction), storing the idempotency key with the created Transaction"""
+
+        (dal_transaction, denial_reason), attempts = await self._retry_on_contention(
+            lambda: self._perform_transaction_once(src_account_id=src_account_id,
+                                                   dst_account_id=dst_account_id,
+                                                   timestamp=timestamp,
+                                                   amount=amount,
+                                                   direction=direction,
+                                                   idempotency_key=idempotency_key,
+                                                   request_fingerprint=request_fingerprint))
+
+        if denial_reason is None:
+            logger.debug('Money transfer was successful', attempts=attempts)
+            dal_transaction.transfer_attempts = attempts
+            return dal_transaction
+
+        failure_reason = f'Transfer of funds denied. reason: {denial_reason}'
+        logger.warning(failure_reason)
+        dal_transaction = await self.create_transaction(
+            src_account_id=src_account_id,
+            dst_account_id=dst_account_id,
+            timestamp=timestamp,
+            amount=amount,
+            direction=direction,
+            status=dal_models.DalTransactionStatus.fail,
+            reason=failure_reason,
+            idempotency_key=idempotency_key,
+            request_fingerprint=request_fingerprint)
+        dal_transaction.transfer_attempts = attempts
+        return dal_transaction
+
+    async def _perform_transaction_once(
+            self,
+            src_account_id: str,
+            dst_account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            idempotency_key: Optional[str] = None,
+            request_fingerprint: Optional[str] = None
+    ) -> Tuple[Optional[dal_models.DalTransaction], Optional[str]]:
+        """
+        A single attempt of moving the funds & writing the successful Transaction record. The accounts are locked in
+        ascending ID order first, & then the funds are moved with a guarded UPDATE.
+        :return: (transaction, denial_reason) A tuple containing either the created Transaction record,
+            or the reason why the transfer was denied
+        """
+
+        if src_account_id == dst_account_id:
+            return None, "Source and destination accounts must be different accounts"
+
+        paying_account_id, receiving_account_id = get_paying_and_receiving_account_ids(
+            src_account_id=src_account_id, dst_account_id=dst_account_id, direction=direction)
+
+        async with await self._get_session() as session:
+            (await session.scalars(lock_accounts_statement([_to_account_id(paying_account_id),
+                                                            _to_account_id(receiving_account_id)]))).all()
+            updated_account_ids = (await session.scalars(
+                move_funds_statement(paying_account_id=_to_account_id(paying_account_id),
+                                     receiving_account_id=_to_account_id(receiving_account_id),
+                                     amount=amount))).all()
+
+            if len(updated_account_ids) != 2:
+                await session.rollback()
+                # Finding out why the transfer was denied costs an extra query, so it is done only for denied transfers
+                account_stripes = {
+                    str(account_id): stripes for account_id, stripes in await session.execute(
+                        account_stripes_statement([_to_account_id(src_account_id),
+                                                   _to_account_id(dst_account_id)]))
+                }
+                return None, get_denial_reason(src_account_id=src_account_id,
+                                               dst_account_id=dst_account_id,
+                                               paying_account_id=paying_account_id,
+                                               existing_account_ids=set(account_stripes),
+                                               striped_account_ids={account_id for account_id, stripes
+                                                                    in account_stripes.items() if stripes})
+
+            transaction = sqlalchemy_models.Transaction(
+                src_account_id=_to_account_id(src_account_id),
+                dst_account_id=_to_account_id(dst_account_id),
+                timestamp=timestamp,
+                amount=amount,
+                direction=direction.value,
+                status=dal_models.DalTransactionStatus.successful.value,
+                reason=""
+            )
+            session.add(transaction)
+            # Flushing inserts the record & fetches its ID, so the record can be read before the commit expires it
+            await session.flush()
+            dal_transaction = dal_models.DalTransaction.from_orm(transaction)
+            self._add_idempotency_key(session=session, idempotency_key=idempotency_key,
+                                      request_fingerprint=request_fingerprint, dal_transaction=dal_transaction)
+            await session.commit()
+            if self.__on_account_balances_changed:
+                self.__on_account_balances_changed([paying_account_id, receiving_account_id])
+
+            return dal_transaction, None
+
+    async def create_transaction(
+            self,
+            src_account_id: str,
+            dst_account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            status: dal_models.DalTransactionStatus,
+            reason: Optional[str] = None,
+            idempotency_key: Optional[str] = None,
+            request_fingerprint: Optional[str] = None) -> dal_models.DalTransaction:
+        """
+        Async version of Dal.create_transaction. Creates a Transaction record (& stores the idempotency key of the
+        request along with it, if given) in the database & returns it.
+        Note: This function does not transfer the funds, this has to be done separately.
+        :return: The created Transaction record
+        """
+
+        async with await self._get_session() as session:
+            transaction = sqlalchemy_models.Transaction(
+                src_account_id=_to_account_id(src_account_id),
+                dst_account_id=_to_account_id(dst_account_id),
+                timestamp=timestamp,
+                amount=amount,
+                direction=direction.value,
+                status=status.value,
+                reason=reason if reason else ""
+            )
+            session.add(transaction)
+            await session.flush()
+            dal_transaction = dal_models.DalTransaction.from_orm(transaction)
+            self._add_idempotency_key(session=session, idempotency_key=idempotency_key,
+                                      request_fingerprint=request_fingerprint, dal_transaction=dal_transaction)
+            await session.commit()
+
+        return dal_transaction
+
+    async def get_paginated_transactions(self, start_timestamp: datetime,
+                                         end_timestamp: datetime,
+                                         page: int = 0,
+                                         limit: int = 100) -> List[dal_models.DalTransaction]:
+        """
+        Async version of Dal.get_paginated_transactions. Searches for all transaction matching the given parameters,
+        & returns them within the specified pagination
+        :return: The transactions in the page
+        """
+
+        async with await self._get_session() as session:
+            all_transactions = (await session.scalars(
+                transactions_in_range_statement(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+                .order_by(sqlalchemy_models.Transaction.timestamp)
+                .offset(page * limit)
+                .limit(limit)
+            )).all()
+
+            return [dal_models.DalTransaction.from_orm(transaction) for transaction in all_transactions]
+
+    async def count_transactions(self, start_timestamp: datetime, end_timestamp: datetime) -> int:
+        """Async version of Dal.count_transactions"""
+
+        cache_key = (start_timestamp, end_timestamp)
+        cached_count = self.__transactions_count_cache.get(cache_key)
+        if cached_count is not None:
+            return cached_count
+
+        async with await self._get_session() as session:
+            count = await session.scalar(count_transactions_statement(start_timestamp=start_timestamp,
+                                                                      end_timestamp=end_timestamp))
+
+        self.__transactions_count_cache.set(cache_key, count)
+        return count
+
+    async def estimate_transactions_count(self, start_timestamp: datetime, end_timestamp: datetime) -> int:
+        """Async version of Dal.estimate_transactions_count"""
+
+        async with await self._get_session() as session:
+            explain_result = await session.scalar(explain_transactions_in_range_statement(
+                start_timestamp=start_timestamp, end_timestamp=end_timestamp))
+
+        return get_estimated_rows(explain_result)
+
+    async def get_transactions_page_after(self,
+                                          start_timestamp: datetime,
+                                          end_timestamp: datetime,
+                                          after_timestamp: Optional[datetime] = None,
+                                          after_transaction_id: Optional[int] = None,
+                                          limit: int = 100) -> List[dal_models.DalTransaction]:
+        """Async version of Dal.get_transactions_page_after (keyset pagination of the transactions report)"""
+
+        async with await self._get_session() as session:
+            transactions = (await session.scalars(transactions_keyset_page_statement(
+                start_timestamp=start_timestamp,
+                end_timestamp=end_timestamp,
+                after_timestamp=after_timestamp,
+                after_transaction_id=after_transaction_id,
+                limit=limit))).all()
+
+            return [dal_models.DalTransaction.from_orm(transaction) for transaction in transactions]
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+import threading
+import time
+from typing import Generic, TypeVar, Optional, Hashable, Tuple
+
+V = TypeVar('V')
+
+
+class TTLCache(Generic[V]):
+    """
+    A thread safe, bounded in-process cache. When the cache is full the least recently used entry is evicted,
+    & entries older than the TTL are treated as missing.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        """
+        :param max_size: The maximum number of entries kept in the cache
+        :param ttl: How long (seconds) an entry is valid for. None means entries never expire
+        """
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__entries: 'OrderedDict[Hashable, Tuple[float, V]]' = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """Returns the cached value of the key, or None if it is not cached (or expired)"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+
+            stored_at, value = entry
+            if self.__ttl is not None and time.monotonic() - stored_at > self.__ttl:
+                del self.__entries[key]
+                return None
+
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: V) -> None:
+        with self.__lock:
+            self.__entries[key] = (time.monotonic(), value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
@@ -1,99 +1,987 @@
-from datetime import datetime
-from typing import Optional, Tuple, Iterable
+from datetime import datetime, timedelta
+import os
+import random
+import time
+from typing import Optional, Tuple, Callable, TypeVar, List, Dict, Iterator, Iterable, Set
 
 from pydantic import PositiveFloat
 import structlog
 from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy import and_
+from sqlalchemy import select, insert, delete
+from sqlalchemy.exc import DBAPIError, IntegrityError
 
 from dal import dal_models
-from dal.sqlalchemy.configuration import get_sqlalchemy_engine
+from dal.cache import TTLCache
+from dal.idempotency import StoredResponse, get_request_fingerprint, build_idempotency_key, to_stored_response, \
+    check_stored_response, is_duplicate_key_error
+from dal.transfers import get_paying_and_receiving_account_ids, get_denial_reason, get_account_lock_order_key, \
+    get_striped_account_reason
+from dal.sqlalchemy.configuration import get_sqlalchemy_engine, get_pool_stats, EngineProfile
+from dal.sqlalchemy.errors import get_sqlstate, is_retryable_db_error
+from dal.sqlalchemy.statements import move_funds_statement, lock_accounts_statement, existing_account_ids_statement, \
+    transactions_in_range_statement, transactions_keyset_page_statement, \
+    count_transactions_statement, explain_transactions_in_range_statement, get_estimated_rows, \
+    export_transactions_statement, account_transactions_statement, withdraw_statement, deposit_statement, \
+    account_stripes_statement, withdraw_from_stripe_statement, deposit_to_stripe_statement, account_balance_statement
 from dal.sqlalchemy import models as sqlalchemy_models
+from dal.sqlalchemy import partitions, schema
+from dal.sqlalchemy import rollups
 
 
 logger = structlog.get_logger()
 
+T = TypeVar('T')
+
+# How long (seconds) the number of stripes of an account is cached for
+ACCOUNT_STRIPES_CACHE_TTL = 60
+# The maximum time range of transactions rolled up in a single database transaction
+MAX_ROLLUP_RANGE = timedelta(days=1)
+
 
 class Dal:
 
+    __engine = None
     __session_maker = None
-    __session = None
+
+    def __init__(self,
+                 max_transfer_attempts: int = 5,
+                 transfer_retry_base_delay: float = 0.05,
+                 transfers_batch_chunk_size: int = 500,
+                 report_count_cache_ttl: float = 30,
+                 bank_account_id: Optional[str] = None,
+                 idempotency_cache_size: int = 10000,
+                 account_balance_cache_ttl: float = 1):
+        """
+        :param max_transfer_attempts: The maximum number of times a money transfer is attempted when it conflicts with
+            concurrent transfers (deadlocks / serialization failures), before giving up
+        :param transfer_retry_base_delay: The base delay (seconds) of the exponential backoff between transfer attempts
+        :param transfers_batch_chunk_size: The maximum number of transfers of a batch committed in a single
+            database transaction
+        :param report_count_cache_ttl: How long (seconds) the total count of a transactions report is cached for
+        :param bank_account_id: The ID of the account of the bank itself, used by bank transactions
+        :param idempotency_cache_size: The number of recently used idempotency keys kept in memory, so replayed
+            requests are answered without a database round trip
+        :param account_balance_cache_ttl: How long (seconds) the balance of an account is cached for. Balances are
+            evicted from the cache when a transfer of the account commits, so the TTL only bounds how stale a balance
+            changed by another process (API worker / instance) can be
+        """
+        self.__max_transfer_attempts = max_transfer_attempts
+        self.__transfer_retry_base_delay = transfer_retry_base_delay
+        self.__transfers_batch_chunk_size = transfers_batch_chunk_size
+        self.__transactions_count_cache: TTLCache[int] = TTLCache(max_size=1024, ttl=report_count_cache_ttl)
+        self.__bank_account_id = bank_account_id
+        # The number of stripes of accounts rarely changes, so it is cached instead of being read on every transaction
+        self.__account_stripes_cache: TTLCache[int] = TTLCache(max_size=1024, ttl=ACCOUNT_STRIPES_CACHE_TTL)
+        # Stored responses never change, so they are only evicted when the cache is full
+        self.__idempotency_cache: TTLCache[StoredResponse] = TTLCache(max_size=idempotency_cache_size)
+        self.__account_balances_cache: TTLCache[dal_models.DalAccountBalance] = TTLCache(
+            max_size=10000, ttl=account_balance_cache_ttl)
+
+    @property
+    def bank_account_id(self) -> Optional[str]:
+        """The ID of the account of the bank itself, used by bank transactions"""
+        return self.__bank_account_id
 
     def _get_session(self) -> Session:
         """
-        Generates a session object, needed to interact with the database
+        Generates a new session object, needed to interact with the database.
+        Every unit of work must use its own session (sessions are not thread safe, & routes run in a thread pool).
+        The session checks out its connection from the pool straight away, so the time spent waiting for a free
+        connection is logged along with the pool usage.
         :return: Session instance
         """
-        if not self.__session_maker and not self.__session:
+        if not self.__session_maker:
             raise ValueError('The session maker is missing. are you sure you initiated the database connection?')
 
-        if self.__session:
-            return self.__session
+        session = self.__session_maker()
 
-        self.__session = self.__session_maker()
+        checkout_start_time = time.perf_counter()
+        session.connection()
+        logger.debug('Database connection checked out',
+                     pool_wait=time.perf_counter() - checkout_start_time,
+                     **get_pool_stats(self.__engine))
 
-        return self.__session
+        return session
 
-    def initiate_connection(self, connection_string: str) -> None:
+    def initiate_connection(self,
+                            connection_string: str,
+                            engine_profile: Optional[EngineProfile] = None) -> None:
         """
         Setup all required connections to the database. This function must be called at least once before using the db
         :param connection_string: The connection string to the databse we are connecting to.
             The format is SQLAlchemy format
+        :param engine_profile: The options of the database engine (driver, connection pool...).
+            Defaults to the production profile
         :return: None
         """
 
         logger.debug('Creating sql alchemy engine')
-        engine = get_sqlalchemy_engine(connection_string)
+        self.__engine = get_sqlalchemy_engine(connection_string, profile=engine_profile)
         logger.debug('creating all model schemas in database')
-        sqlalchemy_models.Base.metadata.create_all(engine)
+        sqlalchemy_models.Base.metadata.create_all(self.__engine)
+        # Columns & indexes added to existing tables are not created with the tables
+        schema.add_missing_columns(self.__engine, sqlalchemy_models.Base.metadata)
+        schema.create_missing_indexes(self.__engine, sqlalchemy_models.Base.metadata)
         logger.debug('model schemas created in database')
 
-        self.__session_maker = sessionmaker(bind=engine)
+        self.__session_maker = sessionmaker(bind=self.__engine)
 
-    def transfer_money(self, src_account_id: str, dst_account_id: str, amount: float) -> None:
+    def _perform_idempotently(self,
+                              idempotency_key: Optional[str],
+                              request_fingerprint: str,
+                              operation: Callable[[], dal_models.DalTransaction]) -> dal_models.DalTransaction:
         """
-        Attempts to transfer money between the given bank accounts, & throws an error if the transfer failed.
-        Note: this function does not create a Transaction record, it has to be created separately
-        :param src_account_id: The ID of the account to take the funds from
-        :param dst_account_id: The ID of the account to grant the funds to
-        :param amount: The amount of funds to transfer (can be negative value)
-        :return: None
+        Runs the operation creating a Transaction, unless a Transaction was already created with the idempotency key.
+        Replays are answered from the in-memory cache, or from the idempotency keys table, without touching the
+        accounts. The key is stored by the operation in the same database transaction as the Transaction, so if two
+        requests with the same key race, the second one is rolled back by the unique key & gets the stored result.
+        :param idempotency_key: The idempotency key of the request. None runs the operation as is
+        :param request_fingerprint: The fingerprint of the request, to detect keys reused for a different request
+        :param operation: A function creating the Transaction & storing the idempotency key with it
+        :return: The created (or previously created) Transaction
         """
 
-        # TODO: If the transaction failed because there was a db change,
-        #  run it again after waiting a random amount of time. after X attempts return a failure
+        if idempotency_key is None:
+            return operation()
+
+        stored_response = self.__idempotency_cache.get(idempotency_key) or self._get_stored_response(idempotency_key)
+        if stored_response is not None:
+            logger.info('Replaying the transaction of an idempotency key', idempotency_key=idempotency_key)
+            return check_stored_response(idempotency_key=idempotency_key,
+                                         request_fingerprint=request_fingerprint,
+                                         stored_response=stored_response,
+                                         cache=self.__idempotency_cache)
+
+        try:
+            dal_transaction = operation()
+        except IntegrityError as e:
+            stored_response = self._get_stored_response(idempotency_key) if is_duplicate_key_error(e) else None
+            if stored_response is None:
+                raise
+
+            logger.info('A concurrent request with the same idempotency key completed first',
+                        idempotency_key=idempotency_key)
+            return check_stored_response(idempotency_key=idempotency_key,
+                                         request_fingerprint=request_fingerprint,
+                                         stored_response=stored_response,
+                                         cache=self.__idempotency_cache)
 
+        self.__idempotency_cache.set(idempotency_key, (request_fingerprint, dal_transaction))
+        return dal_transaction
+
+    def _get_stored_response(self, idempotency_key: str) -> Optional[StoredResponse]:
+        """Reads the stored response of the idempotency key from the database (None if the key was not used)"""
         with self._get_session() as session:
-            # Begin a database transaction
-            session.begin()
+            return to_stored_response(session.get(sqlalchemy_models.IdempotencyKey, idempotency_key))
+
+    @staticmethod
+    def _add_idempotency_key(session: Session,
+                             idempotency_key: Optional[str],
+                             request_fingerprint: Optional[str],
+                             dal_transaction: dal_models.DalTransaction) -> None:
+        """Adds the idempotency key (if given) to the session, so it is committed along with its Transaction"""
+        if idempotency_key is not None:
+            session.add(build_idempotency_key(idempotency_key=idempotency_key,
+                                              request_fingerprint=request_fingerprint,
+                                              dal_transaction=dal_transaction,
+                                              created_at=dal_transaction.timestamp))
 
-            # Retrieve the source and destination accounts from the database with row-level locking
-            src_account = session.query(sqlalchemy_models.BankAccount).with_for_update().get(src_account_id)
-            dst_account = session.query(sqlalchemy_models.BankAccount).with_for_update().get(dst_account_id)
+    def _retry_on_contention(self, operation: Callable[[], T]) -> Tuple[T, int]:
+        """
+        Runs the given database operation, & runs it again after a random (jittered) backoff if it failed because it
+        conflicted with a concurrent transaction (deadlock / serialization failure), up to the configured number of
+        attempts. Any other error, or a conflict in the last attempt, is raised as is.
+        :param operation: A function performing (& committing) a single database transaction
+        :return: (result, attempts) A tuple containing the result of the operation & the number of attempts it took
+        """
 
-            # TODO: Raise custom exceptions for known errors such as insufficient funds
-            if src_account is None:
-                raise ValueError(f"Source account with ID {src_account_id} does not exist")
-            if dst_account is None:
-                raise ValueError(f"Destination account with ID {dst_account_id} does not exist")
-            if src_account_id == dst_account_id:
-                raise ValueError(f"Source and destination accounts must be different accounts")
-            if amount > 0 and src_account.balance < amount:
-                raise ValueError("Insufficient funds in the source account")
-            if amount < 0 and dst_account.balance < amount * -1:
-                raise ValueError("Insufficient funds in the destination account")
+        for attempt in range(1, self.__max_transfer_attempts + 1):
+            try:
+                result = operation()
+            except DBAPIError as e:
+                if not is_retryable_db_error(e) or attempt >= self.__max_transfer_attempts:
+                    raise
 
-            # Perform the transaction
-            src_account.balance -= amount
-            dst_account.balance += amount
+                # Full jitter exponential backoff, so that conflicting transfers do not retry in lock step
+                retry_delay = random.uniform(0, self.__transfer_retry_base_delay * 2 ** (attempt - 1))
+                logger.warning('Money transfer conflicted with a concurrent transfer, retrying',
+                               attempt=attempt,
+                               max_attempts=self.__max_transfer_attempts,
+                               retry_delay=retry_delay,
+                               sqlstate=get_sqlstate(e))
+                time.sleep(retry_delay)
+            else:
+                logger.debug('Money transfer committed', attempts=attempt)
+                return result, attempt
 
-            # Commit the changes to the database
+    def perform_transaction(
+            self,
+            src_account_id: str,
+            dst_account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            idempotency_key: Optional[str] = None) -> dal_models.DalTransaction:
+        """
+        Transfers the funds between the given bank accounts & creates the matching Transaction record,
+        both in a single database transaction, so the account balances & the transactions ledger can never diverge.
+        If the transfer is denied (missing accounts, insufficient funds...) no money is moved,
+        & a failed Transaction record is created instead.
+
+        :param src_account_id: The source account id of the transaction
+        :param dst_account_id: The destination account id of the transaction
+        :param timestamp: The timestamp of when the transaction took place
+        :param amount: The amount (positive value) to transfer
+        :param direction: The direction of the money transfer
+            (See documentation of DalTransactionDirection enum for more detailed explanation)
+        :param idempotency_key: A key identifying the request. If a transaction was already created with this key,
+            it is returned instead of transferring the funds again
+        :return: The created Transaction record, with a status specifying if the transfer was successful or not
+        :raises IdempotencyKeyReusedError: If the idempotency key was already used for a different transfer
+        """
+
+        request_fingerprint = get_request_fingerprint('transaction', src_account_id, dst_account_id, amount,
+                                                      direction.value)
+        return self._perform_idempotently(
+            idempotency_key=idempotency_key,
+            request_fingerprint=request_fingerprint,
+            operation=lambda: self._perform_transaction(src_account_id=src_account_id,
+                                                        dst_account_id=dst_account_id,
+                                                        timestamp=timestamp,
+                                                        amount=amount,
+                                                        direction=direction,
+                                                        idempotency_key=idempotency_key,
+                                                        request_fingerprint=request_fingerprint))
+
+    def _perform_transaction(
+            self,
+            src_account_id: str,
+            dst_account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            idempotency_key: Optional[str],
+            request_fingerprint: str) -> dal_models.DalTransaction:
+        """Performs the transfer (see perform_transaction), storing the idempotency key with the created Transaction"""
+
+        (dal_transaction, denial_reason), attempts = self._retry_on_contention(
+            lambda: self._perform_transaction_once(src_account_id=src_account_id,
+                                                   dst_account_id=dst_account_id,
+                                                   timestamp=timestamp,
+                                                   amount=amount,
+                                                   direction=direction,
+                                                   idempotency_key=idempotency_key,
+                                                   request_fingerprint=request_fingerprint))
+
+        if denial_reason is None:
+            logger.debug('Money transfer was successful', attempts=attempts)
+            dal_transaction.transfer_attempts = attempts
+            return dal_transaction
+
+        failure_reason = f'Transfer of funds denied. reason: {denial_reason}'
+        logger.warning(failure_reason)
+        dal_transaction = self.create_transaction(
+            src_account_id=src_account_id,
+            dst_account_id=dst_account_id,
+            timestamp=timestamp,
+            amount=amount,
+            direction=direction,
+            status=dal_models.DalTransactionStatus.fail,
+            reason=failure_reason,
+            idempotency_key=idempotency_key,
+            request_fingerprint=request_fingerprint)
+        dal_transaction.transfer_attempts = attempts
+        return dal_transaction
+
+    def _perform_transaction_once(
+            self,
+            src_account_id: str,
+            dst_account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            idempotency_key: Optional[str] = None,
+            request_fingerprint: Optional[str] = None
+    ) -> Tuple[Optional[dal_models.DalTransaction], Optional[str]]:
+        """
+        A single attempt of moving the funds & writing the successful Transaction record.
+        The accounts are locked in ascending ID order first, & then the funds are moved with a single guarded UPDATE,
+        that only takes money from the paying account if it has enough funds. If the update did not affect both
+        accounts the database transaction is rolled back.
+        :return: (transaction, denial_reason) A tuple containing either the created Transaction record,
+            or the reason why the transfer was denied
+        """
+
+        if src_account_id == dst_account_id:
+            return None, "Source and destination accounts must be different accounts"
+
+        paying_account_id, receiving_account_id = get_paying_and_receiving_account_ids(
+            src_account_id=src_account_id, dst_account_id=dst_account_id, direction=direction)
+
+        with self._get_session() as session:
+            session.scalars(lock_accounts_statement([paying_account_id, receiving_account_id])).all()
+            updated_account_ids = session.scalars(move_funds_statement(paying_account_id=paying_account_id,
+                                                                       receiving_account_id=receiving_account_id,
+                                                                       amount=amount)).all()
+
+            if len(updated_account_ids) != 2:
+                session.rollback()
+                # Finding out why the transfer was denied costs an extra query, so it is done only for denied transfers
+                account_stripes = {
+                    str(account_id): stripes for account_id, stripes in
+                    session.execute(account_stripes_statement([src_account_id, dst_account_id]))
+                }
+                return None, get_denial_reason(src_account_id=src_account_id,
+                                               dst_account_id=dst_account_id,
+                                               paying_account_id=paying_account_id,
+                                               existing_account_ids=set(account_stripes),
+                                               striped_account_ids={account_id for account_id, stripes
+                                                                    in account_stripes.items() if stripes})
+
+            transaction = sqlalchemy_models.Transaction(
+                src_account_id=src_account_id,
+                dst_account_id=dst_account_id,
+                timestamp=timestamp,
+                amount=amount,
+                direction=direction.value,
+                status=dal_models.DalTransactionStatus.successful.value,
+                reason=""
+            )
+            session.add(transaction)
+            # Flushing inserts the record & fetches its ID, so the record can be read before the commit expires it
+            # (which would cost another round trip to reload it)
+            session.flush()
+            dal_transaction = dal_models.DalTransaction.from_orm(transaction)
+            self._add_idempotency_key(session=session, idempotency_key=idempotency_key,
+                                      request_fingerprint=request_fingerprint, dal_transaction=dal_transaction)
             session.commit()
+            self.invalidate_account_balances([paying_account_id, receiving_account_id])
 
             logger.debug(f"Transaction completed: {amount} units transferred "
-                         f"from account {src_account_id} to account {dst_account_id}")
-            logger.debug(f"Source account balance: {src_account.balance}")
-            logger.debug(f"Destination account balance: {dst_account.balance}")
+                         f"from account {paying_account_id} to account {receiving_account_id}")
+
+            return dal_transaction, None
+
+    def perform_transactions_batch(self,
+                                   transfers: List[dal_models.DalTransferRequest],
+                                   timestamp: datetime) -> List[dal_models.DalTransaction]:
+        """
+        Performs a batch of money transfers & creates a Transaction record for each of them.
+        The transfers are processed in chunks, where every chunk is a single database transaction: the accounts of the
+        whole chunk are locked at once, the transfers are applied in order & all the Transaction records are inserted
+        in bulk. Transfers are applied one after the other, so a transfer can use funds received earlier in the batch.
+
+        :param transfers: The transfers to perform, in the order they should be applied
+        :param timestamp: The timestamp of when the transactions took place
+        :return: The created Transaction records, in the same order as the given transfers
+        """
+
+        dal_transactions = []
+        for chunk_start in range(0, len(transfers), self.__transfers_batch_chunk_size):
+            chunk = transfers[chunk_start:chunk_start + self.__transfers_batch_chunk_size]
+            try:
+                chunk_transactions, attempts = self._retry_on_contention(
+                    lambda: self._perform_transactions_chunk(transfers=chunk, timestamp=timestamp))
+                logger.debug('Transfers chunk committed', chunk_start=chunk_start, chunk_size=len(chunk),
+                             attempts=attempts)
+            except Exception as e:
+                failure_reason = f'Money transfer failed due to an unexpected error: {e}'
+                logger.exception(failure_reason, chunk_start=chunk_start, chunk_size=len(chunk))
+                chunk_transactions = self._create_transactions(
+                    [self._build_transaction(transfer=transfer,
+                                             timestamp=timestamp,
+                                             status=dal_models.DalTransactionStatus.fail,
+                                             reason=failure_reason)
+                     for transfer in chunk])
+
+            dal_transactions.extend(chunk_transactions)
+
+        return dal_transactions
+
+    def _perform_transactions_chunk(self,
+                                    transfers: List[dal_models.DalTransferRequest],
+                                    timestamp: datetime) -> List[dal_models.DalTransaction]:
+        """
+        Performs a chunk of transfers in a single database transaction.
+        All the accounts involved in the chunk are locked with a single statement in ascending ID order,
+        so concurrent chunks & single transfers can not deadlock on them.
+        :return: The created Transaction records, in the same order as the given transfers
+        """
+
+        account_ids = sorted({transfer.src_account_id for transfer in transfers} |
+                             {transfer.dst_account_id for transfer in transfers},
+                             key=get_account_lock_order_key)
+
+        with self._get_session() as session:
+            accounts = session.scalars(
+                select(sqlalchemy_models.BankAccount)
+                .where(sqlalchemy_models.BankAccount.id.in_(account_ids))
+                .order_by(sqlalchemy_models.BankAccount.id)
+                .with_for_update()
+            ).all()
+            accounts_by_id = {str(account.id): account for account in accounts}
+
+            transactions = []
+            for transfer in transfers:
+                denial_reason = self._apply_transfer(transfer=transfer, accounts_by_id=accounts_by_id)
+                if denial_reason is None:
+                    transactions.append(self._build_transaction(transfer=transfer,
+                                                                timestamp=timestamp,
+                                                                status=dal_models.DalTransactionStatus.successful))
+                else:
+                    transactions.append(self._build_transaction(transfer=transfer,
+                                                                timestamp=timestamp,
+                                                                status=dal_models.DalTransactionStatus.fail,
+                                                                reason=f'Transfer of funds denied. '
+                                                                       f'reason: {denial_reason}'))
+
+            # Writes the updated balances of the accounts
+            session.flush()
+            dal_transactions = self._insert_transactions(session=session, transactions=transactions)
+            session.commit()
+
+        self.invalidate_account_balances(account_ids)
+        return dal_transactions
+
+    @staticmethod
+    def _apply_transfer(transfer: dal_models.DalTransferRequest,
+                        accounts_by_id: Dict[str, sqlalchemy_models.BankAccount]) -> Optional[str]:
+        """
+        Moves the funds of the given transfer between the (already locked) accounts, if the transfer is valid.
+        :return: The reason the transfer was denied, or None if the funds were moved
+        """
+
+        if transfer.src_account_id == transfer.dst_account_id:
+            return "Source and destination accounts must be different accounts"
+
+        src_account = accounts_by_id.get(str(transfer.src_account_id))
+        dst_account = accounts_by_id.get(str(transfer.dst_account_id))
+        if src_account is None:
+            return f"Source account with ID {transfer.src_account_id} does not exist"
+        if dst_account is None:
+            return f"Destination account with ID {transfer.dst_account_id} does not exist"
+        for account in (src_account, dst_account):
+            if account.stripes:
+                return get_striped_account_reason(str(account.id))
+
+        if transfer.direction == dal_models.DalTransactionDirection.debit:
+            paying_account, receiving_account = src_account, dst_account
+        else:
+            paying_account, receiving_account = dst_account, src_account
+
+        if paying_account.balance < transfer.amount:
+            if paying_account is src_account:
+                return "Insufficient funds in the source account"
+            return "Insufficient funds in the destination account"
+
+        paying_account.balance -= transfer.amount
+        receiving_account.balance += transfer.amount
+
+        return None
+
+    @staticmethod
+    def _build_transaction(transfer: dal_models.DalTransferRequest,
+                           timestamp: datetime,
+                           status: dal_models.DalTransactionStatus,
+                           reason: Optional[str] = None) -> Dict:
+        """Builds the column values of a Transaction record of the given transfer, for a bulk insert"""
+        return {
+            'src_account_id': transfer.src_account_id,
+            'dst_account_id': transfer.dst_account_id,
+            'timestamp': timestamp,
+            'amount': transfer.amount,
+            'direction': transfer.direction.value,
+            'status': status.value,
+            'reason': reason if reason else ""
+        }
+
+    @staticmethod
+    def _insert_transactions(session: Session, transactions: List[Dict]) -> List[dal_models.DalTransaction]:
+        """
+        Inserts the given Transaction records in bulk (batched multi-row INSERTs).
+        :return: The created Transaction records, in the same order as the given records
+        """
+
+        if not transactions:
+            return []
+
+        inserted_transactions = session.scalars(
+            insert(sqlalchemy_models.Transaction).returning(sqlalchemy_models.Transaction,
+                                                            sort_by_parameter_order=True),
+            transactions
+        ).all()
+
+        return [dal_models.DalTransaction.from_orm(transaction) for transaction in inserted_transactions]
+
+    def _create_transactions(self, transactions: List[Dict]) -> List[dal_models.DalTransaction]:
+        """Inserts the given Transaction records in bulk, in their own database transaction"""
+        with self._get_session() as session:
+            dal_transactions = self._insert_transactions(session=session, transactions=transactions)
+            session.commit()
+
+        return dal_transactions
+
+    def perform_bank_transaction(
+            self,
+            account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            description: Optional[str] = None,
+            idempotency_key: Optional[str] = None) -> dal_models.DalTransaction:
+        """
+        Moves money between the bank account & the given account, & creates the matching Transaction record in the
+        same database transaction. If the transfer is denied a failed Transaction record is created instead.
+        The Transaction is recorded with the account as the source & the bank account as the destination, so a debit
+        takes money from the account (for example: an advance payment), & a credit gives money to the account
+        (for example: granting an advance).
+        If the bank account (or the account) is hot (its balance is split into stripes), only a single random stripe is
+        locked instead of the whole account, so concurrent bank transactions do not wait for each other.
+
+        :param account_id: The ID of the account the bank gives money to / takes money from
+        :param timestamp: The timestamp of when the transaction took place
+        :param amount: The amount (positive value) to transfer
+        :param direction: debit - take the money from the account, credit - give the money to the account
+        :param description: Why the transaction happened (for example: "Advance payment week 3")
+        :param idempotency_key: A key identifying the request. If a transaction was already created with this key,
+            it is returned instead of transferring the funds again
+        :return: The created Transaction record, with a status specifying if the transfer was successful or not
+        :raises IdempotencyKeyReusedError: If the idempotency key was already used for a different transfer
+        """
+
+        request_fingerprint = get_request_fingerprint('bank_transaction', account_id, amount, direction.value,
+                                                      description)
+        return self._perform_idempotently(
+            idempotency_key=idempotency_key,
+            request_fingerprint=request_fingerprint,
+            operation=lambda: self._perform_bank_transaction(account_id=account_id,
+                                                             timestamp=timestamp,
+                                                             amount=amount,
+                                                             direction=direction,
+                                                             description=description,
+                                                             idempotency_key=idempotency_key,
+                                                             request_fingerprint=request_fingerprint))
+
+    def _perform_bank_transaction(
+            self,
+            account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            description: Optional[str],
+            idempotency_key: Optional[str],
+            request_fingerprint: str) -> dal_models.DalTransaction:
+        """
+        Performs the bank transaction (see perform_bank_transaction), storing the idempotency key with the created
+        Transaction
+        """
+
+        (dal_transaction, denial_reason), attempts = self._retry_on_contention(
+            lambda: self._perform_bank_transaction_once(account_id=account_id,
+                                                        timestamp=timestamp,
+                                                        amount=amount,
+                                                        direction=direction,
+                                                        description=description,
+                                                        idempotency_key=idempotency_key,
+                                                        request_fingerprint=request_fingerprint))
+
+        if denial_reason is None:
+            logger.debug('Bank transaction was successful', attempts=attempts)
+            return dal_transaction
+
+        failure_reason = f'Transfer of funds denied. reason: {denial_reason}'
+        logger.warning(failure_reason)
+        return self.create_transaction(
+            src_account_id=account_id,
+            dst_account_id=self.__bank_account_id,
+            timestamp=timestamp,
+            amount=amount,
+            direction=direction,
+            status=dal_models.DalTransactionStatus.fail,
+            reason=failure_reason,
+            description=description,
+            idempotency_key=idempotency_key,
+            request_fingerprint=request_fingerprint)
+
+    def _perform_bank_transaction_once(
+            self,
+            account_id: str,
+            timestamp: datetime,
+            amount: PositiveFloat,
+            direction: dal_models.DalTransactionDirection,
+            description: Optional[str],
+            idempotency_key: Optional[str] = None,
+            request_fingerprint: Optional[str] = None
+    ) -> Tuple[Optional[dal_models.DalTransaction], Optional[str]]:
+        """
+        A single attempt of moving the funds of a bank transaction & writing the successful Transaction record.
+        The paying side is always updated first, so concurrent bank transactions lock rows in the same order.
+        :return: (transaction, denial_reason) A tuple containing either the created Transaction record,
+            or the reason why the transfer was denied
+        """
+
+        bank_account_id = self.__bank_account_id
+        if str(account_id) == str(bank_account_id):
+            return None, "The bank can not make a transaction with itself"
+
+        paying_account_id, receiving_account_id = get_paying_and_receiving_account_ids(
+            src_account_id=account_id, dst_account_id=bank_account_id, direction=direction)
+
+        with self._get_session() as session:
+            account_stripes = self._get_account_stripes(session=session,
+                                                        account_ids=[paying_account_id, receiving_account_id])
+
+            if not self._withdraw(session=session, account_id=paying_account_id, amount=amount,
+                                  stripes=account_stripes.get(str(paying_account_id), 0)):
+                session.rollback()
+                existing_account_ids = {
+                    str(existing_account_id) for existing_account_id in
+                    session.scalars(existing_account_ids_statement([account_id, bank_account_id]))
+                }
+                return None, get_denial_reason(src_account_id=account_id,
+                                               dst_account_id=bank_account_id,
+                                               paying_account_id=paying_account_id,
+                                               existing_account_ids=existing_account_ids)
+
+            if not self._deposit(session=session, account_id=receiving_account_id, amount=amount,
+                                 stripes=account_stripes.get(str(receiving_account_id), 0)):
+                session.rollback()
+                if receiving_account_id == account_id:
+                    return None, f"Source account with ID {account_id} does not exist"
+                return None, f"Destination account with ID {bank_account_id} does not exist"
+
+            transaction = sqlalchemy_models.Transaction(
+                src_account_id=account_id,
+                dst_account_id=bank_account_id,
+                timestamp=timestamp,
+                amount=amount,
+                direction=direction.value,
+                status=dal_models.DalTransactionStatus.successful.value,
+                reason="",
+                description=description
+            )
+            session.add(transaction)
+            session.flush()
+            dal_transaction = dal_models.DalTransaction.from_orm(transaction)
+            self._add_idempotency_key(session=session, idempotency_key=idempotency_key,
+                                      request_fingerprint=request_fingerprint, dal_transaction=dal_transaction)
+            session.commit()
+            self.invalidate_account_balances([paying_account_id, receiving_account_id])
+
+            return dal_transaction, None
+
+    def perform_bank_transactions_batch(self,
+                                        bank_transfers: List[dal_models.DalBankTransferRequest],
+                                        timestamp: datetime) -> List[dal_models.DalTransaction]:
+        """
+        Performs a batch of bank transactions (see perform_bank_transaction) & creates a Transaction record for each of
+        them. Every bank transaction succeeds or fails on its own, just like bank transactions performed one by one, but
+        the batch is processed in chunks, where every chunk is a single database transaction whose Transaction records &
+        idempotency keys are inserted in bulk.
+        Bank transactions whose idempotency key was already used are replayed instead of being performed again.
+
+        :param bank_transfers: The bank transactions to perform
+        :param timestamp: The timestamp of when the transactions took place
+        :return: The created (or replayed) Transaction records, in the same order as the given bank transactions
+        :raises IdempotencyKeyReusedError: If an idempotency key was already used for a different bank transaction
+        """
+
+        request_fingerprints = [get_request_fingerprint('bank_transaction', bank_transfer.account_id,
+                                                        bank_transfer.amount, bank_transfer.direction.value,
+                                                        bank_transfer.description)
+                                for bank_transfer in bank_transfers]
+        dal_transactions: List[Optional[dal_models.DalTransaction]] = [None] * len(bank_transfers)
+
+        stored_responses = self._get_stored_responses([bank_transfer.idempotency_key for bank_transfer in bank_transfers
+                                                       if bank_transfer.idempotency_key is not None])
+        pending_indexes = []
+        for index, bank_transfer in enumerate(bank_transfers):
+            stored_response = stored_responses.get(bank_transfer.idempotency_key)
+            if stored_response is None:
+                pending_indexes.append(index)
+            else:
+                dal_transactions[index] = check_stored_response(idempotency_key=bank_transfer.idempotency_key,
+                                                                request_fingerprint=request_fingerprints[index],
+                                                                stored_response=stored_response,
+                                                                cache=self.__idempotency_cache)
+        if len(pending_indexes) < len(bank_transfers):
+            logger.info('Replaying the bank transactions of used idempotency keys',
+                        replayed_count=len(bank_transfers) - len(pending_indexes))
+
+        for chunk_start in range(0, len(pending_indexes), self.__transfers_batch_chunk_size):
+            chunk_indexes = pending_indexes[chunk_start:chunk_start + self.__transfers_batch_chunk_size]
+            chunk = [bank_transfers[index] for index in chunk_indexes]
+            chunk_fingerprints = [request_fingerprints[index] for index in chunk_indexes]
+            try:
+                chunk_transactions, attempts = self._retry_on_contention(
+                    lambda: self._perform_bank_transactions_chunk(bank_transfers=chunk,
+                                                                  request_fingerprints=chunk_fingerprints,
+                                                                  timestamp=timestamp))
+                logger.debug('Bank transactions chunk committed', chunk_start=chunk_start, chunk_size=len(chunk),
+                             attempts=attempts)
+            except IntegrityError as e:
+                if not is_duplicate_key_error(e):
+                    raise
+
+                # An idempotency key of the chunk was used concurrently (or twice in the batch). Performed one by one,
+                # the bank transactions of the used keys are replayed
+                logger.info('An idempotency key of the chunk was used concurrently, performing it one by one',
+                            chunk_start=chunk_start, chunk_size=len(chunk))
+                chunk_transactions = [
+                    self.perform_bank_transaction(account_id=bank_transfer.account_id,
+                                                  timestamp=timestamp,
+                                                  amount=bank_transfer.amount,
+                                                  direction=bank_transfer.direction,
+                                                  description=bank_transfer.description,
+                                                  idempotency_key=bank_transfer.idempotency_key)
+                    for bank_transfer in chunk
+                ]
+            except Exception as e:
+                failure_reason = f'Money transfer failed due to an unexpected error: {e}'
+                logger.exception(failure_reason, chunk_start=chunk_start, chunk_size=len(chunk))
+                # The idempotency keys are not stored with the failed records, so the bank transactions can be retried
+                chunk_transactions = self._create_transactions(
+                    [self._build_bank_transaction(bank_transfer=bank_transfer,
+                                                  timestamp=timestamp,
+                                                  status=dal_models.DalTransactionStatus.fail,
+                                                  reason=failure_reason)
+                     for bank_transfer in chunk])
+            else:
+                for bank_transfer, request_fingerprint, dal_transaction in zip(chunk, chunk_fingerprints,
+                                                                               chunk_transactions):
+                    if bank_transfer.idempotency_key is not None:
+                        self.__idempotency_cache.set(bank_transfer.idempotency_key,
+                                                     (request_fingerprint, dal_transaction))
+
+            for index, dal_transaction in zip(chunk_indexes, chunk_transactions):
+                dal_transactions[index] = dal_transaction
+
+        return dal_transactions
+
+    def _get_stored_responses(self, idempotency_keys: List[str]) -> Dict[str, StoredResponse]:
+        """Returns the stored responses of the used idempotency keys, from the cache when possible"""
+        stored_responses = {}
+        missing_idempotency_keys = []
+        for idempotency_key in idempotency_keys:
+            stored_response = self.__idempotency_cache.get(idempotency_key)
+            if stored_response is None:
+                missing_idempotency_keys.append(idempotency_key)
+            else:
+                stored_responses[idempotency_key] = stored_response
+
+        if missing_idempotency_keys:
+            with self._get_session() as session:
+                for idempotency_key in session.scalars(
+                        select(sqlalchemy_models.IdempotencyKey)
+                        .where(sqlalchemy_models.IdempotencyKey.key.in_(missing_idempotency_keys))):
+                    stored_responses[idempotency_key.key] = to_stored_response(idempotency_key)
+
+        return stored_responses
+
+    def _perform_bank_transactions_chunk(self,
+                                         bank_transfers: List[dal_models.DalBankTransferRequest],
+                                         request_fingerprints: List[str],
+                                         timestamp: datetime) -> List[dal_models.DalTransaction]:
+        """
+        Performs a chunk of bank transactions in a single database transaction, storing their idempotency keys with the
+        created Transaction records. The bank transactions are applied in ascending (numeric) account ID order, the same
+        order _perform_transactions_chunk locks the accounts in (the bank transactions of the same account in the given
+        order), so concurrent chunks lock the account rows in the same order. The bank account is locked by the first
+        bank transaction (a random stripe of it, if it is striped).
+        :return: The created Transaction records, in the same order as the given bank transactions
+        """
+
+        bank_account_id = self.__bank_account_id
+        account_ids = sorted({bank_transfer.account_id for bank_transfer in bank_transfers} | {str(bank_account_id)},
+                             key=get_account_lock_order_key)
+        transactions: List[Optional[Dict]] = [None] * len(bank_transfers)
+
+        with self._get_session() as session:
+            existing_account_ids = {str(existing_account_id) for existing_account_id in
+                                    session.scalars(existing_account_ids_statement(account_ids))}
+            account_stripes = self._get_account_stripes(session=session, account_ids=account_ids)
+
+            for index in sorted(range(len(bank_transfers)),
+                                key=lambda index: get_account_lock_order_key(bank_transfers[index].account_id)):
+                bank_transfer = bank_transfers[index]
+                denial_reason = self._apply_bank_transfer(session=session,
+                                                          bank_transfer=bank_transfer,
+                                                          existing_account_ids=existing_account_ids,
+                                                          account_stripes=account_stripes)
+                if denial_reason is None:
+                    transactions[index] = self._build_bank_transaction(
+                        bank_transfer=bank_transfer,
+                        timestamp=timestamp,
+                        status=dal_models.DalTransactionStatus.successful)
+                else:
+                    transactions[index] = self._build_bank_transaction(
+                        bank_transfer=bank_transfer,
+                        timestamp=timestamp,
+                        status=dal_models.DalTransactionStatus.fail,
+                        reason=f'Transfer of funds denied. reason: {denial_reason}')
+
+            dal_transactions = self._insert_transactions(session=session, transactions=transactions)
+            for bank_transfer, request_fingerprint, dal_transaction in zip(bank_transfers, request_fingerprints,
+                                                                           dal_transactions):
+                self._add_idempotency_key(session=session, idempotency_key=bank_transfer.idempotency_key,
+                                          request_fingerprint=request_fingerprint, dal_transaction=dal_transaction)
+            session.commit()
+
+        self.invalidate_account_balances(account_ids)
+        return dal_transactions
+
+    def _apply_bank_transfer(self,
+                             session: Session,
+                             bank_transfer: dal_models.DalBankTransferRequest,
+                             existing_account_ids: Set[str],
+                             account_stripes: Dict[str, int]) -> Optional[str]:
+        """
+        Moves the funds of a bank transaction between the account & the bank account, if the transfer is valid.
+        :param existing_account_ids: Which of the accounts of the chunk exist (as strings)
+        :return: The reason the transfer was denied, or None if the funds were moved
+        """
+
+        account_id, bank_account_id = bank_transfer.account_id, self.__bank_account_id
+        if str(account_id) == str(bank_account_id):
+            return "The bank can not make a transaction with itself"
+
+        paying_account_id, receiving_account_id = get_paying_and_receiving_account_ids(
+            src_account_id=account_id, dst_account_id=bank_account_id, direction=bank_transfer.direction)
+
+        if {str(account_id), str(bank_account_id)} - existing_account_ids or \
+                not self._withdraw(session=session, account_id=paying_account_id, amount=bank_transfer.amount,
+                                   stripes=account_stripes.get(str(paying_account_id), 0)):
+            return get_denial_reason(src_account_id=account_id,
+                                     dst_account_id=bank_account_id,
+                                     paying_account_id=paying_account_id,
+                                     existing_account_ids=existing_account_ids)
+
+        # Both accounts exist, so the deposit can not fail
+        self._deposit(session=session, account_id=receiving_account_id, amount=bank_transfer.amount,
+                      stripes=account_stripes.get(str(receiving_account_id), 0))
+        return None
+
+    def _build_bank_transaction(self,
+                                bank_transfer: dal_models.DalBankTransferRequest,
+                                timestamp: datetime,
+                                status: dal_models.DalTransactionStatus,
+                                reason: Optional[str] = None) -> Dict:
+        """
+        Builds the column values of the Transaction record of a bank transaction, for a bulk insert.
+        Bank transactions are recorded with the account as the source & the bank account as the destination
+        """
+        transfer = dal_models.DalTransferRequest(src_account_id=bank_transfer.account_id,
+                                                 dst_account_id=str(self.__bank_account_id),
+                                                 amount=bank_transfer.amount,
+                                                 direction=bank_transfer.direction)
+        return {
+            **self._build_transaction(transfer=transfer, timestamp=timestamp, status=status, reason=reason),
+            'description': bank_transfer.description,
+        }
+
+    def _get_account_stripes(self, session: Session, account_ids: List[str]) -> Dict[str, int]:
+        """Returns the number of stripes of every given (existing) account, from the cache when possible"""
+        account_stripes = {}
+        missing_account_ids = []
+        for account_id in account_ids:
+            stripes = self.__account_stripes_cache.get(str(account_id))
+            if stripes is None:
+                missing_account_ids.append(account_id)
+            else:
+                account_stripes[str(account_id)] = stripes
+
+        if missing_account_ids:
+            for account_id, stripes in session.execute(account_stripes_statement(missing_account_ids)):
+                account_stripes[str(account_id)] = stripes
+                self.__account_stripes_cache.set(str(account_id), stripes)
+
+        return account_stripes
+
+    @staticmethod
+    def _withdraw(session: Session, account_id: str, amount: float, stripes: int) -> bool:
+        """
+        Takes the amount from the account, only if it has enough funds.
+        For a striped account, a random stripe with enough funds that is not locked by another transaction is used.
+        If all such stripes are locked, waits for one of them, & if no stripe has enough funds, uses the account row.
+        :return: True if the funds were taken
+        """
+        if stripes:
+            for skip_locked in (True, False):
+                stripe_number = session.scalar(withdraw_from_stripe_statement(account_id=account_id,
+                                                                              amount=amount,
+                                                                              skip_locked=skip_locked))
+                if stripe_number is not None:
+                    return True
+
+        return session.scalar(withdraw_statement(account_id=account_id, amount=amount)) is not None
+
+    @staticmethod
+    def _deposit(session: Session, account_id: str, amount: float, stripes: int) -> bool:
+        """
+        Adds the amount to the account. For a striped account the amount is added to a random stripe.
+        :return: True if the funds were added (False if the account does not exist)
+        """
+        if stripes:
+            stripe_number = random.randrange(stripes)
+            if session.scalar(deposit_to_stripe_statement(account_id=account_id,
+                                                          stripe_number=stripe_number,
+                                                          amount=amount)) is not None:
+                return True
+
+        return session.scalar(deposit_statement(account_id=account_id, amount=amount)) is not None
+
+    def stripe_account(self, account_id: str, stripes: int) -> None:
+        """
+        Marks the account as hot by splitting its balance equally into the given number of stripes, or merges the
+        stripes back into the account row when the number of stripes is 0. Does nothing if the account already has the
+        given number of stripes.
+        Only bank transactions use the stripes (account-to-account transfers deny striped accounts), so only the bank
+        account can be striped.
+        :param account_id: The ID of the account
+        :param stripes: The number of stripes to split the balance of the account into
+        :raises ValueError: If the account does not exist, or it is not the bank account
+        """
+
+        if stripes and str(account_id) != str(self.__bank_account_id):
+            raise ValueError(f"Account with ID {account_id} is not the bank account, only the bank account can be "
+                             f"striped")
+
+        with self._get_session() as session:
+            account = session.get(sqlalchemy_models.BankAccount, account_id, with_for_update=True)
+            if account is None:
+                raise ValueError(f"Account with ID {account_id} does not exist")
+            if account.stripes == stripes:
+                return
+
+            existing_stripes = session.scalars(
+                select(sqlalchemy_models.BankAccountStripe)
+                .where(sqlalchemy_models.BankAccountStripe.account_id == account.id)
+                .with_for_update()
+            ).all()
+            total_balance = account.balance + sum(stripe.balance for stripe in existing_stripes)
+            for stripe in existing_stripes:
+                session.delete(stripe)
+            session.flush()
+
+            if stripes:
+                stripe_balance = total_balance / stripes
+                session.add_all([
+                    sqlalchemy_models.BankAccountStripe(account_id=account.id,
+                                                        stripe_number=stripe_number,
+                                                        balance=stripe_balance)
+                    for stripe_number in range(stripes)
+                ])
+                # Whatever is left due to rounding stays in the account row
+                account.balance = max(total_balance - stripe_balance * stripes, 0)
+            else:
+                account.balance = total_balance
+
+            account.stripes = stripes
+            session.commit()
+
+        self.__account_stripes_cache.delete(str(account_id))
+        self.invalidate_account_balances([account_id])
+        logger.info('Account stripes changed', account_id=account_id, stripes=stripes)
 
     def create_transaction(
             self,
@@ -103,7 +991,10 @@ class Dal:
             amount: PositiveFloat,
             direction: dal_models.DalTransactionDirection,
             status: dal_models.DalTransactionStatus,
-            reason: Optional[str] = None) -> dal_models.DalTransaction:
+            reason: Optional[str] = None,
+            description: Optional[str] = None,
+            idempotency_key: Optional[str] = None,
+            request_fingerprint: Optional[str] = None) -> dal_models.DalTransaction:
         """
         Creates a Transaction record in the database & returns it.
         Note: This function does not transfer the funds, this has to be done separately.
@@ -116,6 +1007,9 @@ class Dal:
             (See documentation of DalTransactionDirection enum for more detailed explanation)
         :param status: The state of the transfer, basically if it was successful or not
         :param reason: The reason why the transfer failed. needed only if the transfer failed
+        :param description: Why the transaction happened (used by bank transactions)
+        :param idempotency_key: The idempotency key of the request, stored along with the record
+        :param request_fingerprint: The fingerprint of the request, needed when an idempotency key is given
         :return: The created Transaction record
         """
         
@@ -127,44 +1021,359 @@ class Dal:
                 amount=amount,
                 direction=direction.value,
                 status=status.value,
-                reason=reason if reason else ""
+                reason=reason if reason else "",
+                description=description
             )
             session.add(transaction)
-            session.commit()
-
+            session.flush()
             dal_transaction = dal_models.DalTransaction.from_orm(transaction)
+            self._add_idempotency_key(session=session, idempotency_key=idempotency_key,
+                                      request_fingerprint=request_fingerprint, dal_transaction=dal_transaction)
+            session.commit()
 
         return dal_transaction
 
     def get_paginated_transactions(self, start_timestamp: datetime,
                                    end_timestamp: datetime,
                                    page: int = 0,
-                                   limit: int = 100) -> Tuple[Iterable[dal_models.DalTransaction], int]:
+                                   limit: int = 100) -> List[dal_models.DalTransaction]:
         """
-        Searches for all transaction matching the given parameters, & returns them within the specified pagination
+        Searches for all transaction matching the given parameters, & returns them within the specified pagination.
+        The total number of matching transactions is counted separately (see count_transactions)
         :param start_timestamp: The earliest timestamp of transaction to include.
             Transactions can happen exactly at this time or later.
         :param end_timestamp: The latest timestamp of transaction to include.
             Only transaction that happened before this timestamp are included.
         :param page: The number of the paged results to return (first page is 0)
         :param limit: The maximum amount of elements to show in every page
-        :return: (Transactions, number_of_transactions) A tuple containing:
-            * The Iterable of all the matching transactions in the page
-            * The total number of transactions in every page (used to know how many more pages are there)
+        :return: The transactions in the page
         """
 
-        start_slice = page * limit
-        end_slice = start_slice + limit
         with self._get_session() as session:
-            # A query that returns all transactions within the given time rang
-            all_matching_transactions_query = session.query(sqlalchemy_models.Transaction)\
-                .filter(and_(sqlalchemy_models.Transaction.timestamp >= start_timestamp,
-                             sqlalchemy_models.Transaction.timestamp < end_timestamp))
-
             # Get all matching transactions within the desired page
-            all_transactions = all_matching_transactions_query\
-                .order_by(sqlalchemy_models.Transaction.timestamp).slice(start=start_slice, stop=end_slice).all()
+            all_transactions = session.scalars(
+                transactions_in_range_statement(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+                .order_by(sqlalchemy_models.Transaction.timestamp)
+                .offset(page * limit)
+                .limit(limit)
+            ).all()
+
+            return [dal_models.DalTransaction.from_orm(transaction) for transaction in all_transactions]
+
+    def count_transactions(self, start_timestamp: datetime, end_timestamp: datetime) -> int:
+        """
+        Counts the transactions in the given time range exactly. The count is cached for a short while, so paginating
+        through a report does not count the whole range on every page.
+        :param start_timestamp: The earliest timestamp of transaction to include.
+        :param end_timestamp: The latest timestamp of transaction to include (not included).
+        :return: The number of transactions
+        """
+
+        cache_key = (start_timestamp, end_timestamp)
+        cached_count = self.__transactions_count_cache.get(cache_key)
+        if cached_count is not None:
+            return cached_count
+
+        with self._get_session() as session:
+            count = session.scalar(count_transactions_statement(start_timestamp=start_timestamp,
+                                                                end_timestamp=end_timestamp))
+
+        self.__transactions_count_cache.set(cache_key, count)
+        return count
+
+    def estimate_transactions_count(self, start_timestamp: datetime, end_timestamp: datetime) -> int:
+        """
+        Estimates the number of transactions in the given time range using the query planner statistics,
+        without scanning the transactions
+        :param start_timestamp: The earliest timestamp of transaction to include.
+        :param end_timestamp: The latest timestamp of transaction to include (not included).
+        :return: The estimated number of transactions
+        """
+
+        with self._get_session() as session:
+            explain_result = session.scalar(explain_transactions_in_range_statement(start_timestamp=start_timestamp,
+                                                                                    end_timestamp=end_timestamp))
+
+        return get_estimated_rows(explain_result)
+
+    def get_transactions_page_after(self,
+                                    start_timestamp: datetime,
+                                    end_timestamp: datetime,
+                                    after_timestamp: Optional[datetime] = None,
+                                    after_transaction_id: Optional[int] = None,
+                                    limit: int = 100) -> List[dal_models.DalTransaction]:
+        """
+        Keyset pagination of the transactions report: returns the transactions in the given time range that come after
+        the given (timestamp, id) position, ordered by (timestamp, id).
+        :param start_timestamp: The earliest timestamp of transaction to include.
+        :param end_timestamp: The latest timestamp of transaction to include (not included).
+        :param after_timestamp: The timestamp of the last transaction of the previous page (None for the first page)
+        :param after_transaction_id: The ID of the last transaction of the previous page (None for the first page)
+        :param limit: The maximum amount of transactions to return
+        :return: The transactions of the page
+        """
+
+        with self._get_session() as session:
+            transactions = session.scalars(transactions_keyset_page_statement(
+                start_timestamp=start_timestamp,
+                end_timestamp=end_timestamp,
+                after_timestamp=after_timestamp,
+                after_transaction_id=after_transaction_id,
+                limit=limit)).all()
+
+            return [dal_models.DalTransaction.from_orm(transaction) for transaction in transactions]
+
+    def get_account_balance(self, account_id: str) -> Optional[dal_models.DalAccountBalance]:
+        """
+        Returns the balance of the account (the sum of its stripes for striped accounts), from the cache when possible.
+        The balance is read without locking the account, so reads never wait for (or block) concurrent transfers.
+        :param account_id: The ID of the account
+        :return: The balance of the account, or None if the account does not exist
+        """
+
+        account_balance = self.__account_balances_cache.get(str(account_id))
+        if account_balance is not None:
+            return account_balance
+
+        with self._get_session() as session:
+            row = session.execute(account_balance_statement(account_id)).one_or_none()
+
+        if row is None:
+            return None
+
+        account_balance = dal_models.DalAccountBalance(account_id=str(row.id), balance=row.balance)
+        self.__account_balances_cache.set(str(account_id), account_balance)
+        return account_balance
+
+    def invalidate_account_balances(self, account_ids: Iterable[str]) -> None:
+        """Evicts the cached balances of the given accounts, called whenever a change to their balance commits"""
+        for account_id in account_ids:
+            self.__account_balances_cache.delete(str(account_id))
+
+    def get_account_transactions(self,
+                                 account_id: str,
+                                 start_timestamp: datetime,
+                                 end_timestamp: datetime,
+                                 limit: int = 100) -> List[dal_models.DalTransaction]:
+        """
+        Returns the latest transactions of the account in the given time range, newest first.
+        Includes the transactions where the account is either the source or the destination.
+        :param account_id: The ID of the account
+        :param start_timestamp: The earliest timestamp of transaction to include.
+        :param end_timestamp: The latest timestamp of transaction to include (not included).
+        :param limit: The maximum amount of transactions to return
+        :return: The transactions of the account
+        """
+
+        with self._get_session() as session:
+            transactions = session.scalars(account_transactions_statement(account_id=account_id,
+                                                                          start_timestamp=start_timestamp,
+                                                                          end_timestamp=end_timestamp,
+                                                                          limit=limit)).all()
+
+            return [dal_models.DalTransaction.from_orm(transaction) for transaction in transactions]
+
+    def iter_transactions(self,
+                          start_timestamp: datetime,
+                          end_timestamp: datetime,
+                          chunk_size: int = 1000) -> Iterator[List[dal_models.DalTransaction]]:
+        """
+        Streams all the transactions in the given time range, ordered by (timestamp, id), in chunks.
+        The transactions are fetched from a server side cursor, so only a single chunk is held in memory at a time
+        no matter how many transactions there are.
+        Note: the session (& its connection) is held open until the iterator is exhausted or closed, so iterators that
+        are not exhausted (for example when the client disconnected) must be closed
+        :param start_timestamp: The earliest timestamp of transaction to include.
+        :param end_timestamp: The latest timestamp of transaction to include (not included).
+        :param chunk_size: The number of transactions fetched from the database at a time
+        :return: An iterator of chunks of transactions
+        """
+
+        with self._get_session() as session:
+            result = session.execute(export_transactions_statement(start_timestamp=start_timestamp,
+                                                                   end_timestamp=end_timestamp,
+                                                                   chunk_size=chunk_size))
+            try:
+                for rows in result.partitions():
+                    yield [dal_models.DalTransaction.from_orm(row) for row in rows]
+            finally:
+                # Closes the server side cursor, before the session returns the connection to the pool
+                result.close()
+
+    def maintain_transaction_partitions(self,
+                                        interval: dal_models.DalPartitionInterval,
+                                        premake: int,
+                                        now: Optional[datetime] = None) -> List[str]:
+        """
+        Makes sure the transactions table has a partition for the current day / week & the given number of future
+        partitions, so new transactions never wait for a partition to be created.
+        Does nothing if the transactions table is not partitioned (databases created before it was partitioned).
+        :param interval: The time range of transactions stored in every partition
+        :param premake: The number of future partitions to create ahead of time
+        :param now: The current time (used for tests & backfills)
+        :return: The names of the created partitions
+        """
+
+        now = now or datetime.now()
+        with self.__engine.begin() as connection:
+            if not partitions.is_table_partitioned(connection):
+                logger.warning('The transactions table is not partitioned, skipping partition maintenance')
+                return []
+
+            partitions.create_default_partition(connection)
+
+            missing_partition_starts = partitions.get_missing_partition_starts(
+                partitions=partitions.list_partitions(connection), now=now, interval=interval, premake=premake)
+            created_partitions = [partitions.create_partition(connection, start=start, interval=interval)
+                                  for start in missing_partition_starts]
+
+        for partition in created_partitions:
+            logger.info('Created transactions partition', partition=partition.name,
+                        start=partition.start, end=partition.end)
+
+        return [partition.name for partition in created_partitions]
+
+    def archive_transaction_partitions(self,
+                                       retention: timedelta,
+                                       archive_dir: str,
+                                       now: Optional[datetime] = None,
+                                       chunk_size: int = 1000) -> List[str]:
+        """
+        Moves the partitions holding only transactions older than the retention period to cold storage: every partition
+        is exported to a compressed file in the archive directory, & only then detached from the transactions table &
+        dropped. Partitions are archived one by one, so a failure leaves the rest of the partitions untouched.
+        Only a single instance archives the partitions at a time (others skip archiving while the lock is held).
+        :param retention: How long transactions are kept in the database
+        :param archive_dir: The directory the archive files are written to
+        :param now: The current time (used for tests)
+        :param chunk_size: The number of transactions fetched from the database at a time
+        :return: The paths of the archive files
+        """
+
+        # A session lock, held on its own connection while the partitions are archived one by one
+        with self.__engine.connect() as lock_connection:
+            if not partitions.try_lock_archiving(lock_connection):
+                logger.info('The partitions are being archived by another instance, skipping partitions archival')
+                return []
+            # The session lock outlives the database transaction, which is not left open while archiving
+            lock_connection.commit()
+
+            try:
+                return self._archive_transaction_partitions(retention=retention, archive_dir=archive_dir,
+                                                            now=now or datetime.now(), chunk_size=chunk_size)
+            finally:
+                partitions.unlock_archiving(lock_connection)
+
+    def _archive_transaction_partitions(self,
+                                        retention: timedelta,
+                                        archive_dir: str,
+                                        now: datetime,
+                                        chunk_size: int) -> List[str]:
+        """Archives the partitions older than the retention period, while holding the archiving lock"""
+
+        with self.__engine.connect() as connection:
+            if not partitions.is_table_partitioned(connection):
+                logger.warning('The transactions table is not partitioned, skipping partitions archival')
+                return []
+            partitions_to_archive = partitions.get_partitions_to_archive(
+                partitions=partitions.list_partitions(connection), now=now, retention=retention)
+
+        os.makedirs(archive_dir, exist_ok=True)
+
+        archive_paths = []
+        for partition in partitions_to_archive:
+            with self.__engine.connect() as connection:
+                archive_path = partitions.export_partition(connection, partition=partition,
+                                                           archive_dir=archive_dir, chunk_size=chunk_size)
+
+            with self.__engine.begin() as connection:
+                partitions.detach_partition(connection, partition=partition)
+                partitions.drop_detached_partition(connection, partition=partition)
+
+            logger.info('Archived transactions partition', partition=partition.name, archive_path=archive_path)
+            archive_paths.append(archive_path)
+
+        return archive_paths
+
+    def delete_expired_idempotency_keys(self, retention: timedelta, now: Optional[datetime] = None) -> int:
+        """
+        Deletes the idempotency keys older than the retention period, so the keys table does not grow forever.
+        Requests retried with a deleted key are performed again.
+        :param retention: How long idempotency keys are kept
+        :param now: The current time (used for tests)
+        :return: The number of deleted keys
+        """
+
+        now = now or datetime.now()
+        with self._get_session() as session:
+            deleted_count = session.execute(
+                delete(sqlalchemy_models.IdempotencyKey)
+                .where(sqlalchemy_models.IdempotencyKey.created_at < now - retention)).rowcount
+            session.commit()
+
+        logger.info('Deleted expired idempotency keys', deleted_count=deleted_count)
+        return deleted_count
+
+    def refresh_transaction_rollups(self, lag: timedelta, now: Optional[datetime] = None) -> Optional[datetime]:
+        """
+        Rolls up the transactions from the rollups watermark until `lag` before now, & moves the watermark forward.
+        Every range is rolled up in the same database transaction as the watermark update, so transactions are rolled
+        up exactly once. A big backlog (for example after the job was down) is rolled up one day at a time.
+        :param lag: How long after their timestamp transactions are rolled up. Must be longer than the time it takes to
+            commit a transaction, since transactions that commit after their minute was rolled up are not counted
+        :param now: The current time (used for tests)
+        :return: The new watermark, or None if there are no transactions yet
+        """
+
+        rollups_end = rollups.floor_to_bucket((now or datetime.now()) - lag)
+        while True:
+            with self.__engine.begin() as connection:
+                watermark = rollups.lock_watermark(connection)
+                if watermark is None:
+                    earliest_timestamp = rollups.get_earliest_transaction_timestamp(connection)
+                    watermark = rollups.floor_to_bucket(earliest_timestamp) if earliest_timestamp else rollups_end
+
+                range_end = min(rollups_end, watermark + MAX_ROLLUP_RANGE)
+                if range_end <= watermark:
+                    return watermark
+
+                rollup_rows = rollups.roll_up_transactions(connection, start=watermark, end=range_end)
+                rollups.set_watermark(connection, rolled_up_until=range_end)
+
+            logger.debug('Rolled up transactions', start=watermark, end=range_end, rollup_rows=rollup_rows)
+            if range_end >= rollups_end:
+                return range_end
+
+    def get_transactions_summary(self,
+                                 start_timestamp: datetime,
+                                 end_timestamp: datetime) -> List[dal_models.DalTransactionsSummaryGroup]:
+        """
+        Sums up the transactions in the given time range by (status, direction, failure category).
+        The whole minutes that were already rolled up are read from the rollups, & only the rest of the range
+        (the edges of the range & the last few minutes) is aggregated from the transactions table, so the summary of any
+        time range is fast.
+        :param start_timestamp: The earliest timestamp of transaction to include.
+        :param end_timestamp: The latest timestamp of transaction to include (not included).
+        :return: The totals of every (status, direction, failure category) group
+        """
+
+        with self.__engine.connect() as connection:
+            rollups_range, transactions_ranges = rollups.get_summary_ranges(
+                start=start_timestamp, end=end_timestamp, watermark=rollups.get_watermark(connection))
+
+            statements = [rollups.summarize_transactions_statement(start=start, end=end)
+                          for start, end in transactions_ranges]
+            if rollups_range:
+                statements.append(rollups.summarize_rollups_statement(start=rollups_range[0], end=rollups_range[1]))
+
+            groups: Dict[Tuple[str, str, str], dal_models.DalTransactionsSummaryGroup] = {}
+            for statement in statements:
+                for row in connection.execute(statement):
+                    group = groups.setdefault((row.status, row.direction, row.reason),
+                                              dal_models.DalTransactionsSummaryGroup(status=row.status,
+                                                                                     direction=row.direction,
+                                                                                     reason=row.reason))
+                    group.transactions_count += row.transactions_count
+                    group.amount_sum += row.amount_sum or 0
 
-            # Count the total number of matching transactions without pagination
-            total_amount_of_transactions = all_matching_transactions_query.count()
-            return all_transactions, total_amount_of_transactions
+        return list(groups.values())
@@ -20,6 +20,21 @@ class DalTransactionStatus(str, Enum):
     fail = 'fail'
 
 
+class DalFailureCategory(str, Enum):
+    """The category of the failure reason of a failed transaction, which the transactions summary is grouped by"""
+    insufficient_funds = 'insufficient_funds'
+    account_not_found = 'account_not_found'
+    same_account = 'same_account'
+    unexpected_error = 'unexpected_error'
+    other = 'other'
+
+
+class DalPartitionInterval(str, Enum):
+    """The time range of transactions stored in every partition of the transactions table"""
+    daily = 'daily'
+    weekly = 'weekly'
+
+
 class DalTransaction(BaseModel):
     transaction_id: str = Field(alias="id")
     src_account_id: str
@@ -29,6 +44,48 @@ class DalTransaction(BaseModel):
     direction: DalTransactionDirection
     status: DalTransactionStatus
     reason: Optional[str]
+    description: Optional[str]
+    # The number of attempts it took to move the funds (conflicts with concurrent transfers are retried). Not stored,
+    # only set on the transactions performed by the current request
+    transfer_attempts: Optional[int] = None
 
     class Config:
         orm_mode = True
+
+
+# The fields of a DalTransaction that are not a part of the transaction record, left out when it is stored or exported
+TRANSACTION_REQUEST_FIELDS = {'transfer_attempts'}
+
+
+class DalTransferRequest(BaseModel):
+    """A single money transfer in a batch of transfers"""
+    src_account_id: str
+    dst_account_id: str
+    amount: PositiveFloat
+    direction: DalTransactionDirection
+
+
+class DalBankTransferRequest(BaseModel):
+    """A single bank transaction in a batch of bank transactions (see Dal.perform_bank_transaction)"""
+    account_id: str
+    amount: PositiveFloat
+    # debit - take the money from the account, credit - give the money to the account
+    direction: DalTransactionDirection
+    description: Optional[str] = None
+    idempotency_key: Optional[str] = None
+
+
+class DalAccountBalance(BaseModel):
+    """The balance of a bank account, including the balance of its stripes"""
+    account_id: str
+    balance: float
+
+
+class DalTransactionsSummaryGroup(BaseModel):
+    """The totals of the transactions with the same status, direction & failure category in a time range"""
+    status: DalTransactionStatus
+    direction: DalTransactionDirection
+    # The failure category (see DalFailureCategory), empty for successful transactions
+    reason: str
+    transactions_count: int = 0
+    amount_sum: float = 0
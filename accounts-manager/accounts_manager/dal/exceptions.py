@@ -0,0 +1,6 @@
+class IdempotencyKeyReusedError(ValueError):
+    """Raised when an idempotency key that was already used is sent with a different request"""
+
+    def __init__(self, idempotency_key: str):
+        super().__init__(f'The idempotency key {idempotency_key} was already used for a different request')
+        self.idempotency_key = idempotency_key
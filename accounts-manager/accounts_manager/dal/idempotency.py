@@ -0,0 +1,64 @@
+"""
+Idempotency keys of requests that create transactions, shared by the sync & async DAL implementations
+"""
+
+from datetime import datetime
+import hashlib
+from typing import Any, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from dal import dal_models
+from dal.cache import TTLCache
+from dal.exceptions import IdempotencyKeyReusedError
+from dal.sqlalchemy import models as sqlalchemy_models
+from dal.sqlalchemy.errors import get_sqlstate
+
+# Postgres error code of a unique constraint violation
+UNIQUE_VIOLATION_SQLSTATE = '23505'
+
+# (request fingerprint, resulting transaction) of an idempotency key
+StoredResponse = Tuple[str, dal_models.DalTransaction]
+
+
+def get_request_fingerprint(*request_parameters: Any) -> str:
+    """Hashes the parameters of a request, to tell if an idempotency key is reused for a different request"""
+    return hashlib.sha256('|'.join(str(parameter) for parameter in request_parameters).encode()).hexdigest()
+
+
+def build_idempotency_key(idempotency_key: str,
+                          request_fingerprint: str,
+                          dal_transaction: dal_models.DalTransaction,
+                          created_at: datetime) -> sqlalchemy_models.IdempotencyKey:
+    response = dal_transaction.json(by_alias=True, exclude=dal_models.TRANSACTION_REQUEST_FIELDS)
+    return sqlalchemy_models.IdempotencyKey(key=idempotency_key,
+                                            request_fingerprint=request_fingerprint,
+                                            response=response,
+                                            created_at=created_at)
+
+
+def to_stored_response(idempotency_key: Optional[sqlalchemy_models.IdempotencyKey]) -> Optional[StoredResponse]:
+    if idempotency_key is None:
+        return None
+    return idempotency_key.request_fingerprint, dal_models.DalTransaction.parse_raw(idempotency_key.response)
+
+
+def check_stored_response(idempotency_key: str,
+                          request_fingerprint: str,
+                          stored_response: StoredResponse,
+                          cache: TTLCache[StoredResponse]) -> dal_models.DalTransaction:
+    """
+    Returns the stored transaction of the idempotency key (& caches it)
+    :raises IdempotencyKeyReusedError: If the key was used for a different request
+    """
+    stored_fingerprint, dal_transaction = stored_response
+    if stored_fingerprint != request_fingerprint:
+        raise IdempotencyKeyReusedError(idempotency_key)
+
+    cache.set(idempotency_key, stored_response)
+    return dal_transaction
+
+
+def is_duplicate_key_error(e: IntegrityError) -> bool:
+    """Checks if the error was raised because a concurrent request stored the same idempotency key first"""
+    return get_sqlstate(e) == UNIQUE_VIOLATION_SQLSTATE
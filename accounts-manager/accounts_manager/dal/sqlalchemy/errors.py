@@ -0,0 +1,26 @@
+from typing import Optional
+
+from sqlalchemy.exc import DBAPIError
+
+# Postgres error codes of failures caused by concurrent transactions, which are safe to retry
+# 40001 - serialization_failure, 40P01 - deadlock_detected
+RETRYABLE_SQLSTATES = {'40001', '40P01'}
+
+
+def get_sqlstate(e: DBAPIError) -> Optional[str]:
+    """Extracts the postgres error code (SQLSTATE) out of a database error, regardless of the driver used"""
+    for attribute in ('sqlstate', 'pgcode'):
+        sqlstate = getattr(e.orig, attribute, None)
+        if sqlstate:
+            return sqlstate
+
+    # pg8000 passes the error fields sent by the server as a dict, where the "C" field is the error code
+    if e.orig is not None and e.orig.args and isinstance(e.orig.args[0], dict):
+        return e.orig.args[0].get('C')
+
+    return None
+
+
+def is_retryable_db_error(e: DBAPIError) -> bool:
+    """Checks if the database error was caused by a conflict with a concurrent transaction"""
+    return get_sqlstate(e) in RETRYABLE_SQLSTATES
@@ -0,0 +1,95 @@
+import re
+import time
+from functools import lru_cache
+from typing import Dict, Iterator
+
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from sqlalchemy import event, Engine
+from sqlalchemy.pool import QueuePool
+
+# The table a statement works on: the first table it reads from, inserts into or updates
+STATEMENT_TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(?P<table>[\w.]+)"?', re.IGNORECASE)
+# The date suffix of the transactions partitions (for example: transaction_p20230711, see partitions.py), so all the
+# partitions of a table are reported under the name of the table
+PARTITION_SUFFIX_PATTERN = re.compile(r'_p\d+$')
+
+STATEMENT_DURATION = Histogram('db_statement_duration_seconds',
+                               'The time it took the database to run a statement',
+                               ['engine', 'statement'],
+                               buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+
+@lru_cache(maxsize=1024)
+def get_statement_name(statement: str) -> str:
+    """
+    Returns a low cardinality name of the given SQL statement: its verb & the table it works on (for example:
+    "SELECT bank_account"). The name is cached, as the engine runs the same statements again & again
+    """
+    words = statement.split(None, 1)
+    if not words:
+        return 'UNKNOWN'
+
+    verb = words[0].upper()
+    match = STATEMENT_TABLE_PATTERN.search(statement)
+    if not match:
+        return verb
+
+    return f'{verb} {PARTITION_SUFFIX_PATTERN.sub("", match.group("table"))}'
+
+
+class PoolStatsCollector(Collector):
+    """Reports the usage of the connection pools of the instrumented engines, read when the metrics are collected"""
+
+    def __init__(self):
+        self.engines: Dict[str, Engine] = {}
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        checked_out = GaugeMetricFamily('db_pool_checked_out_connections',
+                                        'The number of connections currently in use', labels=['engine'])
+        overflow = GaugeMetricFamily('db_pool_overflow_connections',
+                                     'The number of connections opened on top of the pool size (negative while the '
+                                     'pool is not full)', labels=['engine'])
+        size = GaugeMetricFamily('db_pool_size', 'The number of connections kept open in the pool', labels=['engine'])
+
+        for engine_name, engine in self.engines.items():
+            pool = engine.pool
+            # Only queue pools (the pools of the service engines) keep track of their usage
+            if not isinstance(pool, QueuePool):
+                continue
+
+            checked_out.add_metric([engine_name], pool.checkedout())
+            overflow.add_metric([engine_name], pool.overflow())
+            size.add_metric([engine_name], pool.size())
+
+        yield checked_out
+        yield overflow
+        yield size
+
+
+pool_stats_collector = PoolStatsCollector()
+REGISTRY.register(pool_stats_collector)
+
+
+def instrument_engine(engine: Engine, engine_name: str) -> None:
+    """
+    Reports the duration of the statements run by the engine (by statement name), & the usage of its connection pool
+    :param engine: The engine to instrument (the sync engine of async engines)
+    :param engine_name: The name the metrics of the engine are reported under. An engine replaces a previously
+        instrumented engine of the same name in the pool metrics
+    """
+    pool_stats_collector.engines[engine_name] = engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def on_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.statement_start_time = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def on_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start_time = getattr(context, 'statement_start_time', None)
+        if start_time is None:
+            return
+
+        STATEMENT_DURATION.labels(engine=engine_name, statement=get_statement_name(statement)).observe(
+            time.perf_counter() - start_time)
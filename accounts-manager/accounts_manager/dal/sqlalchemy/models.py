@@ -1,7 +1,8 @@
 from datetime import datetime
+from typing import Optional
 
-from sqlalchemy import ForeignKey, CheckConstraint
-from sqlalchemy import String, Float, DateTime
+from sqlalchemy import ForeignKey, CheckConstraint, Index, PrimaryKeyConstraint
+from sqlalchemy import String, Float, DateTime, Integer, BigInteger
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
@@ -16,25 +17,63 @@ class BankAccount(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     owner_name: Mapped[str] = mapped_column(String)
     balance: Mapped[float] = mapped_column(Float)
+    # The number of stripes the balance of a hot account is split across (see BankAccountStripe).
+    # 0 means the whole balance is kept in this row
+    stripes: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
 
     __table_args__ = (
         CheckConstraint(balance >= 0, name='check_balance_not_negative'),
         {})
 
     def __repr__(self) -> str:
-        return f"BankAccount(id={self.id!r}, owner_name={self.owner_name!r}, balance={self.balance!r})"
+        return f"BankAccount(id={self.id!r}, owner_name={self.owner_name!r}, balance={self.balance!r}, " \
+               f"stripes={self.stripes!r})"
+
+
+class BankAccountStripe(Base):
+    """
+    A part of the balance of a hot account (an account that takes part in many concurrent transactions, like the bank
+    account). Every transaction locks a single random stripe instead of the account row, so concurrent transactions do
+    not wait for each other. The balance of a striped account is the sum of its stripes & its own balance.
+    """
+    __tablename__ = "bank_account_stripe"
+    account_id: Mapped[int] = mapped_column(ForeignKey("bank_account.id"))
+    stripe_number: Mapped[int] = mapped_column(Integer)
+    balance: Mapped[float] = mapped_column(Float)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(account_id, stripe_number),
+        CheckConstraint(balance >= 0, name='check_stripe_balance_not_negative'),
+        {})
+
+    def __repr__(self) -> str:
+        return f"BankAccountStripe(account_id={self.account_id!r}, " \
+               f"stripe_number={self.stripe_number!r}, " \
+               f"balance={self.balance!r})"
 
 
 class Transaction(Base):
     __tablename__ = "transaction"
-    id: Mapped[int] = mapped_column(primary_key=True)
-    timestamp: Mapped[datetime] = mapped_column(DateTime)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # The table is partitioned by the timestamp, so it must be a part of the primary key
+    timestamp: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
     src_account_id: Mapped[int] = mapped_column(ForeignKey("bank_account.id"))
     dst_account_id: Mapped[int] = mapped_column(ForeignKey("bank_account.id"))
     amount: Mapped[float] = mapped_column(Float)
     direction: Mapped[str] = mapped_column(String)
     status: Mapped[str] = mapped_column(String)
     reason: Mapped[str] = mapped_column(String)
+    # Why the transaction happened (for example: "Advance payment week 3"), used by bank transactions for tracking
+    description: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+
+    __table_args__ = (
+        # Serves the transactions report, which is paginated by (timestamp, id)
+        Index('ix_transaction_timestamp_id', timestamp, id),
+        # Serve the history of a single account (as either side of the transaction), & the foreign key checks
+        Index('ix_transaction_src_account_id_timestamp', src_account_id, timestamp),
+        Index('ix_transaction_dst_account_id_timestamp', dst_account_id, timestamp),
+        # Every partition holds the transactions of a single day / week (see dal/sqlalchemy/partitions.py)
+        {'postgresql_partition_by': 'RANGE (timestamp)'})
 
     def __repr__(self) -> str:
         return f"Transaction(id={self.id!r}, " \
@@ -44,3 +83,58 @@ class Transaction(Base):
                f"amount={self.status!r}, " \
                f"status={self.status!r}, " \
                f"reason={self.reason!r})"
+
+
+class IdempotencyKey(Base):
+    """
+    A key sent by a client with a request, so retries of the request return the original result instead of performing
+    the request again. Written in the same database transaction as the Transaction it belongs to.
+    """
+    __tablename__ = "idempotency_key"
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    # A hash of the request parameters, so a key can not be reused for a different request
+    request_fingerprint: Mapped[str] = mapped_column(String)
+    # The resulting Transaction (as JSON), so replays do not read the (partitioned & archived) transactions table
+    response: Mapped[str] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(DateTime, index=True)
+
+    def __repr__(self) -> str:
+        return f"IdempotencyKey(key={self.key!r}, created_at={self.created_at!r})"
+
+
+class TransactionRollup(Base):
+    """
+    The totals of the transactions of a single minute, by status, direction & failure category.
+    Rollups are appended by a background job (see dal/sqlalchemy/rollups.py), so summaries of long time ranges do not
+    scan the transactions table. Rollups are kept after the transactions are archived.
+    """
+    __tablename__ = "transaction_rollup"
+    bucket_start: Mapped[datetime] = mapped_column(DateTime)
+    status: Mapped[str] = mapped_column(String)
+    direction: Mapped[str] = mapped_column(String)
+    # The failure category of failed transactions (see DalFailureCategory), empty for successful transactions. A small
+    # fixed set, as the failure reasons hold account IDs & error messages
+    reason: Mapped[str] = mapped_column(String)
+    transactions_count: Mapped[int] = mapped_column(BigInteger)
+    amount_sum: Mapped[float] = mapped_column(Float)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(bucket_start, status, direction, reason),
+        {})
+
+    def __repr__(self) -> str:
+        return f"TransactionRollup(bucket_start={self.bucket_start!r}, " \
+               f"status={self.status!r}, " \
+               f"direction={self.direction!r}, " \
+               f"transactions_count={self.transactions_count!r})"
+
+
+class TransactionRollupWatermark(Base):
+    """A single row holding the timestamp up to which (not included) the transactions were rolled up"""
+    __tablename__ = "transaction_rollup_watermark"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    # Null until the first transactions are rolled up
+    rolled_up_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self) -> str:
+        return f"TransactionRollupWatermark(rolled_up_until={self.rolled_up_until!r})"
@@ -0,0 +1,215 @@
+"""
+Management of the partitions of the transactions table.
+The transactions table is range partitioned by timestamp, where every partition holds a single day / week of
+transactions. Partitions are created ahead of time, & old partitions are detached from the table & archived, so the
+table only holds the recent (hot) transactions.
+"""
+
+import csv
+from datetime import datetime, timedelta
+import gzip
+import os
+import re
+from typing import List
+
+from pydantic import BaseModel
+from sqlalchemy import Connection, text
+import structlog
+
+from dal.dal_models import DalPartitionInterval
+from dal.sqlalchemy import models as sqlalchemy_models
+
+logger = structlog.get_logger()
+
+TRANSACTIONS_TABLE = sqlalchemy_models.Transaction.__tablename__
+DEFAULT_PARTITION_NAME = f'{TRANSACTIONS_TABLE}_default'
+# The key of the advisory lock held while archiving partitions, so only a single instance archives them at a time
+ARCHIVE_LOCK_ID = 7411230001
+
+# Matches the bounds of a range partition, for example:
+# FOR VALUES FROM ('2023-07-11 00:00:00') TO ('2023-07-12 00:00:00')
+PARTITION_BOUNDS_PATTERN = re.compile(r"FOR VALUES FROM \('(?P<start>[^']+)'\) TO \('(?P<end>[^']+)'\)")
+
+
+class TransactionsPartition(BaseModel):
+    name: str
+    # The partition holds the transactions from the start timestamp (included) to the end timestamp (not included)
+    start: datetime
+    end: datetime
+
+
+def get_partition_start(moment: datetime, interval: DalPartitionInterval) -> datetime:
+    """Returns the start of the partition that holds the given moment (the start of the day / week)"""
+    day_start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == DalPartitionInterval.weekly:
+        return day_start - timedelta(days=day_start.weekday())
+    return day_start
+
+
+def get_partition_length(interval: DalPartitionInterval) -> timedelta:
+    return timedelta(weeks=1) if interval == DalPartitionInterval.weekly else timedelta(days=1)
+
+
+def is_table_partitioned(connection: Connection) -> bool:
+    """
+    Checks if the transactions table is partitioned. Databases created before the table was partitioned keep their
+    plain table, which has to be migrated manually.
+    """
+    return connection.scalar(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = :table_name)"
+    ).bindparams(table_name=TRANSACTIONS_TABLE))
+
+
+def list_partitions(connection: Connection) -> List[TransactionsPartition]:
+    """Lists the range partitions attached to the transactions table (without the default partition), oldest first"""
+    rows = connection.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table_name"
+    ).bindparams(table_name=TRANSACTIONS_TABLE)).all()
+
+    partitions = []
+    for name, bounds in rows:
+        match = PARTITION_BOUNDS_PATTERN.search(bounds or '')
+        if match:
+            partitions.append(TransactionsPartition(name=name,
+                                                    start=datetime.fromisoformat(match['start']),
+                                                    end=datetime.fromisoformat(match['end'])))
+
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def create_default_partition(connection: Connection) -> None:
+    """
+    Creates the partition that holds transactions that do not belong to any other partition (if it does not exist),
+    so inserting a transaction never fails because its partition was not created in time
+    """
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION_NAME}" '
+                            f'PARTITION OF "{TRANSACTIONS_TABLE}" DEFAULT'))
+
+
+def create_partition(connection: Connection, start: datetime, interval: DalPartitionInterval) -> TransactionsPartition:
+    """
+    Creates the partition that starts at the given timestamp. Transactions of its time range that were inserted into
+    the default partition (as the partition was not created in time) would make creating the partition fail, so they are
+    moved into the new partition, in the same database transaction
+    """
+    partition = TransactionsPartition(name=f'{TRANSACTIONS_TABLE}_p{start:%Y%m%d}',
+                                      start=start,
+                                      end=start + get_partition_length(interval))
+    has_default_rows = move_default_partition_rows_out(connection, partition=partition)
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS "{partition.name}" PARTITION OF "{TRANSACTIONS_TABLE}" '
+                            f"FOR VALUES FROM ('{partition.start.isoformat(sep=' ')}') "
+                            f"TO ('{partition.end.isoformat(sep=' ')}')"))
+    if has_default_rows:
+        # Routed into the new partition
+        connection.execute(text(f'INSERT INTO "{TRANSACTIONS_TABLE}" SELECT * FROM "{partition.name}_moved"'))
+    return partition
+
+
+def move_default_partition_rows_out(connection: Connection, partition: TransactionsPartition) -> bool:
+    """
+    Moves the transactions of the partition time range out of the default partition, into a temporary table named after
+    the partition (dropped on commit). The transactions table is locked until the end of the database transaction (as
+    creating the partition does anyway), so no transactions of the range are inserted into the default partition until
+    the partition is created.
+    :return: True if any transactions were moved
+    """
+    connection.execute(text(f'LOCK TABLE "{TRANSACTIONS_TABLE}" IN ACCESS EXCLUSIVE MODE'))
+
+    range_condition = 'timestamp >= :start AND timestamp < :end'
+    has_default_rows = connection.scalar(text(
+        f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT_PARTITION_NAME}" WHERE {range_condition})'
+    ).bindparams(start=partition.start, end=partition.end))
+    if not has_default_rows:
+        return False
+
+    connection.execute(text(f'CREATE TEMPORARY TABLE "{partition.name}_moved" (LIKE "{TRANSACTIONS_TABLE}") '
+                            f'ON COMMIT DROP'))
+    moved_count = connection.execute(text(
+        f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION_NAME}" WHERE {range_condition} RETURNING *) '
+        f'INSERT INTO "{partition.name}_moved" SELECT * FROM moved'
+    ).bindparams(start=partition.start, end=partition.end)).rowcount
+    logger.warning('Moving transactions out of the default partition', partition=partition.name,
+                   moved_count=moved_count)
+    return True
+
+
+def try_lock_archiving(connection: Connection) -> bool:
+    """
+    Takes the archiving advisory lock for the connection (session), unless another instance holds it.
+    The lock is not released with the database transaction, so it must be released with unlock_archiving
+    :return: True if the lock was taken
+    """
+    return connection.scalar(text('SELECT pg_try_advisory_lock(:lock_id)').bindparams(lock_id=ARCHIVE_LOCK_ID))
+
+
+def unlock_archiving(connection: Connection) -> None:
+    connection.scalar(text('SELECT pg_advisory_unlock(:lock_id)').bindparams(lock_id=ARCHIVE_LOCK_ID))
+
+
+def detach_partition(connection: Connection, partition: TransactionsPartition) -> None:
+    """Detaches the partition from the transactions table, so it is no longer a part of the table (or its queries)"""
+    connection.execute(text(f'ALTER TABLE "{TRANSACTIONS_TABLE}" DETACH PARTITION "{partition.name}"'))
+
+
+def drop_detached_partition(connection: Connection, partition: TransactionsPartition) -> None:
+    connection.execute(text(f'DROP TABLE IF EXISTS "{partition.name}"'))
+
+
+def export_partition(connection: Connection,
+                     partition: TransactionsPartition,
+                     archive_dir: str,
+                     chunk_size: int = 1000) -> str:
+    """
+    Exports all the transactions of the partition into a gzip compressed CSV file in the archive directory.
+    The transactions are streamed from a server side cursor, & the file is written under a temporary name & renamed
+    only when it is complete, so a failed export never leaves a partial archive behind.
+    :return: The path of the archive file
+    """
+    archive_path = os.path.join(archive_dir, f'{partition.name}.csv.gz')
+    temporary_path = f'{archive_path}.tmp'
+
+    result = connection.execution_options(stream_results=True, yield_per=chunk_size)\
+        .execute(text(f'SELECT * FROM "{partition.name}" ORDER BY timestamp, id'))
+
+    with gzip.open(temporary_path, 'wt', newline='') as archive_file:
+        writer = csv.writer(archive_file)
+        writer.writerow(result.keys())
+        for rows in result.partitions():
+            writer.writerows(rows)
+
+    os.replace(temporary_path, archive_path)
+    return archive_path
+
+
+def get_missing_partition_starts(partitions: List[TransactionsPartition],
+                                 now: datetime,
+                                 interval: DalPartitionInterval,
+                                 premake: int) -> List[datetime]:
+    """
+    Returns the starts of the partitions that should exist but do not: the current partition & the given number of
+    future partitions. Time ranges that are already covered by an existing partition are skipped (for example when the
+    partition interval was changed).
+    """
+    current_start = get_partition_start(now, interval)
+    length = get_partition_length(interval)
+
+    missing_starts = []
+    for partition_index in range(premake + 1):
+        start = current_start + length * partition_index
+        end = start + length
+        overlaps_existing_partition = any(partition.start < end and start < partition.end for partition in partitions)
+        if not overlaps_existing_partition:
+            missing_starts.append(start)
+
+    return missing_starts
+
+
+def get_partitions_to_archive(partitions: List[TransactionsPartition],
+                              now: datetime,
+                              retention: timedelta) -> List[TransactionsPartition]:
+    """Returns the partitions that only hold transactions older than the retention period"""
+    archive_before = now - retention
+    return [partition for partition in partitions if partition.end <= archive_before]
@@ -0,0 +1,170 @@
+"""
+Incremental rollups of the transactions table.
+Every rollup row holds the totals of a single minute of transactions by (status, direction, failure category). The
+failure reasons hold account IDs & error messages, so they are grouped into a small fixed set of categories, which keeps
+the number of rollup rows of a minute bounded. A background job
+rolls up the transactions between the watermark & a moment shortly before now (transactions are committed a bit after
+their timestamp, so the most recent minutes are still changing), & moves the watermark forward in the same database
+transaction. Summaries read the rollups for the rolled up range, & aggregate the transactions table only for the parts
+of the range that were not rolled up (the edges of the range & the time after the watermark).
+"""
+
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Connection, Select, ColumnElement, select, func, case
+from sqlalchemy.dialects.postgresql import insert
+
+from dal.dal_models import DalFailureCategory, DalTransactionStatus
+from dal.sqlalchemy import models as sqlalchemy_models
+
+ROLLUP_BUCKET_LENGTH = timedelta(minutes=1)
+WATERMARK_ID = 1
+
+# (start, end) of a time range, the start is included & the end is not
+TimeRange = Tuple[datetime, datetime]
+
+# The failure reasons of every failure category (LIKE patterns, see dal/transfers.py & dal/dal.py), in match order
+FAILURE_CATEGORY_PATTERNS = [
+    (DalFailureCategory.insufficient_funds, '%Insufficient funds%'),
+    (DalFailureCategory.account_not_found, '%does not exist%'),
+    (DalFailureCategory.same_account, '%must be different accounts%'),
+    (DalFailureCategory.same_account, '%can not make a transaction with itself%'),
+    (DalFailureCategory.unexpected_error, 'Money transfer failed due to an unexpected error%'),
+]
+
+
+def to_database_time(moment: datetime) -> datetime:
+    """
+    The transactions timestamps (& the watermark) are naive local times, so time zone aware moments are converted to
+    naive local times before they are compared with them
+    """
+    return moment.astimezone().replace(tzinfo=None) if moment.tzinfo else moment
+
+
+def failure_category(status: ColumnElement, reason: ColumnElement) -> ColumnElement:
+    """
+    The failure category of a transaction (empty for successful transactions). Categories are kept as they are, so the
+    rollups written before the reasons were categorized are categorized when they are summed up
+    """
+    return case(
+        (status != DalTransactionStatus.fail.value, ''),
+        (reason.in_([category.value for category in DalFailureCategory]), reason),
+        *[(reason.like(pattern), category.value) for category, pattern in FAILURE_CATEGORY_PATTERNS],
+        else_=DalFailureCategory.other.value)
+
+
+def floor_to_bucket(moment: datetime) -> datetime:
+    """Returns the start of the rollup bucket holding the given moment"""
+    return moment.replace(second=0, microsecond=0)
+
+
+def ceil_to_bucket(moment: datetime) -> datetime:
+    """Returns the start of the first rollup bucket that starts at the given moment or after it"""
+    bucket_start = floor_to_bucket(moment)
+    return bucket_start if bucket_start == moment else bucket_start + ROLLUP_BUCKET_LENGTH
+
+
+def lock_watermark(connection: Connection) -> Optional[datetime]:
+    """
+    Locks the watermark row until the end of the database transaction (so concurrent jobs of other API instances do not
+    roll up the same transactions twice) & returns it. Returns None if nothing was rolled up yet.
+    """
+    watermark = sqlalchemy_models.TransactionRollupWatermark
+    connection.execute(insert(watermark)
+                       .values(id=WATERMARK_ID, rolled_up_until=None)
+                       .on_conflict_do_nothing(index_elements=[watermark.id]))
+    return connection.scalar(select(watermark.rolled_up_until)
+                             .where(watermark.id == WATERMARK_ID)
+                             .with_for_update())
+
+
+def get_watermark(connection: Connection) -> Optional[datetime]:
+    """Returns the timestamp up to which the transactions were rolled up, or None if nothing was rolled up yet"""
+    watermark = sqlalchemy_models.TransactionRollupWatermark
+    return connection.scalar(select(watermark.rolled_up_until).where(watermark.id == WATERMARK_ID))
+
+
+def set_watermark(connection: Connection, rolled_up_until: datetime) -> None:
+    watermark = sqlalchemy_models.TransactionRollupWatermark
+    connection.execute(watermark.__table__.update()
+                       .where(watermark.id == WATERMARK_ID)
+                       .values(rolled_up_until=rolled_up_until))
+
+
+def get_earliest_transaction_timestamp(connection: Connection) -> Optional[datetime]:
+    return connection.scalar(select(func.min(sqlalchemy_models.Transaction.timestamp)))
+
+
+def roll_up_transactions(connection: Connection, start: datetime, end: datetime) -> int:
+    """
+    Adds the totals of the transactions in the given time range (bucket aligned) to the rollups.
+    :return: The number of rollup rows written
+    """
+    transaction = sqlalchemy_models.Transaction
+    rollup = sqlalchemy_models.TransactionRollup
+    bucket_start = func.date_trunc('minute', transaction.timestamp)
+    reason = failure_category(transaction.status, func.coalesce(transaction.reason, ''))
+
+    totals = select(bucket_start, transaction.status, transaction.direction, reason,
+                    func.count(), func.sum(transaction.amount))\
+        .where(transaction.timestamp >= start, transaction.timestamp < end)\
+        .group_by(bucket_start, transaction.status, transaction.direction, reason)
+
+    statement = insert(rollup).from_select(
+        [rollup.bucket_start, rollup.status, rollup.direction, rollup.reason, rollup.transactions_count,
+         rollup.amount_sum],
+        totals)
+    # The watermark makes every range rolled up once, but rows are added to (& not replaced) just in case
+    statement = statement.on_conflict_do_update(
+        index_elements=[rollup.bucket_start, rollup.status, rollup.direction, rollup.reason],
+        set_={'transactions_count': rollup.transactions_count + statement.excluded.transactions_count,
+              'amount_sum': rollup.amount_sum + statement.excluded.amount_sum})
+
+    return connection.execute(statement).rowcount
+
+
+def get_summary_ranges(start: datetime,
+                       end: datetime,
+                       watermark: Optional[datetime]) -> Tuple[Optional[TimeRange], List[TimeRange]]:
+    """
+    Splits the time range of a summary into the range answered by the rollups (whole buckets before the watermark), &
+    the ranges that have to be aggregated from the transactions table.
+    :return: (rollups_range, transactions_ranges) The rollups range is None if no part of the range was rolled up.
+        The ranges are in naive local time, like the transactions timestamps
+    """
+    start, end = to_database_time(start), to_database_time(end)
+    rollups_start = ceil_to_bucket(start)
+    rollups_end = min(floor_to_bucket(end), watermark) if watermark else rollups_start
+    if rollups_end <= rollups_start:
+        return None, [(start, end)]
+
+    transactions_ranges = [(range_start, range_end)
+                           for range_start, range_end in ((start, rollups_start), (rollups_end, end))
+                           if range_start < range_end]
+    return (rollups_start, rollups_end), transactions_ranges
+
+
+def summarize_rollups_statement(start: datetime, end: datetime) -> Select:
+    """Totals of the rollups in the given range by (status, direction, failure category)"""
+    rollup = sqlalchemy_models.TransactionRollup
+    reason = failure_category(rollup.status, rollup.reason).label('reason')
+    return select(rollup.status, rollup.direction, reason,
+                  func.sum(rollup.transactions_count).label('transactions_count'),
+                  func.sum(rollup.amount_sum).label('amount_sum'))\
+        .where(rollup.bucket_start >= start, rollup.bucket_start < end)\
+        .group_by(rollup.status, rollup.direction, reason)
+
+
+def summarize_transactions_statement(start: datetime, end: datetime) -> Select:
+    """
+    Totals of the transactions in the given range by (status, direction, failure category), straight from the
+    transactions
+    """
+    transaction = sqlalchemy_models.Transaction
+    reason = failure_category(transaction.status, func.coalesce(transaction.reason, '')).label('reason')
+    return select(transaction.status, transaction.direction, reason,
+                  func.count().label('transactions_count'),
+                  func.sum(transaction.amount).label('amount_sum'))\
+        .where(transaction.timestamp >= start, transaction.timestamp < end)\
+        .group_by(transaction.status, transaction.direction, reason)
@@ -0,0 +1,40 @@
+"""
+Upgrades the schema of existing databases: the tables are created with create_all, which skips existing tables, so the
+columns & indexes added to the models later are added to the existing tables here
+"""
+
+from sqlalchemy import Engine, MetaData, inspect, text
+from sqlalchemy.schema import CreateColumn
+import structlog
+
+logger = structlog.get_logger()
+
+
+def add_missing_columns(engine: Engine, metadata: MetaData) -> None:
+    """
+    Adds the columns of the models that are missing from their existing tables. Only nullable columns (or columns with a
+    server default) can be added to tables that already have rows. A column added to the (partitioned) transactions
+    table is added to all of its partitions
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                logger.info('Adding a missing column', table=table.name, column=column.name)
+                # The column definition (type, nullability & server default), as in CREATE TABLE
+                column_definition = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column_definition}'))
+
+
+def create_missing_indexes(engine: Engine, metadata: MetaData) -> None:
+    """Creates the indexes of the models that are missing from their existing tables"""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
@@ -0,0 +1,210 @@
+"""
+SQL statements shared by the sync & async DAL implementations
+"""
+
+from datetime import datetime
+import json
+from typing import Iterable, Any, Optional
+
+from sqlalchemy import Select, Update, TextClause, select, update, or_, and_, case, tuple_, func, text, union_all
+from sqlalchemy.orm import aliased
+
+from dal.sqlalchemy import models as sqlalchemy_models
+
+
+def move_funds_statement(paying_account_id: Any, receiving_account_id: Any, amount: float) -> Update:
+    """
+    A single guarded UPDATE that moves the funds between the accounts, & only takes the money from the paying account
+    if it has enough funds. Striped accounts are not updated, as their balance is kept in their stripes.
+    Returns the IDs of the updated accounts, so if less than 2 accounts were updated the transfer was denied & the
+    database transaction must be rolled back.
+    """
+    bank_account = sqlalchemy_models.BankAccount
+    return update(bank_account)\
+        .where(bank_account.id.in_([paying_account_id, receiving_account_id]), bank_account.stripes == 0)\
+        .where(or_(bank_account.id == receiving_account_id, bank_account.balance >= amount))\
+        .values(balance=bank_account.balance + case((bank_account.id == receiving_account_id, amount),
+                                                    else_=-amount))\
+        .returning(bank_account.id)\
+        .execution_options(synchronize_session=False)
+
+
+def lock_accounts_statement(account_ids: Iterable[Any]) -> Select:
+    """
+    Locks the rows of the given accounts in ascending ID order & selects their IDs. A single UPDATE of many rows locks
+    them in whatever order it finds them, so transfers lock their accounts with this first, in the same database
+    transaction, & concurrent transfers of the same accounts can not deadlock
+    """
+    bank_account = sqlalchemy_models.BankAccount
+    return select(bank_account.id)\
+        .where(bank_account.id.in_(list(account_ids)))\
+        .order_by(bank_account.id)\
+        .with_for_update()
+
+
+def existing_account_ids_statement(account_ids: Iterable[Any]) -> Select:
+    """Selects the IDs of the given accounts that exist"""
+    return select(sqlalchemy_models.BankAccount.id)\
+        .where(sqlalchemy_models.BankAccount.id.in_(list(account_ids)))
+
+
+def transactions_in_range_statement(start_timestamp: datetime, end_timestamp: datetime) -> Select:
+    """Selects all transactions that happened in the given time range (the end timestamp is not included)"""
+    return select(sqlalchemy_models.Transaction)\
+        .where(and_(sqlalchemy_models.Transaction.timestamp >= start_timestamp,
+                    sqlalchemy_models.Transaction.timestamp < end_timestamp))
+
+
+def count_transactions_statement(start_timestamp: datetime, end_timestamp: datetime) -> Select:
+    """Counts the transactions in the given time range"""
+    statement = transactions_in_range_statement(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+    return select(func.count()).select_from(statement.subquery())
+
+
+def explain_transactions_in_range_statement(start_timestamp: datetime, end_timestamp: datetime) -> TextClause:
+    """
+    Asks the query planner how many transactions are in the given time range, without running the query.
+    The estimate is based on the table statistics, so it costs the same no matter how many transactions there are.
+    """
+    return text(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM {sqlalchemy_models.Transaction.__tablename__} '
+                f'WHERE timestamp >= :start_timestamp AND timestamp < :end_timestamp')\
+        .bindparams(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+
+
+def get_estimated_rows(explain_result: Any) -> int:
+    """Extracts the estimated number of rows out of the result of an EXPLAIN (FORMAT JSON) statement"""
+    # Some drivers parse the JSON result & some return it as a string
+    if isinstance(explain_result, str):
+        explain_result = json.loads(explain_result)
+
+    return int(explain_result[0]['Plan']['Plan Rows'])
+
+
+def transactions_keyset_page_statement(start_timestamp: datetime,
+                                       end_timestamp: datetime,
+                                       after_timestamp: Optional[datetime],
+                                       after_transaction_id: Optional[int],
+                                       limit: int) -> Select:
+    """
+    Selects a page of transactions in the given time range, ordered by (timestamp, id), that come after the given
+    (timestamp, id) position. This is a range scan on the (timestamp, id) index, so every page costs the same no matter
+    how deep into the report it is.
+    """
+    transaction = sqlalchemy_models.Transaction
+    statement = transactions_in_range_statement(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+
+    if after_timestamp is not None and after_transaction_id is not None:
+        statement = statement.where(tuple_(transaction.timestamp, transaction.id) >
+                                    tuple_(after_timestamp, after_transaction_id))
+
+    return statement.order_by(transaction.timestamp, transaction.id).limit(limit)
+
+
+def export_transactions_statement(start_timestamp: datetime, end_timestamp: datetime, chunk_size: int) -> Select:
+    """
+    Selects the columns of all transactions in the given time range, ordered by (timestamp, id), streamed from a
+    server side cursor in chunks of the given size. Plain rows are selected instead of ORM objects, so they are not
+    tracked by the session while exporting.
+    """
+    transaction = sqlalchemy_models.Transaction
+    return select(*transaction.__table__.columns)\
+        .where(and_(transaction.timestamp >= start_timestamp, transaction.timestamp < end_timestamp))\
+        .order_by(transaction.timestamp, transaction.id)\
+        .execution_options(stream_results=True, yield_per=chunk_size)
+
+
+def account_transactions_statement(account_id: Any,
+                                   start_timestamp: datetime,
+                                   end_timestamp: datetime,
+                                   limit: int) -> Select:
+    """
+    Selects the latest transactions of an account in the given time range (as either the source or the destination),
+    newest first. Each side is a separate range scan on its (account_id, timestamp) index, limited on its own, so the
+    query never scans more than 2 * limit transactions (an OR condition could not use the index order).
+    """
+    transaction = sqlalchemy_models.Transaction
+    in_range = and_(transaction.timestamp >= start_timestamp, transaction.timestamp < end_timestamp)
+    newest_first = (transaction.timestamp.desc(), transaction.id.desc())
+
+    as_source = select(transaction).where(transaction.src_account_id == account_id, in_range)\
+        .order_by(*newest_first).limit(limit)
+    as_destination = select(transaction).where(transaction.dst_account_id == account_id, in_range)\
+        .order_by(*newest_first).limit(limit)
+
+    both_sides = union_all(as_source, as_destination).subquery()
+    account_transaction = aliased(transaction, both_sides)
+
+    return select(account_transaction)\
+        .order_by(account_transaction.timestamp.desc(), account_transaction.id.desc())\
+        .limit(limit)
+
+
+def withdraw_statement(account_id: Any, amount: float) -> Update:
+    """Takes the amount from the balance of an account row, only if it has enough funds. Returns the account ID"""
+    bank_account = sqlalchemy_models.BankAccount
+    return update(bank_account)\
+        .where(bank_account.id == account_id, bank_account.balance >= amount)\
+        .values(balance=bank_account.balance - amount)\
+        .returning(bank_account.id)\
+        .execution_options(synchronize_session=False)
+
+
+def deposit_statement(account_id: Any, amount: float) -> Update:
+    """Adds the amount to the balance of an account row. Returns the account ID"""
+    bank_account = sqlalchemy_models.BankAccount
+    return update(bank_account)\
+        .where(bank_account.id == account_id)\
+        .values(balance=bank_account.balance + amount)\
+        .returning(bank_account.id)\
+        .execution_options(synchronize_session=False)
+
+
+def account_stripes_statement(account_ids: Iterable[Any]) -> Select:
+    """Selects the (id, number of stripes) of the given accounts"""
+    bank_account = sqlalchemy_models.BankAccount
+    return select(bank_account.id, bank_account.stripes).where(bank_account.id.in_(list(account_ids)))
+
+
+def withdraw_from_stripe_statement(account_id: Any, amount: float, skip_locked: bool) -> Update:
+    """
+    Takes the amount from a random stripe of the account that has enough funds. Returns the stripe number.
+    With skip_locked, stripes locked by concurrent transactions are skipped instead of waited for.
+    """
+    stripe = sqlalchemy_models.BankAccountStripe
+    chosen_stripe_number = select(stripe.stripe_number)\
+        .where(stripe.account_id == account_id, stripe.balance >= amount)\
+        .order_by(func.random())\
+        .limit(1)\
+        .with_for_update(skip_locked=skip_locked)\
+        .scalar_subquery()
+
+    return update(stripe)\
+        .where(stripe.account_id == account_id, stripe.stripe_number == chosen_stripe_number)\
+        .values(balance=stripe.balance - amount)\
+        .returning(stripe.stripe_number)\
+        .execution_options(synchronize_session=False)
+
+
+def deposit_to_stripe_statement(account_id: Any, stripe_number: int, amount: float) -> Update:
+    """Adds the amount to the given stripe of the account. Returns the stripe number"""
+    stripe = sqlalchemy_models.BankAccountStripe
+    return update(stripe)\
+        .where(stripe.account_id == account_id, stripe.stripe_number == stripe_number)\
+        .values(balance=stripe.balance + amount)\
+        .returning(stripe.stripe_number)\
+        .execution_options(synchronize_session=False)
+
+
+def account_balance_statement(account_id: Any) -> Select:
+    """
+    Reads the (id, balance) of the account, where the balance of a striped account is its own balance & the sum of its
+    stripes. The rows are not locked, so the read does not wait for concurrent transfers.
+    """
+    account = sqlalchemy_models.BankAccount
+    stripe = sqlalchemy_models.BankAccountStripe
+    stripes_balance = select(func.coalesce(func.sum(stripe.balance), 0))\
+        .where(stripe.account_id == account.id)\
+        .scalar_subquery()
+
+    return select(account.id, (account.balance + stripes_balance).label('balance'))\
+        .where(account.id == account_id)
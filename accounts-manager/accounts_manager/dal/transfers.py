@@ -0,0 +1,62 @@
+"""
+Business rules of money transfers, shared by the sync & async DAL implementations
+"""
+
+from typing import Tuple, Set, Union, AbstractSet
+
+from dal import dal_models
+
+
+def get_paying_and_receiving_account_ids(src_account_id: str,
+                                         dst_account_id: str,
+                                         direction: dal_models.DalTransactionDirection) -> Tuple[str, str]:
+    """
+    A debit transaction takes the money from the source account, & a credit transaction takes it from the
+    destination account
+    :return: (paying_account_id, receiving_account_id)
+    """
+    if direction == dal_models.DalTransactionDirection.debit:
+        return src_account_id, dst_account_id
+    return dst_account_id, src_account_id
+
+
+def get_account_lock_order_key(account_id: str) -> Tuple[int, Union[int, str]]:
+    """
+    The order the accounts of a chunk are locked in: ascending ID, as the database orders the (integer) IDs, so "9" is
+    locked before "10". IDs that are not numbers go last (they do not exist)
+    """
+    try:
+        return 0, int(account_id)
+    except ValueError:
+        return 1, account_id
+
+
+def get_striped_account_reason(account_id: str) -> str:
+    """
+    The balance of a striped account is split across its stripes, which only bank transactions use, so it does not take
+    part in account-to-account transfers
+    """
+    return f"Account with ID {account_id} is striped & only takes part in bank transactions"
+
+
+def get_denial_reason(src_account_id: str,
+                      dst_account_id: str,
+                      paying_account_id: str,
+                      existing_account_ids: Set[str],
+                      striped_account_ids: AbstractSet[str] = frozenset()) -> str:
+    """
+    Explains why a guarded transfer did not update both accounts
+    :param existing_account_ids: Which of the transfer accounts exist (as strings)
+    :param striped_account_ids: Which of the transfer accounts are striped (as strings), which account-to-account
+        transfers do not update
+    """
+    if str(src_account_id) not in existing_account_ids:
+        return f"Source account with ID {src_account_id} does not exist"
+    if str(dst_account_id) not in existing_account_ids:
+        return f"Destination account with ID {dst_account_id} does not exist"
+    for account_id in (src_account_id, dst_account_id):
+        if str(account_id) in striped_account_ids:
+            return get_striped_account_reason(account_id)
+    if paying_account_id == src_account_id:
+        return "Insufficient funds in the source account"
+    return "Insufficient funds in the destination account"
@@ -0,0 +1,62 @@
+"""
+The metrics of the service, exposed in the Prometheus format on the /metrics path.
+The database statements & connection pool metrics are reported by the dal (see dal/sqlalchemy/metrics.py).
+"""
+
+from enum import Enum
+from typing import Optional
+
+from prometheus_client import Counter, Histogram
+from starlette.types import Scope
+
+from dal.dal_models import DalTransaction, DalTransactionStatus
+
+# The route of requests that did not match any route, so unknown paths do not create new label values
+UNMATCHED_ROUTE = 'unmatched'
+# The status code of requests that failed before sending a response
+UNHANDLED_ERROR_STATUS_CODE = 500
+
+HTTP_REQUEST_DURATION = Histogram('http_request_duration_seconds',
+                                  'The time it took to handle a request',
+                                  ['method', 'route'])
+HTTP_REQUESTS = Counter('http_requests', 'The number of handled requests', ['method', 'route', 'status_code'])
+TRANSFERS = Counter('transfers', 'The number of transfers by their outcome', ['operation', 'outcome'])
+
+
+class TransferOutcome(str, Enum):
+    successful = 'successful'
+    # The transfer was denied, for example: insufficient funds
+    denied = 'denied'
+    # The transfer failed due to an unexpected error
+    error = 'error'
+
+
+def get_route_name(scope: Scope) -> str:
+    """Returns the path template of the route that handled the request (for example: /api/v1/accounts/{account_id})"""
+    route = scope.get('route')
+    return getattr(route, 'path', UNMATCHED_ROUTE)
+
+
+def observe_request(scope: Scope, status_code: Optional[int], duration: float) -> None:
+    """Records the duration & the status code of a handled request, by its route"""
+    method = scope['method']
+    route = get_route_name(scope)
+    HTTP_REQUEST_DURATION.labels(method=method, route=route).observe(duration)
+    HTTP_REQUESTS.labels(method=method, route=route, status_code=status_code or UNHANDLED_ERROR_STATUS_CODE).inc()
+
+
+def count_transfer(operation: str, dal_transaction: DalTransaction, is_error: bool = False) -> None:
+    """
+    Counts the outcome of a transfer
+    :param operation: The kind of the transfer (for example: transaction, bank_transaction)
+    :param dal_transaction: The resulting transaction of the transfer
+    :param is_error: Whether the transfer failed due to an unexpected error
+    """
+    if is_error:
+        outcome = TransferOutcome.error
+    elif dal_transaction.status == DalTransactionStatus.successful:
+        outcome = TransferOutcome.successful
+    else:
+        outcome = TransferOutcome.denied
+
+    TRANSFERS.labels(operation=operation, outcome=outcome.value).inc()
@@ -1,9 +1,10 @@
 from typing import Dict
 
+from starlette.datastructures import URL
+from starlette.types import Scope
 from structlog.contextvars import get_contextvars, bind_contextvars, clear_contextvars
-from fastapi import Request
 
-LOG_REQUEST_HEADERS = ['user-agent']
+LOG_REQUEST_HEADERS = [b'user-agent']
 MAX_HEADER_VALUE_LEN = 150
 
 
@@ -24,23 +25,23 @@ class ContextVars:
         bind_contextvars(**self.__original_context_vars)
 
 
-def extract_request_metadata(request: Request) -> Dict:
-    client = request.client.host
-    request_url = str(request.url)
-    request_uri = request.url.path
-    request_method = request.method
+def extract_request_metadata(scope: Scope) -> Dict:
+    """Extracts the details of the request that are logged, straight from the ASGI scope of the request"""
+    client = scope['client'][0] if scope.get('client') else None
+    request_url = str(URL(scope=scope))
+    request_uri = scope['path']
+    request_method = scope['method']
 
-    all_headers = dict(request.headers)
     headers = {}
-    for key, value in all_headers.items():
-        if key.lower() in LOG_REQUEST_HEADERS:
-            _value = value
-            if not isinstance(_value, str):
-                _value = str(_value)
+    # Only the logged headers are decoded, the headers of the scope are a list of (name, value) byte strings
+    for key, value in scope['headers']:
+        key = key.lower()
+        if key in LOG_REQUEST_HEADERS:
+            _value = value.decode('latin-1')
 
             if len(_value) > MAX_HEADER_VALUE_LEN:
                 _value = f'{_value[:MAX_HEADER_VALUE_LEN]}...'
-            headers[key.lower()] = _value
+            headers[key.decode('latin-1')] = _value
 
     request_metadata = {
         'client': client,
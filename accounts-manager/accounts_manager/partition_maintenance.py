@@ -0,0 +1,66 @@
+"""
+Maintains the partitions of the transactions table: creates future partitions ahead of time, & archives old partitions
+to compressed files. Expired idempotency keys are deleted along the way.
+Runs periodically in the background of the API, & can also be run manually:
+    python3 partition_maintenance.py
+"""
+
+from datetime import timedelta
+import threading
+
+from structlog import get_logger
+
+from settings import Settings
+from dal.dal import Dal
+
+logger = get_logger()
+
+
+def run_partition_maintenance(dal: Dal, settings: Settings) -> None:
+    """
+    Runs a single round of partitions maintenance: creating future partitions, archiving old ones & deleting expired
+    idempotency keys
+    """
+    dal.maintain_transaction_partitions(interval=settings.transactions_partition_interval,
+                                        premake=settings.transactions_partitions_premake)
+
+    if settings.transactions_archive_after_days:
+        dal.archive_transaction_partitions(retention=timedelta(days=settings.transactions_archive_after_days),
+                                           archive_dir=settings.transactions_archive_dir,
+                                           chunk_size=settings.export_chunk_size)
+
+    if settings.idempotency_keys_retention_hours:
+        dal.delete_expired_idempotency_keys(retention=timedelta(hours=settings.idempotency_keys_retention_hours))
+
+
+class PartitionMaintenanceThread(threading.Thread):
+    """A background thread running the partitions maintenance every interval, until it is stopped"""
+
+    def __init__(self, dal: Dal, settings: Settings):
+        super().__init__(name='partition-maintenance', daemon=True)
+        self.__dal = dal
+        self.__settings = settings
+        self.__stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.__stopped.wait(self.__settings.partition_maintenance_interval):
+            try:
+                run_partition_maintenance(dal=self.__dal, settings=self.__settings)
+            except Exception:
+                # A failed round is retried in the next interval, & partitions are created days ahead of time
+                logger.exception('Transactions partition maintenance failed')
+
+    def stop(self) -> None:
+        self.__stopped.set()
+
+
+if __name__ == '__main__':
+    from configure_logging import configure_logging
+
+    _settings = Settings()
+    configure_logging(_settings)
+
+    _dal = Dal()
+    _dal.initiate_connection(_settings.db_connection_string.get_secret_value(),
+                             engine_profile=_settings.get_db_engine_profile())
+    run_partition_maintenance(dal=_dal, settings=_settings)
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+import hashlib
+from typing import Optional, Union
+
+from fastapi import APIRouter, Header, HTTPException, Query, Response, status
+from structlog import get_logger
+
+from api_models.transations import Transaction, AccountTransactions, AccountBalance
+from dal.dal import Dal
+from dal.dal_models import DalAccountBalance
+from routes.pagination import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT
+
+logger = get_logger()
+
+# The default time range of an account history, the transactions of the last few days
+DEFAULT_ACCOUNT_HISTORY_RANGE = timedelta(days=5)
+
+
+def get_balance_etag(account_balance: DalAccountBalance) -> str:
+    """The ETag of an account balance, which changes whenever the balance changes"""
+    return '"' + hashlib.sha1(f'{account_balance.account_id}:{account_balance.balance!r}'.encode()).hexdigest() + '"'
+
+
+def is_etag_matching(etag: str, if_none_match: Optional[str]) -> bool:
+    """Checks if the ETag is one of the ETags of an If-None-Match header"""
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))
+
+
+def get_router(dal: Dal, balance_max_age: int = 1) -> APIRouter:
+    """
+    Generates the bank accounts routes, and returns the resulting router
+    :param dal: The DAL used by the routes
+    :param balance_max_age: How long (seconds) clients may cache an account balance for
+    """
+    router = APIRouter()
+
+    @router.get('/api/v1/accounts/{account_id}', response_model=AccountBalance)
+    def get_account(account_id: str,
+                    response: Response,
+                    if_none_match: Optional[str] = Header(default=None)) -> Union[AccountBalance, Response]:
+        """
+        Returns the current balance of the account, without locking the account (so it can be polled freely).
+        The response has an ETag, so clients polling the balance get an empty 304 response while it did not change.
+        :param account_id: The ID of the account
+        :param response: The response, used to set the caching headers
+        :param if_none_match: The ETag of the balance the client already has (the If-None-Match header)
+        """
+        account_balance = dal.get_account_balance(account_id=account_id)
+        if account_balance is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Account with ID {account_id} does not exist')
+
+        etag = get_balance_etag(account_balance)
+        caching_headers = {'ETag': etag, 'Cache-Control': f'private, max-age={balance_max_age}'}
+        if is_etag_matching(etag=etag, if_none_match=if_none_match):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=caching_headers)
+
+        response.headers.update(caching_headers)
+        return AccountBalance(account_id=account_balance.account_id, balance=account_balance.balance)
+
+    @router.get('/api/v1/accounts/{account_id}/transactions', response_model=AccountTransactions)
+    def get_account_transactions(
+            account_id: str,
+            start_timestamp: Optional[datetime] = None,
+            end_timestamp: Optional[datetime] = None,
+            limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT)) -> AccountTransactions:
+        """
+        Returns the latest transactions of the account (where it is either the source or the destination),
+        newest first.
+        :param account_id: The ID of the account
+        :param start_timestamp: The earliest timestamp of transaction to include. Defaults to 5 days before the end
+        :param end_timestamp: Only transaction that happened before this timestamp are included. Defaults to now
+        :param limit: The maximum amount of transactions to return (1 to 1000)
+        """
+        end_timestamp = end_timestamp or datetime.now()
+        start_timestamp = start_timestamp or end_timestamp - DEFAULT_ACCOUNT_HISTORY_RANGE
+
+        dal_transactions = dal.get_account_transactions(account_id=account_id,
+                                                        start_timestamp=start_timestamp,
+                                                        end_timestamp=end_timestamp,
+                                                        limit=limit)
+
+        return AccountTransactions(
+            account_id=account_id,
+            items=[Transaction(**dal_transaction.dict(by_alias=True)) for dal_transaction in dal_transactions],
+            limit=limit
+        )
+
+    return router
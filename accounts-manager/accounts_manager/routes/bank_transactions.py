@@ -0,0 +1,134 @@
+from datetime import datetime
+from typing import Optional, List
+
+from fastapi import APIRouter, Header, HTTPException, status
+from structlog import get_logger
+
+from api_models.transations import BankTransactionRequest, BankTransaction, TransactionDirection, TransactionStatus, \
+    BankTransactionsBatchRequest
+from dal.dal import Dal
+from dal.exceptions import IdempotencyKeyReusedError
+from metrics import count_transfer
+from dal.dal_models import DalTransactionDirection, DalTransactionStatus, DalTransaction, DalBankTransferRequest
+
+logger = get_logger()
+
+
+def to_bank_transaction(dal_transaction: DalTransaction) -> BankTransaction:
+    """
+    Bank transactions are recorded with the account as the source & the bank as the destination,
+    so the account is the source of the recorded Transaction
+    """
+    return BankTransaction(
+        transaction_id=dal_transaction.transaction_id,
+        timestamp=dal_transaction.timestamp,
+        dst_account_id=dal_transaction.src_account_id,
+        amount=dal_transaction.amount,
+        direction=TransactionDirection(dal_transaction.direction.value),
+        status=TransactionStatus(dal_transaction.status.value),
+        reason=dal_transaction.reason or None,
+        description=dal_transaction.description
+    )
+
+
+def get_router(dal: Dal) -> APIRouter:
+    """Generates the bank transactions routes, and returns the resulting router"""
+    router = APIRouter()
+
+    @router.post('/api/v1/bank_transactions', response_model=BankTransaction)
+    def post_bank_transaction(bank_transaction_request: BankTransactionRequest,
+                              idempotency_key: Optional[str] = Header(default=None)) -> BankTransaction:
+        """
+        Gives money from the bank to an account, or takes money from an account to the bank
+        (for example: granting an advance & collecting its payments).
+        :param bank_transaction_request: The details of the bank transaction (the account, amount etc..)
+        :param idempotency_key: A unique key of the request (the Idempotency-Key header). Retrying a request
+            with the same key returns the original transaction instead of transferring the funds again
+        :return: The resulting BankTransaction, which includes the status specifying if
+                 the transaction was successful or not
+        """
+
+        if not dal.bank_account_id:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail='Bank transactions are not available, the bank account is not configured')
+
+        direction = DalTransactionDirection(bank_transaction_request.direction.value)
+        timestamp = datetime.now()
+
+        is_error = False
+        try:
+            dal_transaction = dal.perform_bank_transaction(
+                account_id=bank_transaction_request.dst_account_id,
+                amount=bank_transaction_request.amount,
+                direction=direction,
+                description=bank_transaction_request.reason,
+                timestamp=timestamp,
+                idempotency_key=idempotency_key)
+        except IdempotencyKeyReusedError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+        except Exception as e:
+            failure_reason = f'Money transfer failed due to an unexpected error: {e}'
+            logger.exception(failure_reason)
+
+            is_error = True
+            dal_transaction = dal.create_transaction(
+                src_account_id=bank_transaction_request.dst_account_id,
+                dst_account_id=dal.bank_account_id,
+                amount=bank_transaction_request.amount,
+                direction=direction,
+                status=DalTransactionStatus.fail,
+                reason=failure_reason,
+                description=bank_transaction_request.reason,
+                timestamp=timestamp
+            )
+
+        logger.info('Bank transaction complete',
+                    is_successful=dal_transaction.status == DalTransactionStatus.successful,
+                    reason=dal_transaction.reason or None)
+        count_transfer('bank_transaction', dal_transaction=dal_transaction, is_error=is_error)
+
+        return to_bank_transaction(dal_transaction)
+
+    @router.post('/api/v1/bank_transactions/batch', response_model=List[BankTransaction])
+    def post_bank_transactions_batch(bank_transaction_requests: BankTransactionsBatchRequest) -> List[BankTransaction]:
+        """
+        Performs a batch of bank transactions (for example: collecting a chunk of due advance payments). Every bank
+        transaction succeeds or fails on its own, just like bank transactions performed one by one, but the batch is
+        committed in chunks which is much faster for bulk clients.
+        :param bank_transaction_requests: The details of the bank transactions, each with an optional idempotency key
+        :return: The resulting BankTransactions, in the same order as the requests. Each includes the status specifying
+                 if the transaction was successful or not
+        """
+
+        if not dal.bank_account_id:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail='Bank transactions are not available, the bank account is not configured')
+
+        bank_transfers = [
+            DalBankTransferRequest(
+                account_id=bank_transaction_request.dst_account_id,
+                amount=bank_transaction_request.amount,
+                direction=DalTransactionDirection(bank_transaction_request.direction.value),
+                description=bank_transaction_request.reason,
+                idempotency_key=bank_transaction_request.idempotency_key)
+            for bank_transaction_request in bank_transaction_requests
+        ]
+
+        try:
+            dal_transactions = dal.perform_bank_transactions_batch(bank_transfers=bank_transfers,
+                                                                   timestamp=datetime.now())
+        except IdempotencyKeyReusedError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+        successful_count = 0
+        for dal_transaction in dal_transactions:
+            successful_count += dal_transaction.status == DalTransactionStatus.successful
+            count_transfer('batch_bank_transaction', dal_transaction=dal_transaction)
+        logger.info('Bank transactions batch complete',
+                    batch_size=len(dal_transactions),
+                    successful_count=successful_count,
+                    failed_count=len(dal_transactions) - successful_count)
+
+        return [to_bank_transaction(dal_transaction) for dal_transaction in dal_transactions]
+
+    return router
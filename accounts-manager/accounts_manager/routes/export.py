@@ -0,0 +1,79 @@
+import csv
+from enum import Enum
+import io
+from typing import Iterable, Iterator, List, Dict
+
+from dal.dal_models import DalTransaction, TRANSACTION_REQUEST_FIELDS
+
+# The columns of an exported transaction, in the same names as the transactions API
+EXPORT_FIELDS = ['id', 'src_account_id', 'dst_account_id', 'timestamp', 'amount', 'direction', 'status', 'reason',
+                 'description']
+
+
+class ExportFormat(str, Enum):
+    """
+    ndjson - every transaction is a JSON object in its own line
+    csv - a CSV file with a header line
+    """
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: 'application/x-ndjson',
+    ExportFormat.csv: 'text/csv',
+}
+
+
+def close_chunks(transactions_chunks: Iterable[List[DalTransaction]]) -> None:
+    """
+    Closes the chunks iterator (if it is a generator), which releases its server side cursor & database connection even
+    if it was not exhausted
+    """
+    close = getattr(transactions_chunks, 'close', None)
+    if close is not None:
+        close()
+
+
+def iter_ndjson(transactions_chunks: Iterable[List[DalTransaction]]) -> Iterator[str]:
+    """
+    Formats chunks of transactions as NDJSON, yielding a single string for every chunk.
+    The chunks iterator is closed when this iterator is exhausted or closed
+    """
+    try:
+        for transactions in transactions_chunks:
+            yield ''.join(f'{transaction.json(by_alias=True, exclude=TRANSACTION_REQUEST_FIELDS)}\n'
+                          for transaction in transactions)
+    finally:
+        close_chunks(transactions_chunks)
+
+
+def _to_csv_row(transaction: DalTransaction) -> Dict:
+    """Formats the fields of a transaction the same way they are formatted in JSON"""
+    return {
+        **transaction.dict(by_alias=True, exclude=TRANSACTION_REQUEST_FIELDS),
+        'timestamp': transaction.timestamp.isoformat(),
+        'direction': transaction.direction.value,
+        'status': transaction.status.value,
+    }
+
+
+def iter_csv(transactions_chunks: Iterable[List[DalTransaction]]) -> Iterator[str]:
+    """
+    Formats chunks of transactions as CSV (starting with a header line), yielding a single string for every chunk.
+    The chunks iterator is closed when this iterator is exhausted or closed
+    """
+    try:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+
+        writer.writeheader()
+        yield buffer.getvalue()
+
+        for transactions in transactions_chunks:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(_to_csv_row(transaction) for transaction in transactions)
+            yield buffer.getvalue()
+    finally:
+        close_chunks(transactions_chunks)
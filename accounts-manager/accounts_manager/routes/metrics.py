@@ -0,0 +1,16 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+
+def get_router() -> APIRouter:
+    """Generates the metrics route, and returns the resulting router"""
+    router = APIRouter()
+
+    @router.get('/metrics', include_in_schema=False)
+    def get_metrics() -> Response:
+        """Returns the metrics of the service (request latency, database statements, connection pool etc..) in the
+        Prometheus text format"""
+        # Set as a header, as a media type would get a second charset appended
+        return Response(content=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    return router
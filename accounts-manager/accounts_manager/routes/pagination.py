@@ -0,0 +1,73 @@
+import math
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from fastapi import HTTPException, status
+
+from api_models.cursors import TransactionsCursor
+from api_models.transations import Transaction, TransactionsPage
+from dal.dal_models import DalTransaction
+
+# The default & maximum number of transactions in a page of the transactions report
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+
+def decode_transactions_cursor(cursor: str, start_timestamp: datetime, end_timestamp: datetime) -> TransactionsCursor:
+    """
+    Parses the cursor sent by the client, & responds with a 400 error if it is invalid, or if it belongs to a report of
+    a different time range
+    """
+    try:
+        transactions_cursor = TransactionsCursor.decode(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    if (transactions_cursor.start_timestamp, transactions_cursor.end_timestamp) != (start_timestamp, end_timestamp):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='The cursor belongs to a report of a different time range '
+                                   f'({transactions_cursor.start_timestamp} - {transactions_cursor.end_timestamp})')
+    return transactions_cursor
+
+
+def get_snapshot_timestamp(end_timestamp: datetime, snapshot_lag: float) -> datetime:
+    """
+    The snapshot of a report paginated with cursors: the transactions with an earlier timestamp were committed, since a
+    transaction is committed less than snapshot_lag seconds after its timestamp. Transaction IDs can not be used as the
+    snapshot, since transactions are not committed in the order of their IDs.
+    The snapshot is in the time zone of the report (if any), so they can be compared
+    """
+    return datetime.now(tz=end_timestamp.tzinfo) - timedelta(seconds=snapshot_lag)
+
+
+def get_number_of_pages(total_items: Optional[int], limit: int) -> Optional[int]:
+    return math.ceil(total_items / limit) if total_items is not None else None
+
+
+def build_keyset_transactions_page(dal_transactions: List[DalTransaction],
+                                   limit: int,
+                                   transactions_cursor: TransactionsCursor) -> TransactionsPage:
+    """
+    Builds a page of the transactions report paginated with cursors.
+    :param dal_transactions: The transactions of the page, with one extra transaction (limit + 1) if there are more
+        pages, which is used only to know if there is a next page
+    :param limit: The maximum amount of transactions in the page
+    :param transactions_cursor: The cursor of the page. Its time range, snapshot & total count are passed on to the
+        next pages
+    """
+    page_transactions = dal_transactions[:limit]
+
+    next_cursor: Optional[str] = None
+    if len(dal_transactions) > limit:
+        last_transaction = page_transactions[-1]
+        next_cursor = transactions_cursor.copy(update={
+            'after_timestamp': last_transaction.timestamp,
+            'after_transaction_id': int(last_transaction.transaction_id)}).encode()
+
+    return TransactionsPage(
+        items=[Transaction(**dal_transaction.dict(by_alias=True)) for dal_transaction in page_transactions],
+        limit=limit,
+        total_items=transactions_cursor.total_items,
+        number_of_pages=get_number_of_pages(total_items=transactions_cursor.total_items, limit=limit),
+        next_cursor=next_cursor
+    )
@@ -0,0 +1,39 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import List, Dict, Tuple
+
+from api_models.transations import TransactionsSummary, TransactionsSummaryGroup, FailureReasonSummary, \
+    TransactionStatus, TransactionDirection
+from dal.dal_models import DalTransactionsSummaryGroup, DalTransactionStatus
+
+
+def build_transactions_summary(start_timestamp: datetime,
+                               end_timestamp: datetime,
+                               dal_groups: List[DalTransactionsSummaryGroup]) -> TransactionsSummary:
+    """Builds the summary of the transactions from the totals of every (status, direction, failure category) group"""
+
+    groups: Dict[Tuple[TransactionStatus, TransactionDirection], TransactionsSummaryGroup] = {}
+    failure_reasons: Dict[str, int] = defaultdict(int)
+    for dal_group in dal_groups:
+        status = TransactionStatus(dal_group.status.value)
+        direction = TransactionDirection(dal_group.direction.value)
+        group = groups.setdefault((status, direction), TransactionsSummaryGroup(status=status,
+                                                                                direction=direction,
+                                                                                transactions_count=0,
+                                                                                amount_sum=0))
+        group.transactions_count += dal_group.transactions_count
+        group.amount_sum += dal_group.amount_sum
+
+        if dal_group.status == DalTransactionStatus.fail:
+            failure_reasons[dal_group.reason] += dal_group.transactions_count
+
+    return TransactionsSummary(
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
+        transactions_count=sum(group.transactions_count for group in groups.values()),
+        amount_sum=sum(group.amount_sum for group in groups.values()),
+        groups=list(groups.values()),
+        failure_reasons=[FailureReasonSummary(reason=reason, transactions_count=transactions_count)
+                         for reason, transactions_count in sorted(failure_reasons.items(),
+                                                                  key=lambda item: item[1], reverse=True)]
+    )
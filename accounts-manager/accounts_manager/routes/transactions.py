@@ -1,89 +1,224 @@
 from datetime import datetime
-import math
+from typing import List, Optional
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from structlog import get_logger
 
-from api_models.transations import TransactionRequest, Transaction, TransactionDirection, TransactionsPage
+from api_models.cursors import TransactionsCursor
+from api_models.transations import TransactionRequest, Transaction, TransactionsPage, PaginationMode, \
+    ReportCountStrategy, TransactionsBatchRequest, TransactionsSummary
 from dal.dal import Dal
-from dal.dal_models import DalTransactionDirection, DalTransactionStatus, DalTransaction
+from dal.exceptions import IdempotencyKeyReusedError
+from metrics import count_transfer
+from dal.dal_models import DalTransactionDirection, DalTransactionStatus, DalTransaction, DalTransferRequest
+from routes.export import ExportFormat, EXPORT_MEDIA_TYPES, iter_ndjson, iter_csv
+from routes.pagination import decode_transactions_cursor, build_keyset_transactions_page, get_number_of_pages, \
+    get_snapshot_timestamp, DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT
+from routes.summary import build_transactions_summary
 
 logger = get_logger()
 
 
-def get_router(dal: Dal) -> APIRouter:
+def get_router(dal: Dal, export_chunk_size: int = 1000, report_snapshot_lag: float = 60) -> APIRouter:
     """Generated a bunch of example routes on a router, and returns the resulting router"""
     router = APIRouter()
 
     @router.post('/api/v1/transaction', response_model=Transaction)
-    def post_transaction(transaction_request: TransactionRequest) -> DalTransaction:
+    def post_transaction(transaction_request: TransactionRequest,
+                         idempotency_key: Optional[str] = Header(default=None)) -> DalTransaction:
         """
         Creates a new transfer & attempts to transfer the funds between the specified bank accounts.
         :param transaction_request: The details of the transfer request (the bank accounts, amount etc..)
+        :param idempotency_key: A unique key of the request (the Idempotency-Key header). Retrying a request
+            with the same key returns the original transaction instead of transferring the funds again
         :return: The resulting Transaction, which includes the status specifying if
                  the transaction was successful or not
         """
 
         # If the transaction from account A to B of 100 units is with the direction "debit",
         # we subtract 100 units from A and add 100 units to B.
-        # But if the direction is "credit" we have to do the opposite, so we will invert the amount being transferred.
-        normalized_amount = transaction_request.amount
-        if transaction_request.direction == TransactionDirection.credit:
-            normalized_amount = normalized_amount * -1
+        # But if the direction is "credit" we have to do the opposite. The dal handles both directions, moving the
+        # funds & recording the transaction in a single database transaction.
+        direction = DalTransactionDirection(transaction_request.direction.value)
+        timestamp = datetime.now()
 
-        failure_reason = None
+        is_error = False
         try:
-            dal.transfer_money(
+            dal_transaction = dal.perform_transaction(
                 src_account_id=transaction_request.src_account_id,
                 dst_account_id=transaction_request.dst_account_id,
-                amount=normalized_amount)
-            logger.debug('Money transfer was successful')
-        # A ValueError is raised when there is a problem with the given parameters.
-        # for example: invalid accounts, not enough funds or invalid transfer amount
-        except ValueError as e:
-            failure_reason = f'Transfer of funds denied. reason: {e}'
-            logger.warning(failure_reason)
+                amount=transaction_request.amount,
+                direction=direction,
+                timestamp=timestamp,
+                idempotency_key=idempotency_key)
+        except IdempotencyKeyReusedError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
         except Exception as e:
             failure_reason = f'Money transfer failed due to an unexpected error: {e}'
             logger.exception(failure_reason)
 
-        transfer_successful = failure_reason is None
-        logger.info('Transaction complete', is_successful=transfer_successful, reason=failure_reason)
-
-        dal_transaction = dal.create_transaction(
-            src_account_id=transaction_request.src_account_id,
-            dst_account_id=transaction_request.dst_account_id,
-            amount=transaction_request.amount,
-            direction=DalTransactionDirection(transaction_request.direction.value),
-            status=DalTransactionStatus.successful if transfer_successful else DalTransactionStatus.fail,
-            reason=failure_reason,
-            timestamp=datetime.now()
-        )
+            is_error = True
+            dal_transaction = dal.create_transaction(
+                src_account_id=transaction_request.src_account_id,
+                dst_account_id=transaction_request.dst_account_id,
+                amount=transaction_request.amount,
+                direction=direction,
+                status=DalTransactionStatus.fail,
+                reason=failure_reason,
+                timestamp=timestamp
+            )
+
+        logger.info('Transaction complete',
+                    is_successful=dal_transaction.status == DalTransactionStatus.successful,
+                    reason=dal_transaction.reason or None,
+                    transfer_attempts=dal_transaction.transfer_attempts)
+        count_transfer('transaction', dal_transaction=dal_transaction, is_error=is_error)
 
         return dal_transaction
 
+    @router.post('/api/v1/transactions/batch', response_model=List[Transaction])
+    def post_transactions_batch(transaction_requests: TransactionsBatchRequest) -> List[DalTransaction]:
+        """
+        Performs a batch of transfers, in the given order. Every transfer succeeds or fails on its own, just like
+        transfers created one by one, but the batch is committed in chunks which is much faster for bulk clients.
+        :param transaction_requests: The details of the transfer requests (the bank accounts, amount etc..)
+        :return: The resulting Transactions, in the same order as the requests. Each includes the status specifying if
+                 the transaction was successful or not
+        """
+
+        transfers = [
+            DalTransferRequest(
+                src_account_id=transaction_request.src_account_id,
+                dst_account_id=transaction_request.dst_account_id,
+                amount=transaction_request.amount,
+                direction=DalTransactionDirection(transaction_request.direction.value))
+            for transaction_request in transaction_requests
+        ]
+
+        dal_transactions = dal.perform_transactions_batch(transfers=transfers, timestamp=datetime.now())
+
+        successful_count = sum(1 for dal_transaction in dal_transactions
+                               if dal_transaction.status == DalTransactionStatus.successful)
+        logger.info('Transactions batch complete',
+                    batch_size=len(dal_transactions),
+                    successful_count=successful_count,
+                    failed_count=len(dal_transactions) - successful_count)
+        for dal_transaction in dal_transactions:
+            count_transfer('batch_transaction', dal_transaction=dal_transaction)
+
+        return dal_transactions
+
+    def count_transactions(start_timestamp: datetime,
+                           end_timestamp: datetime,
+                           count: ReportCountStrategy) -> Optional[int]:
+        """Counts the transactions in the report using the requested count strategy"""
+        if count == ReportCountStrategy.exact:
+            return dal.count_transactions(start_timestamp=start_timestamp,
+                                          end_timestamp=end_timestamp)
+        if count == ReportCountStrategy.estimate:
+            return dal.estimate_transactions_count(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+        return None
+
+    @router.get('/api/v1/transactions/summary', response_model=TransactionsSummary)
+    def get_transactions_summary(start_timestamp: datetime, end_timestamp: datetime) -> TransactionsSummary:
+        """
+        Sums up the transactions in the given time range: the number & total amount of transactions by status &
+        direction, & the number of failed transactions by failure reason.
+        The summary is read from the per minute rollups of the transactions, so it is fast for any time range.
+        :param start_timestamp: The earliest timestamp of transaction to include.
+            Transactions can happen exactly at this time or later.
+        :param end_timestamp: The latest timestamp of transaction to include.
+            Only transaction that happened before this timestamp are included.
+        """
+        dal_groups = dal.get_transactions_summary(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+        return build_transactions_summary(start_timestamp=start_timestamp,
+                                          end_timestamp=end_timestamp,
+                                          dal_groups=dal_groups)
+
     @router.get('/api/v1/transactions', response_model=TransactionsPage)
     def get_transactions(start_timestamp: datetime,
                          end_timestamp: datetime,
-                         page: int = 0,
-                         limit: int = 100) -> TransactionsPage:
-        dal_transactions, total_count = dal.get_paginated_transactions(start_timestamp=start_timestamp,
-                                                                       end_timestamp=end_timestamp,
-                                                                       page=page,
-                                                                       limit=limit)
-        transactions = [Transaction.from_orm(dal_transaction) for dal_transaction in dal_transactions]
+                         page: int = Query(0, ge=0),
+                         limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+                         pagination: PaginationMode = PaginationMode.page,
+                         cursor: Optional[str] = None,
+                         count: ReportCountStrategy = ReportCountStrategy.exact) -> TransactionsPage:
+        """
+        Returns a page of the transactions report.
+        To paginate with cursors, request the first page with pagination=cursor, & pass the next_cursor of every page
+        to get the next one, with the same time range. The cursor also fixes the snapshot of the report, so new
+        transactions do not show up while paginating (transactions show up report_snapshot_lag seconds after their
+        timestamp). The report is counted only on the first page, & the count is passed on in the cursor.
+        """
+        if pagination == PaginationMode.cursor or cursor:
+            if cursor:
+                transactions_cursor = decode_transactions_cursor(cursor,
+                                                                 start_timestamp=start_timestamp,
+                                                                 end_timestamp=end_timestamp)
+            else:
+                # The first page fixes the snapshot of the report, & counts it
+                transactions_cursor = TransactionsCursor(
+                    start_timestamp=start_timestamp,
+                    end_timestamp=end_timestamp,
+                    snapshot_timestamp=get_snapshot_timestamp(end_timestamp=end_timestamp,
+                                                              snapshot_lag=report_snapshot_lag))
+                transactions_cursor.total_items = count_transactions(
+                    start_timestamp=start_timestamp,
+                    end_timestamp=transactions_cursor.get_report_end_timestamp(),
+                    count=count)
+
+            # Fetching one extra transaction tells if there is a next page
+            dal_transactions = dal.get_transactions_page_after(
+                start_timestamp=start_timestamp,
+                end_timestamp=transactions_cursor.get_report_end_timestamp(),
+                after_timestamp=transactions_cursor.after_timestamp,
+                after_transaction_id=transactions_cursor.after_transaction_id,
+                limit=limit + 1)
+
+            return build_keyset_transactions_page(dal_transactions=dal_transactions,
+                                                  limit=limit,
+                                                  transactions_cursor=transactions_cursor)
+
+        dal_transactions = dal.get_paginated_transactions(start_timestamp=start_timestamp,
+                                                          end_timestamp=end_timestamp,
+                                                          page=page,
+                                                          limit=limit)
+        total_count = count_transactions(start_timestamp=start_timestamp, end_timestamp=end_timestamp, count=count)
+
+        transactions = [Transaction(**dal_transaction.dict(by_alias=True)) for dal_transaction in dal_transactions]
         transactions_page = TransactionsPage(
             items=transactions,
             page=page,
             limit=limit,
             total_items=total_count,
-            number_of_pages=math.ceil(total_count / limit)
+            number_of_pages=get_number_of_pages(total_items=total_count, limit=limit)
         )
 
         return transactions_page
 
-    # TODO: Implement a route for creating "special" Transactions where the bank gives an amount of money to an account
-    #       without taking it from another account. every BankTransaction can give / take money from an account, &
-    #       will have a reason for it (for example: Advance from bank, Payment of an advance etc...)
+    @router.get('/api/v1/transactions/export')
+    def export_transactions(start_timestamp: datetime,
+                            end_timestamp: datetime,
+                            format: ExportFormat = ExportFormat.ndjson) -> StreamingResponse:
+        """
+        Exports all the transactions in the given time range in a single streamed response, ordered by timestamp.
+        Memory usage stays flat no matter how big the time range is, because the transactions are read from a
+        server side cursor & written to the response one chunk at a time.
+        """
+        transactions_chunks = dal.iter_transactions(start_timestamp=start_timestamp,
+                                                    end_timestamp=end_timestamp,
+                                                    chunk_size=export_chunk_size)
+        content = iter_csv(transactions_chunks) if format == ExportFormat.csv else iter_ndjson(transactions_chunks)
+
+        logger.info('Exporting transactions', export_format=format.value)
+        return StreamingResponse(
+            content,
+            media_type=EXPORT_MEDIA_TYPES[format],
+            headers={'Content-Disposition': f'attachment; filename="transactions.{format.value}"'},
+            # Runs after the response ended, even if the client disconnected in the middle of it, so the server side
+            # cursor & its connection are released right away instead of when the iterator is garbage collected
+            background=BackgroundTask(content.close))
 
     return router
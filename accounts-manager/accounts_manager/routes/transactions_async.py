@@ -0,0 +1,151 @@
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query, status
+from structlog import get_logger
+
+from api_models.cursors import TransactionsCursor
+from api_models.transations import TransactionRequest, Transaction, TransactionsPage, PaginationMode, \
+    ReportCountStrategy
+from dal.async_dal import AsyncDal
+from dal.exceptions import IdempotencyKeyReusedError
+from metrics import count_transfer
+from dal.dal_models import DalTransactionDirection, DalTransactionStatus, DalTransaction
+from routes.pagination import decode_transactions_cursor, build_keyset_transactions_page, get_number_of_pages, \
+    get_snapshot_timestamp, DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT
+
+logger = get_logger()
+
+
+def get_router(dal: AsyncDal, report_snapshot_lag: float = 60) -> APIRouter:
+    """
+    Generates the async versions of the hot transactions routes, and returns the resulting router.
+    These routes run on the event loop instead of the thread pool, so they are not limited by the thread pool size.
+    When the router is included before the sync transactions router, these routes take precedence over the sync ones.
+    """
+    router = APIRouter()
+
+    @router.post('/api/v1/transaction', response_model=Transaction)
+    async def post_transaction(transaction_request: TransactionRequest,
+                               idempotency_key: Optional[str] = Header(default=None)) -> DalTransaction:
+        """
+        Creates a new transfer & attempts to transfer the funds between the specified bank accounts.
+        :param transaction_request: The details of the transfer request (the bank accounts, amount etc..)
+        :param idempotency_key: A unique key of the request (the Idempotency-Key header). Retrying a request
+            with the same key returns the original transaction instead of transferring the funds again
+        :return: The resulting Transaction, which includes the status specifying if
+                 the transaction was successful or not
+        """
+
+        direction = DalTransactionDirection(transaction_request.direction.value)
+        timestamp = datetime.now()
+
+        is_error = False
+        try:
+            dal_transaction = await dal.perform_transaction(
+                src_account_id=transaction_request.src_account_id,
+                dst_account_id=transaction_request.dst_account_id,
+                amount=transaction_request.amount,
+                direction=direction,
+                timestamp=timestamp,
+                idempotency_key=idempotency_key)
+        except IdempotencyKeyReusedError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+        except Exception as e:
+            failure_reason = f'Money transfer failed due to an unexpected error: {e}'
+            logger.exception(failure_reason)
+
+            is_error = True
+            dal_transaction = await dal.create_transaction(
+                src_account_id=transaction_request.src_account_id,
+                dst_account_id=transaction_request.dst_account_id,
+                amount=transaction_request.amount,
+                direction=direction,
+                status=DalTransactionStatus.fail,
+                reason=failure_reason,
+                timestamp=timestamp
+            )
+
+        logger.info('Transaction complete',
+                    is_successful=dal_transaction.status == DalTransactionStatus.successful,
+                    reason=dal_transaction.reason or None,
+                    transfer_attempts=dal_transaction.transfer_attempts)
+        count_transfer('transaction', dal_transaction=dal_transaction, is_error=is_error)
+
+        return dal_transaction
+
+    async def count_transactions(start_timestamp: datetime,
+                                 end_timestamp: datetime,
+                                 count: ReportCountStrategy) -> Optional[int]:
+        """Counts the transactions in the report using the requested count strategy"""
+        if count == ReportCountStrategy.exact:
+            return await dal.count_transactions(start_timestamp=start_timestamp,
+                                                end_timestamp=end_timestamp)
+        if count == ReportCountStrategy.estimate:
+            return await dal.estimate_transactions_count(start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+        return None
+
+    @router.get('/api/v1/transactions', response_model=TransactionsPage)
+    async def get_transactions(start_timestamp: datetime,
+                               end_timestamp: datetime,
+                               page: int = Query(0, ge=0),
+                               limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+                               pagination: PaginationMode = PaginationMode.page,
+                               cursor: Optional[str] = None,
+                               count: ReportCountStrategy = ReportCountStrategy.exact) -> TransactionsPage:
+        """
+        Returns a page of the transactions report.
+        To paginate with cursors, request the first page with pagination=cursor, & pass the next_cursor of every page
+        to get the next one, with the same time range. The cursor also fixes the snapshot of the report, so new
+        transactions do not show up while paginating (transactions show up report_snapshot_lag seconds after their
+        timestamp). The report is counted only on the first page, & the count is passed on in the cursor.
+        """
+        if pagination == PaginationMode.cursor or cursor:
+            if cursor:
+                transactions_cursor = decode_transactions_cursor(cursor,
+                                                                 start_timestamp=start_timestamp,
+                                                                 end_timestamp=end_timestamp)
+            else:
+                # The first page fixes the snapshot of the report, & counts it
+                transactions_cursor = TransactionsCursor(
+                    start_timestamp=start_timestamp,
+                    end_timestamp=end_timestamp,
+                    snapshot_timestamp=get_snapshot_timestamp(end_timestamp=end_timestamp,
+                                                              snapshot_lag=report_snapshot_lag))
+                transactions_cursor.total_items = await count_transactions(
+                    start_timestamp=start_timestamp,
+                    end_timestamp=transactions_cursor.get_report_end_timestamp(),
+                    count=count)
+
+            # Fetching one extra transaction tells if there is a next page
+            dal_transactions = await dal.get_transactions_page_after(
+                start_timestamp=start_timestamp,
+                end_timestamp=transactions_cursor.get_report_end_timestamp(),
+                after_timestamp=transactions_cursor.after_timestamp,
+                after_transaction_id=transactions_cursor.after_transaction_id,
+                limit=limit + 1)
+
+            return build_keyset_transactions_page(dal_transactions=dal_transactions,
+                                                  limit=limit,
+                                                  transactions_cursor=transactions_cursor)
+
+        dal_transactions = await dal.get_paginated_transactions(start_timestamp=start_timestamp,
+                                                                end_timestamp=end_timestamp,
+                                                                page=page,
+                                                                limit=limit)
+        total_count = await count_transactions(start_timestamp=start_timestamp,
+                                               end_timestamp=end_timestamp,
+                                               count=count)
+
+        transactions = [Transaction(**dal_transaction.dict(by_alias=True)) for dal_transaction in dal_transactions]
+        transactions_page = TransactionsPage(
+            items=transactions,
+            page=page,
+            limit=limit,
+            total_items=total_count,
+            number_of_pages=get_number_of_pages(total_items=total_count, limit=limit)
+        )
+
+        return transactions_page
+
+    return router
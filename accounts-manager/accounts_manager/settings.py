@@ -1,13 +1,130 @@
-from pydantic import BaseSettings, DirectoryPath, SecretStr
+from typing import Optional
+
+from pydantic import BaseSettings, DirectoryPath, SecretStr, PositiveInt, NonNegativeInt, PositiveFloat, \
+    NonNegativeFloat, confloat
+
+from dal.dal_models import DalPartitionInterval
+from dal.sqlalchemy.configuration import EngineProfileName, EngineProfile, get_engine_profile
 
 
 class Settings(BaseSettings):
     title: str = 'Accounts Manager'
     logs_dir: DirectoryPath = './logs'
     console_color_logs: bool = True
+    # Write the logs to the console as well as to the log files
+    log_to_console: bool = True
+    # Add the function name & line number of the log call to every log record. Walks the stack on every log call
+    log_callsite: bool = True
+    # Hand the log records to a background thread that formats & writes them, so requests never wait for log I/O.
+    # Recommended for production
+    log_non_blocking: bool = False
+    # The maximum number of log records waiting to be written when logging is non-blocking. Records logged while the
+    # queue is full are dropped
+    log_queue_size: PositiveInt = 10000
+
+    # The fraction (0-1) of the requests whose start & completion are logged. Failed requests & slow requests are
+    # always logged
+    request_log_sample_rate: confloat(ge=0, le=1) = 1
+    # Requests that take longer than this (seconds) are always logged
+    slow_request_threshold: NonNegativeFloat = 1
 
     db_connection_string: SecretStr
 
+    # The predefined set of database engine options to use (see dal/sqlalchemy/configuration.py).
+    # The development profile logs every statement
+    db_engine_profile: EngineProfileName = EngineProfileName.production
+    # The settings below override the options of the engine profile, unset settings keep the options of the profile
+    # The database driver, replacing the driver of the connection string (for example: psycopg2, implemented in C)
+    db_driver: Optional[str] = None
+    # Log every statement
+    db_echo: Optional[bool] = None
+    # The maximum time (milliseconds) a statement may run before the database cancels it
+    db_statement_timeout: Optional[PositiveInt] = None
+    # The number of database connections kept open in the connection pool
+    db_pool_size: Optional[PositiveInt] = None
+    # The number of connections that can be opened on top of the pool size, when all pooled connections are in use
+    db_max_overflow: Optional[NonNegativeInt] = None
+    # How long (seconds) a request waits for a free database connection before failing
+    db_pool_timeout: Optional[PositiveFloat] = None
+    # Test connections when they are taken from the pool, so stale connections are replaced instead of failing requests
+    db_pool_pre_ping: Optional[bool] = None
+    # The maximum age (seconds) of a pooled connection, after which it is replaced
+    db_pool_recycle: Optional[int] = None
+    # The number of compiled statements cached, so repeated statements are not compiled again
+    db_query_cache_size: Optional[NonNegativeInt] = None
+    # The number of rows inserted by a single statement in bulk inserts
+    db_insertmanyvalues_page_size: Optional[PositiveInt] = None
+    # How statements with many parameter sets are run (values_only / values_plus_batch), only supported by psycopg2
+    db_executemany_mode: Optional[str] = None
+
+    # Serve the hot transactions routes (perform transaction & transactions report) with async routes & an async
+    # database driver, instead of sync routes running in the thread pool
+    async_request_path: bool = False
+    # The asyncio database driver used by the async request path
+    async_db_driver: str = 'asyncpg'
+
+    # The ID of the account of the bank itself, which gives money to accounts & takes money from them in bank transactions
+    bank_account_id: Optional[str] = None
+    # The number of stripes the balance of the bank account is split into, so concurrent bank transactions do not wait
+    # for each other's lock on the bank account. 0 keeps the whole balance in the account row
+    bank_account_stripes: NonNegativeInt = 0
+
+    # The time range of transactions stored in every partition of the transactions table
+    transactions_partition_interval: DalPartitionInterval = DalPartitionInterval.daily
+    # The number of future partitions created ahead of time
+    transactions_partitions_premake: NonNegativeInt = 7
+    # Partitions older than this many days are exported to the archive directory & dropped. 0 disables archiving
+    transactions_archive_after_days: NonNegativeInt = 30
+    # The directory that archived partitions are written to (as gzip compressed CSV files)
+    transactions_archive_dir: str = './archive'
+    # How often (seconds) the partitions maintenance runs in the background. 0 disables the background maintenance
+    partition_maintenance_interval: NonNegativeFloat = 3600
+
+    # How often (seconds) the recent transactions are rolled up for the transactions summary. 0 disables the rollups
+    # in the background (the summary is then aggregated from the transactions table)
+    transaction_rollups_interval: NonNegativeFloat = 60
+    # How long (seconds) after their timestamp transactions are rolled up. Must be longer than a money transfer can
+    # take to commit, since transactions committed after their minute was rolled up are left out of the rollups
+    transaction_rollups_lag: NonNegativeInt = 120
+
+    # How many times a money transfer is attempted when it conflicts with concurrent transfers on the same accounts
+    transfer_max_attempts: PositiveInt = 5
+    # The base delay (in seconds) of the jittered exponential backoff between transfer attempts
+    transfer_retry_base_delay: NonNegativeFloat = 0.05
+    # The maximum number of transfers of a batch request that are committed together in a single database transaction
+    transfers_batch_chunk_size: PositiveInt = 500
+    # How long (seconds) the exact total count of a transactions report (paginated by page numbers) is cached for
+    report_count_cache_ttl: NonNegativeFloat = 30
+    # How long (seconds) after their timestamp transactions show up in a report paginated with cursors. Must be longer
+    # than a money transfer can take to commit, so transactions do not show up in a report after its first page
+    report_snapshot_lag: NonNegativeFloat = 60
+    # The number of recently used idempotency keys (& their transactions) kept in memory, so retried requests are
+    # answered without a database round trip
+    idempotency_cache_size: PositiveInt = 10000
+    # How long (hours) idempotency keys are kept, so requests retried within this period are not performed twice.
+    # Expired keys are deleted by the partitions maintenance. 0 keeps the keys forever
+    idempotency_keys_retention_hours: NonNegativeInt = 24
+    # How long (seconds) account balances are cached for, both by the API & by clients (Cache-Control max-age).
+    # Cached balances are evicted whenever a transfer of the account commits in the same process
+    account_balance_cache_ttl: NonNegativeInt = 1
+    # The number of transactions fetched from the database at a time when exporting transactions
+    export_chunk_size: PositiveInt = 1000
+
+    def get_db_engine_profile(self) -> EngineProfile:
+        """The options of the database engine: the engine profile, overridden by the database settings"""
+        return get_engine_profile(self.db_engine_profile,
+                                  driver=self.db_driver,
+                                  echo=self.db_echo,
+                                  statement_timeout=self.db_statement_timeout,
+                                  pool_size=self.db_pool_size,
+                                  max_overflow=self.db_max_overflow,
+                                  pool_timeout=self.db_pool_timeout,
+                                  pool_pre_ping=self.db_pool_pre_ping,
+                                  pool_recycle=self.db_pool_recycle,
+                                  query_cache_size=self.db_query_cache_size,
+                                  insertmanyvalues_page_size=self.db_insertmanyvalues_page_size,
+                                  executemany_mode=self.db_executemany_mode)
+
     class Config:
         env_file = '.env'
         env_file_encoding = 'utf-8'
@@ -0,0 +1,54 @@
+"""
+Rolls up the recent transactions into the per minute rollups used by the transactions summary.
+Runs periodically in the background of the API, & can also be run manually (for example to catch up after downtime):
+    python3 transaction_rollups.py
+"""
+
+from datetime import timedelta
+import threading
+
+from structlog import get_logger
+
+from settings import Settings
+from dal.dal import Dal
+
+logger = get_logger()
+
+
+def run_transaction_rollups(dal: Dal, settings: Settings) -> None:
+    """Rolls up all the transactions that were not rolled up yet (up to the configured lag before now)"""
+    watermark = dal.refresh_transaction_rollups(lag=timedelta(seconds=settings.transaction_rollups_lag))
+    logger.debug('Transactions rolled up', rolled_up_until=watermark)
+
+
+class TransactionRollupsThread(threading.Thread):
+    """A background thread rolling up the transactions every interval, until it is stopped"""
+
+    def __init__(self, dal: Dal, settings: Settings):
+        super().__init__(name='transaction-rollups', daemon=True)
+        self.__dal = dal
+        self.__settings = settings
+        self.__stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.__stopped.wait(self.__settings.transaction_rollups_interval):
+            try:
+                run_transaction_rollups(dal=self.__dal, settings=self.__settings)
+            except Exception:
+                # The watermark did not move, so the same transactions are rolled up in the next interval
+                logger.exception('Transactions rollup failed')
+
+    def stop(self) -> None:
+        self.__stopped.set()
+
+
+if __name__ == '__main__':
+    from configure_logging import configure_logging
+
+    _settings = Settings()
+    configure_logging(_settings)
+
+    _dal = Dal()
+    _dal.initiate_connection(_settings.db_connection_string.get_secret_value(),
+                             engine_profile=_settings.get_db_engine_profile())
+    run_transaction_rollups(dal=_dal, settings=_settings)
@@ -0,0 +1,9 @@
+"""
+The service modules import each other by absolute imports from the service directory (the directory it runs from), so
+the tests import them the same way
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'accounts_manager'))
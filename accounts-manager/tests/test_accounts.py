@@ -0,0 +1,18 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+from dal.dal import Dal
+from routes.accounts import get_router
+from routes.pagination import MAX_PAGE_LIMIT
+
+
+@pytest.mark.parametrize('limit', [0, -1, MAX_PAGE_LIMIT + 1])
+def test_the_account_transactions_reject_invalid_limits(limit):
+    app = FastAPI()
+    # The parameters are validated before the DAL is used, so it is not connected to a database
+    app.include_router(get_router(dal=Dal()))
+
+    response = TestClient(app).get('/api/v1/accounts/1/transactions', params={'limit': limit})
+
+    assert response.status_code == 422
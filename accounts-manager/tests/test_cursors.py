@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from api_models.cursors import TransactionsCursor
+
+START = datetime(2023, 7, 11)
+END = datetime(2023, 7, 12)
+
+
+def test_encode_decode_round_trip():
+    cursor = TransactionsCursor(start_timestamp=START,
+                                end_timestamp=END,
+                                snapshot_timestamp=datetime(2023, 7, 11, 18, 30, 0, 123456),
+                                after_timestamp=datetime(2023, 7, 11, 9, 15, 0, 654321),
+                                after_transaction_id=42,
+                                total_items=1000)
+
+    assert TransactionsCursor.decode(cursor.encode()) == cursor
+
+
+def test_encode_decode_round_trip_keeps_the_time_zone():
+    start = datetime(2023, 7, 11, tzinfo=timezone(timedelta(hours=3)))
+    cursor = TransactionsCursor(start_timestamp=start,
+                                end_timestamp=start + timedelta(days=1),
+                                snapshot_timestamp=start + timedelta(hours=12),
+                                after_timestamp=None,
+                                after_transaction_id=None,
+                                total_items=None)
+
+    decoded_cursor = TransactionsCursor.decode(cursor.encode())
+    assert decoded_cursor == cursor
+    assert decoded_cursor.start_timestamp.utcoffset() == timedelta(hours=3)
+
+
+@pytest.mark.parametrize('encoded_cursor', ['not base64!', 'e30=', 'bm90IGpzb24='])
+def test_decode_rejects_invalid_cursors(encoded_cursor):
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        TransactionsCursor.decode(encoded_cursor)
+
+
+def test_the_report_ends_at_the_snapshot_if_it_is_earlier():
+    snapshot_timestamp = datetime(2023, 7, 11, 18)
+    cursor = TransactionsCursor(start_timestamp=START, end_timestamp=END, snapshot_timestamp=snapshot_timestamp)
+
+    assert cursor.get_report_end_timestamp() == snapshot_timestamp
+
+
+def test_the_report_ends_at_the_end_of_its_range_if_the_snapshot_is_later():
+    cursor = TransactionsCursor(start_timestamp=START, end_timestamp=END, snapshot_timestamp=END + timedelta(hours=1))
+
+    assert cursor.get_report_end_timestamp() == END
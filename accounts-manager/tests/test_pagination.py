@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+import pytest
+
+from api_models.cursors import TransactionsCursor
+from dal.dal import Dal
+from dal.dal_models import DalTransaction, DalTransactionDirection, DalTransactionStatus
+from routes.pagination import decode_transactions_cursor, build_keyset_transactions_page, get_number_of_pages, \
+    get_snapshot_timestamp, MAX_PAGE_LIMIT
+from routes.transactions import get_router
+
+START = datetime(2023, 7, 11)
+END = datetime(2023, 7, 12)
+
+
+def get_transaction(transaction_id: int, timestamp: datetime) -> DalTransaction:
+    return DalTransaction(id=str(transaction_id),
+                          src_account_id='1',
+                          dst_account_id='2',
+                          timestamp=timestamp,
+                          amount=10,
+                          direction=DalTransactionDirection.debit,
+                          status=DalTransactionStatus.successful,
+                          reason='',
+                          description=None)
+
+
+def get_first_cursor(snapshot_timestamp: datetime = END, total_items: Optional[int] = None) -> TransactionsCursor:
+    return TransactionsCursor(start_timestamp=START,
+                              end_timestamp=END,
+                              snapshot_timestamp=snapshot_timestamp,
+                              total_items=total_items)
+
+
+def get_transactions_page_after(transactions: List[DalTransaction],
+                                start_timestamp: datetime,
+                                end_timestamp: datetime,
+                                after_timestamp: Optional[datetime],
+                                after_transaction_id: Optional[int],
+                                limit: int) -> List[DalTransaction]:
+    """The keyset page query of the DAL (see transactions_keyset_page_statement), over a list of transactions"""
+    page = sorted((transaction for transaction in transactions
+                   if start_timestamp <= transaction.timestamp < end_timestamp),
+                  key=lambda transaction: (transaction.timestamp, int(transaction.transaction_id)))
+    if after_timestamp is not None and after_transaction_id is not None:
+        page = [transaction for transaction in page
+                if (transaction.timestamp, int(transaction.transaction_id)) > (after_timestamp, after_transaction_id)]
+    return page[:limit]
+
+
+def paginate(transactions: List[DalTransaction], limit: int, snapshot_timestamp: datetime) -> List[List[str]]:
+    """Paginates through the report with cursors, like a client does, & returns the IDs of every page"""
+    pages = []
+    cursor: Optional[str] = None
+    while True:
+        if cursor:
+            transactions_cursor = decode_transactions_cursor(cursor, start_timestamp=START, end_timestamp=END)
+        else:
+            transactions_cursor = get_first_cursor(snapshot_timestamp=snapshot_timestamp)
+
+        dal_transactions = get_transactions_page_after(
+            transactions,
+            start_timestamp=START,
+            end_timestamp=transactions_cursor.get_report_end_timestamp(),
+            after_timestamp=transactions_cursor.after_timestamp,
+            after_transaction_id=transactions_cursor.after_transaction_id,
+            limit=limit + 1)
+        page = build_keyset_transactions_page(dal_transactions=dal_transactions,
+                                              limit=limit,
+                                              transactions_cursor=transactions_cursor)
+        pages.append([transaction.transaction_id for transaction in page.items])
+
+        cursor = page.next_cursor
+        if cursor is None:
+            return pages
+
+
+def test_keyset_pagination_returns_every_transaction_once_in_order():
+    # Transactions sharing a timestamp are ordered by ID, across page boundaries
+    transactions = [get_transaction(transaction_id, START + timedelta(minutes=transaction_id // 3))
+                    for transaction_id in range(1, 11)]
+
+    pages = paginate(transactions, limit=3, snapshot_timestamp=END)
+
+    assert pages == [['1', '2', '3'], ['4', '5', '6'], ['7', '8', '9'], ['10']]
+
+
+def test_keyset_pagination_excludes_transactions_from_the_snapshot_on():
+    snapshot_timestamp = START + timedelta(hours=1)
+    transactions = [get_transaction(1, START),
+                    get_transaction(2, snapshot_timestamp - timedelta(microseconds=1)),
+                    get_transaction(3, snapshot_timestamp),
+                    # A lower ID, committed after the first page (its ID does not matter, only its timestamp)
+                    get_transaction(0, snapshot_timestamp + timedelta(seconds=1))]
+
+    assert paginate(transactions, limit=1, snapshot_timestamp=snapshot_timestamp) == [['1'], ['2']]
+
+
+def test_the_last_page_has_no_next_cursor():
+    transactions = [get_transaction(1, START), get_transaction(2, START)]
+
+    page = build_keyset_transactions_page(dal_transactions=transactions,
+                                          limit=2,
+                                          transactions_cursor=get_first_cursor())
+
+    assert page.next_cursor is None
+    assert len(page.items) == 2
+
+
+def test_the_next_cursor_continues_after_the_last_transaction_of_the_page():
+    snapshot_timestamp = START + timedelta(hours=1)
+    transactions = [get_transaction(1, START), get_transaction(2, START + timedelta(seconds=1)),
+                    get_transaction(3, START + timedelta(seconds=2))]
+
+    page = build_keyset_transactions_page(dal_transactions=transactions,
+                                          limit=2,
+                                          transactions_cursor=get_first_cursor(snapshot_timestamp=snapshot_timestamp,
+                                                                               total_items=3))
+
+    assert len(page.items) == 2
+    assert page.total_items == 3
+    assert page.number_of_pages == 2
+    next_cursor = TransactionsCursor.decode(page.next_cursor)
+    assert (next_cursor.after_timestamp, next_cursor.after_transaction_id) == (START + timedelta(seconds=1), 2)
+    # The time range, snapshot & count of the report are passed on to the next pages
+    assert (next_cursor.start_timestamp, next_cursor.end_timestamp) == (START, END)
+    assert next_cursor.snapshot_timestamp == snapshot_timestamp
+    assert next_cursor.total_items == 3
+
+
+def test_decode_rejects_a_cursor_of_a_different_time_range():
+    cursor = get_first_cursor().encode()
+
+    with pytest.raises(HTTPException) as exc_info:
+        decode_transactions_cursor(cursor, start_timestamp=START, end_timestamp=END + timedelta(days=1))
+    assert exc_info.value.status_code == 400
+
+
+def test_decode_rejects_an_invalid_cursor():
+    with pytest.raises(HTTPException) as exc_info:
+        decode_transactions_cursor('not a cursor', start_timestamp=START, end_timestamp=END)
+    assert exc_info.value.status_code == 400
+
+
+def test_snapshot_timestamp_is_in_the_time_zone_of_the_report():
+    naive_snapshot_timestamp = get_snapshot_timestamp(end_timestamp=END, snapshot_lag=60)
+    aware_snapshot_timestamp = get_snapshot_timestamp(end_timestamp=END.replace(tzinfo=timezone.utc), snapshot_lag=60)
+
+    assert naive_snapshot_timestamp.tzinfo is None
+    assert aware_snapshot_timestamp.tzinfo == timezone.utc
+    assert datetime.now() - timedelta(seconds=61) < naive_snapshot_timestamp <= datetime.now() - timedelta(seconds=60)
+
+
+@pytest.mark.parametrize('total_items, limit, number_of_pages',
+                         [(0, 10, 0), (10, 10, 1), (11, 10, 2), (None, 10, None)])
+def test_number_of_pages(total_items, limit, number_of_pages):
+    assert get_number_of_pages(total_items=total_items, limit=limit) == number_of_pages
+
+
+@pytest.mark.parametrize('params', [{'limit': 0}, {'limit': MAX_PAGE_LIMIT + 1}, {'page': -1}])
+def test_the_transactions_report_rejects_invalid_page_parameters(params):
+    app = FastAPI()
+    # The parameters are validated before the DAL is used, so it is not connected to a database
+    app.include_router(get_router(dal=Dal()))
+
+    response = TestClient(app).get('/api/v1/transactions',
+                                   params={'start_timestamp': START.isoformat(), 'end_timestamp': END.isoformat(),
+                                           **params})
+
+    assert response.status_code == 422
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine, text, insert
+
+from dal.dal_models import DalFailureCategory
+from dal.sqlalchemy import models as sqlalchemy_models
+from dal.sqlalchemy.rollups import get_summary_ranges, summarize_rollups_statement, summarize_transactions_statement
+
+START = datetime(2023, 7, 11, 10, 0, 30)
+END = datetime(2023, 7, 11, 12, 0, 30)
+WATERMARK = datetime(2023, 7, 11, 11)
+
+
+def test_summary_ranges_are_split_at_the_buckets_before_the_watermark():
+    rollups_range, transactions_ranges = get_summary_ranges(START, END, WATERMARK)
+
+    assert rollups_range == (datetime(2023, 7, 11, 10, 1), WATERMARK)
+    assert transactions_ranges == [(START, datetime(2023, 7, 11, 10, 1)), (WATERMARK, END)]
+
+
+def test_summary_ranges_of_a_time_zone_aware_range_are_in_naive_local_time():
+    aware_start = START.astimezone().astimezone(timezone(timedelta(hours=5)))
+    aware_end = END.astimezone().astimezone(timezone.utc)
+
+    assert get_summary_ranges(aware_start, aware_end, WATERMARK) == get_summary_ranges(START, END, WATERMARK)
+
+
+def test_summary_ranges_without_a_watermark_are_read_from_the_transactions():
+    assert get_summary_ranges(START.astimezone(), END.astimezone(), None) == (None, [(START, END)])
+
+
+@pytest.fixture
+def connection():
+    engine = create_engine('sqlite://')
+    with engine.connect() as connection:
+        # The partitioned transactions table (with its composite primary key) can not be created by SQLite
+        connection.execute(text('CREATE TABLE "transaction" (id INTEGER, timestamp DATETIME, src_account_id INTEGER, '
+                                'dst_account_id INTEGER, amount FLOAT, direction VARCHAR, status VARCHAR, '
+                                'reason VARCHAR, description VARCHAR)'))
+        sqlalchemy_models.TransactionRollup.__table__.create(connection)
+        yield connection
+
+
+@pytest.mark.parametrize('reason, category', [
+    ('Insufficient funds in the source account', DalFailureCategory.insufficient_funds),
+    ('Transfer of funds denied. reason: Source account with ID 17 does not exist',
+     DalFailureCategory.account_not_found),
+    ('Source and destination accounts must be different accounts', DalFailureCategory.same_account),
+    ('The bank can not make a transaction with itself', DalFailureCategory.same_account),
+    ('Money transfer failed due to an unexpected error: connection reset', DalFailureCategory.unexpected_error),
+    ('Something else', DalFailureCategory.other),
+    (None, DalFailureCategory.other),
+])
+def test_transactions_are_summed_up_by_failure_category(connection, reason, category):
+    for transaction_id, src_account_id in enumerate([17, 18], start=1):
+        connection.execute(insert(sqlalchemy_models.Transaction.__table__).values(
+            id=transaction_id, timestamp=START, src_account_id=src_account_id, dst_account_id=1, amount=10,
+            direction='debit', status='fail', reason=reason and reason.replace('17', str(src_account_id))))
+
+    rows = connection.execute(summarize_transactions_statement(START, END)).all()
+
+    assert [(row.status, row.reason, row.transactions_count) for row in rows] == [('fail', category.value, 2)]
+
+
+def test_successful_transactions_have_no_failure_category(connection):
+    connection.execute(insert(sqlalchemy_models.Transaction.__table__).values(
+        id=1, timestamp=START, src_account_id=1, dst_account_id=2, amount=10, direction='debit', status='successful',
+        reason=''))
+
+    rows = connection.execute(summarize_transactions_statement(START, END)).all()
+
+    assert [(row.status, row.reason) for row in rows] == [('successful', '')]
+
+
+def test_rollups_of_failure_reasons_are_summed_up_by_failure_category(connection):
+    # Rollups written before the failure reasons were categorized are categorized when they are summed up
+    rollup = sqlalchemy_models.TransactionRollup.__table__
+    connection.execute(insert(rollup), [
+        dict(bucket_start=WATERMARK, status='fail', direction='debit', transactions_count=1, amount_sum=10,
+             reason='Insufficient funds in the source account'),
+        dict(bucket_start=WATERMARK, status='fail', direction='debit', transactions_count=2, amount_sum=20,
+             reason=DalFailureCategory.insufficient_funds.value)])
+
+    rows = connection.execute(summarize_rollups_statement(START, END)).all()
+
+    assert [(row.reason, row.transactions_count, row.amount_sum) for row in rows] == \
+        [(DalFailureCategory.insufficient_funds.value, 3, 30)]
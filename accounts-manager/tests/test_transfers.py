@@ -0,0 +1,52 @@
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from dal.dal import Dal
+from dal.dal_models import DalTransactionDirection, DalTransferRequest
+from dal.sqlalchemy import models as sqlalchemy_models
+from dal.sqlalchemy.statements import lock_accounts_statement
+from dal.transfers import get_denial_reason, get_account_lock_order_key
+
+STRIPED_ACCOUNT_REASON = "Account with ID 1 is striped & only takes part in bank transactions"
+
+
+def test_transfers_of_missing_accounts_are_denied_before_striped_accounts():
+    assert get_denial_reason(src_account_id='1', dst_account_id='2', paying_account_id='1',
+                             existing_account_ids={'1'}, striped_account_ids={'1'}) == \
+        "Destination account with ID 2 does not exist"
+
+
+def test_transfers_of_striped_accounts_are_denied():
+    assert get_denial_reason(src_account_id='2', dst_account_id='1', paying_account_id='2',
+                             existing_account_ids={'1', '2'}, striped_account_ids={'1'}) == STRIPED_ACCOUNT_REASON
+
+
+def test_transfers_without_enough_funds_are_denied():
+    assert get_denial_reason(src_account_id='1', dst_account_id='2', paying_account_id='2',
+                             existing_account_ids={'1', '2'}) == "Insufficient funds in the destination account"
+
+
+def test_batch_transfers_of_striped_accounts_are_denied_without_moving_funds():
+    accounts_by_id = {'1': sqlalchemy_models.BankAccount(id=1, balance=0, stripes=4),
+                      '2': sqlalchemy_models.BankAccount(id=2, balance=100, stripes=0)}
+    transfer = DalTransferRequest(src_account_id='2', dst_account_id='1', amount=10,
+                                  direction=DalTransactionDirection.debit)
+
+    assert Dal._apply_transfer(transfer=transfer, accounts_by_id=accounts_by_id) == STRIPED_ACCOUNT_REASON
+    assert accounts_by_id['2'].balance == 100
+
+
+def test_only_the_bank_account_can_be_striped():
+    # The account is checked before the DAL is used, so it is not connected to a database
+    with pytest.raises(ValueError, match='only the bank account can be striped'):
+        Dal(bank_account_id='1').stripe_account(account_id='2', stripes=4)
+
+
+def test_accounts_are_locked_in_the_order_of_their_numeric_ids():
+    assert sorted(['10', 'x', '9', '1'], key=get_account_lock_order_key) == ['1', '9', '10', 'x']
+
+
+def test_transfers_lock_their_accounts_in_ascending_id_order():
+    sql = str(lock_accounts_statement([2, 1]).compile(dialect=postgresql.dialect()))
+
+    assert sql.endswith('ORDER BY bank_account.id FOR UPDATE')
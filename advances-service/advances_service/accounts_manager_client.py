@@ -0,0 +1,193 @@
+"""
+A client of the accounts-manager API, which moves the money of the advances between the bank & the accounts.
+Every process (API worker / Celery worker child) keeps a single client (see get_accounts_manager_client), which keeps
+its connections to accounts-manager open between requests.
+"""
+
+import os
+import random
+import time
+from typing import List, Optional, Dict, Any
+
+from pydantic import parse_obj_as, ValidationError
+import requests
+from requests.adapters import HTTPAdapter
+from structlog import get_logger
+
+from api_models.accounts_manager import BankTransactionRequest, BankTransaction
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from settings import Settings
+
+logger = get_logger()
+
+# Responses with this status code (& server errors, 5xx) mean accounts-manager is saturated / failing, so they count as
+# failures of the circuit breaker & the request can be retried
+TOO_MANY_REQUESTS_STATUS_CODE = 429
+
+
+def is_retryable_status_code(status_code: int) -> bool:
+    return status_code == TOO_MANY_REQUESTS_STATUS_CODE or status_code >= 500
+
+
+class AccountsManagerError(Exception):
+    """The accounts-manager API failed to handle a request"""
+
+
+class AccountsManagerUnavailableError(AccountsManagerError):
+    """
+    Accounts-manager could not be reached (or is saturated), even after retrying, or its circuit is open.
+    A request that timed out may have been handled, so it must be retried with the same idempotency keys
+    """
+
+
+class AccountsManagerClient:
+
+    def __init__(self,
+                 base_url: str,
+                 connect_timeout: float = 2,
+                 read_timeout: float = 30,
+                 pool_size: int = 10,
+                 max_retries: int = 2,
+                 retry_base_delay: float = 0.2,
+                 circuit_breaker: Optional[CircuitBreaker] = None):
+        """
+        :param base_url: The URL of the accounts-manager API (for example: http://accounts-manager:8000)
+        :param connect_timeout: How long (seconds) to wait for a connection to accounts-manager
+        :param read_timeout: How long (seconds) to wait for a response
+        :param pool_size: The maximum number of open (keep-alive) connections, should match the number of threads
+            sending requests concurrently
+        :param max_retries: The maximum number of times a failed request (connection errors, timeouts, server errors &
+            429 responses) is retried. Only requests with idempotency keys are retried
+        :param retry_base_delay: The base delay (seconds) of the exponential backoff between retries
+        :param circuit_breaker: Fails requests fast after accounts-manager failed too many times in a row.
+            Defaults to a circuit breaker opening after 5 failures for 30 seconds
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(name='accounts-manager')
+
+        self.__session = requests.Session()
+        # Requests are retried by the client, so the retries go through the circuit breaker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+
+    def _post(self, path: str, body: Any, is_idempotent: bool, headers: Optional[Dict[str, str]] = None) -> Any:
+        """
+        Sends a POST request, retrying it (if idempotent) with a jittered exponential backoff while accounts-manager is
+        unavailable, & returns the JSON payload of the response
+        :raises AccountsManagerUnavailableError: If accounts-manager is unavailable / failing, or its circuit is open
+        :raises AccountsManagerError: If accounts-manager rejected the request, or its response is invalid
+        """
+        max_attempts = self.max_retries + 1 if is_idempotent else 1
+        for attempt in range(1, max_attempts + 1):
+            try:
+                self.circuit_breaker.before_call()
+            except CircuitOpenError as e:
+                raise AccountsManagerUnavailableError(str(e)) from e
+
+            try:
+                response = self.__session.post(f'{self.base_url}{path}', json=body, headers=headers,
+                                               timeout=self.timeout)
+            except requests.RequestException as e:
+                failure_reason = f'{type(e).__name__}: {e}'
+            else:
+                if not is_retryable_status_code(response.status_code):
+                    # Accounts-manager handled the request (even if it rejected it), so it is available
+                    self.circuit_breaker.record_success()
+                    if not response.ok:
+                        raise AccountsManagerError(f'Request to {path} failed with status code {response.status_code}: '
+                                                   f'{response.text}')
+                    try:
+                        return response.json()
+                    except ValueError as e:
+                        raise AccountsManagerError(f'Request to {path} returned an invalid JSON response: '
+                                                   f'{response.text[:200]}') from e
+                failure_reason = f'status code {response.status_code}'
+
+            self.circuit_breaker.record_failure()
+            if attempt >= max_attempts:
+                raise AccountsManagerUnavailableError(f'Request to {path} failed after {attempt} attempts, '
+                                                      f'reason: {failure_reason}')
+
+            # Full jitter, so that clients do not retry in lock step
+            retry_delay = random.uniform(0, self.retry_base_delay * 2 ** (attempt - 1))
+            logger.warning('Request to accounts-manager failed, retrying',
+                           path=path,
+                           attempt=attempt,
+                           max_attempts=max_attempts,
+                           retry_delay=retry_delay,
+                           reason=failure_reason)
+            time.sleep(retry_delay)
+
+    def perform_bank_transaction(self, bank_transaction_request: BankTransactionRequest) -> BankTransaction:
+        """
+        Gives money from the bank to an account (for example: granting an advance), or takes money from an account.
+        Retried only when the request has an idempotency key
+        :return: The resulting bank transaction, with a status specifying if it was successful or not
+        :raises AccountsManagerError: If the request failed
+        """
+        headers = {}
+        if bank_transaction_request.idempotency_key:
+            headers['Idempotency-Key'] = bank_transaction_request.idempotency_key
+
+        payload = self._post('/api/v1/bank_transactions',
+                             body=bank_transaction_request.dict(exclude={'idempotency_key'}),
+                             is_idempotent=bool(bank_transaction_request.idempotency_key),
+                             headers=headers)
+        try:
+            return BankTransaction.parse_obj(payload)
+        except ValidationError as e:
+            raise AccountsManagerError(f'Invalid bank transaction response: {e}') from e
+
+    def perform_bank_transactions_batch(
+            self, bank_transaction_requests: List[BankTransactionRequest]) -> List[BankTransaction]:
+        """
+        Performs a batch of bank transactions with a single request. Every bank transaction succeeds or fails on its
+        own, & bank transactions whose idempotency key was already used are not performed again.
+        Retried only when all the bank transactions have idempotency keys
+        :return: The resulting bank transactions, in the same order as the requests
+        :raises AccountsManagerError: If the request failed
+        """
+        payload = self._post('/api/v1/bank_transactions/batch',
+                             body=[bank_transaction_request.dict()
+                                   for bank_transaction_request in bank_transaction_requests],
+                             is_idempotent=all(bank_transaction_request.idempotency_key
+                                               for bank_transaction_request in bank_transaction_requests))
+        try:
+            bank_transactions = parse_obj_as(List[BankTransaction], payload)
+        except ValidationError as e:
+            raise AccountsManagerError(f'Invalid bank transactions batch response: {e}') from e
+
+        if len(bank_transactions) != len(bank_transaction_requests):
+            raise AccountsManagerError(f'The bank transactions batch response has {len(bank_transactions)} bank '
+                                       f'transactions, instead of {len(bank_transaction_requests)}')
+        return bank_transactions
+
+    def close(self) -> None:
+        """Closes the open connections"""
+        self.__session.close()
+
+
+# The client of every process, by process ID. Connections can not be shared with forked processes (Celery worker
+# children), so every process creates its own client
+_clients: Dict[int, AccountsManagerClient] = {}
+
+
+def get_accounts_manager_client(settings: Settings) -> AccountsManagerClient:
+    """Returns the accounts-manager client of the current process, creating it on first use"""
+    pid = os.getpid()
+    if pid not in _clients:
+        _clients[pid] = AccountsManagerClient(
+            base_url=settings.accounts_manager_url,
+            connect_timeout=settings.accounts_manager_connect_timeout,
+            read_timeout=settings.accounts_manager_read_timeout,
+            pool_size=settings.accounts_manager_pool_size,
+            max_retries=settings.accounts_manager_max_retries,
+            retry_base_delay=settings.accounts_manager_retry_base_delay,
+            circuit_breaker=CircuitBreaker(name='accounts-manager',
+                                           failure_threshold=settings.accounts_manager_circuit_failure_threshold,
+                                           reset_timeout=settings.accounts_manager_circuit_reset_timeout))
+    return _clients[pid]
@@ -0,0 +1,124 @@
+"""
+A local stand-in of the accounts-manager bank transactions API, for running advances-service (& its Celery workers)
+without accounts-manager & its database. It can add latency, fail requests & deny bank transactions, to see how the
+accounts-manager client behaves when accounts-manager is slow or saturated.
+
+Usage (from the advances_service directory):
+    python3 accounts_manager_stub.py --port 8000 --latency 0.05 --unavailable-rate 0.1
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional
+
+
+class StubState:
+    """The behaviour of the stub, & the bank transactions it performed by idempotency key"""
+
+    def __init__(self, latency: float, unavailable_rate: float, deny_rate: float):
+        self.latency = latency
+        self.unavailable_rate = unavailable_rate
+        self.deny_rate = deny_rate
+        self.bank_transactions: Dict[str, dict] = {}
+        self.requests_count = 0
+        self.lock = threading.Lock()
+
+    def perform_bank_transaction(self, bank_transaction_request: dict, idempotency_key: Optional[str]) -> dict:
+        with self.lock:
+            if idempotency_key and idempotency_key in self.bank_transactions:
+                return self.bank_transactions[idempotency_key]
+
+            is_denied = random.random() < self.deny_rate
+            bank_transaction = {
+                'transaction_id': str(uuid.uuid4()),
+                'timestamp': datetime.now().isoformat(),
+                'dst_account_id': bank_transaction_request['dst_account_id'],
+                'amount': bank_transaction_request['amount'],
+                'direction': bank_transaction_request['direction'],
+                'status': 'fail' if is_denied else 'successful',
+                'reason': 'Denied by the accounts-manager stub' if is_denied else None,
+                'description': bank_transaction_request.get('reason'),
+            }
+            if idempotency_key:
+                self.bank_transactions[idempotency_key] = bank_transaction
+            return bank_transaction
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like uvicorn, so the connection pooling of the client is exercised
+    protocol_version = 'HTTP/1.1'
+    # The headers & the body are written separately, so without this every response waits for a delayed ACK
+    disable_nagle_algorithm = True
+    state: StubState
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        with self.state.lock:
+            self.state.requests_count += 1
+
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+        if random.random() < self.state.unavailable_rate:
+            self._send_json(503, {'detail': 'The accounts-manager stub is unavailable'})
+        elif self.path == '/api/v1/bank_transactions':
+            self._send_json(200, self.state.perform_bank_transaction(body, self.headers.get('Idempotency-Key')))
+        elif self.path == '/api/v1/bank_transactions/batch':
+            self._send_json(200, [self.state.perform_bank_transaction(bank_transaction_request,
+                                                                      bank_transaction_request.get('idempotency_key'))
+                                  for bank_transaction_request in body])
+        else:
+            self._send_json(404, {'detail': 'Not Found'})
+
+    def _send_json(self, status_code: int, payload) -> None:
+        response_body = json.dumps(payload).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        # Every request is counted instead of logged, so the stub does not slow down load tests
+        pass
+
+
+def run_stub_server(host: str, port: int, state: StubState) -> ThreadingHTTPServer:
+    """Starts the stub server on a background thread, & returns it (stop it with shutdown())"""
+    handler_class = type('BoundStubRequestHandler', (StubRequestHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every request')
+    parser.add_argument('--unavailable-rate', type=float, default=0,
+                        help='The fraction (0-1) of the requests answered with 503 Service Unavailable')
+    parser.add_argument('--deny-rate', type=float, default=0,
+                        help='The fraction (0-1) of the bank transactions that fail')
+    args = parser.parse_args()
+
+    state = StubState(latency=args.latency, unavailable_rate=args.unavailable_rate, deny_rate=args.deny_rate)
+    server = run_stub_server(args.host, args.port, state)
+    print(f'Accounts-manager stub listening on http://{args.host}:{args.port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f'Served {state.requests_count} requests')
+
+
+if __name__ == '__main__':
+    main()
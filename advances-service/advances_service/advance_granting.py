@@ -0,0 +1,54 @@
+"""
+Granting advances: giving the money of a pending_transaction advance to its account with a bank transaction of
+accounts-manager, & activating the advance. Done by the API (synchronous granting) or by the grant_advance Celery task
+(asynchronous granting)
+"""
+
+from structlog import get_logger
+
+from accounts_manager_client import AccountsManagerClient
+from api_models.accounts_manager import BankTransactionRequest, TransactionDirection, TransactionStatus
+from dal.dal import Dal
+from dal import dal_models as dal_models
+
+logger = get_logger()
+
+# The name of the Celery task granting advances, which the API sends without importing the Celery node
+GRANT_ADVANCE_TASK_NAME = 'grant_advance'
+
+
+def get_advance_grant_idempotency_key(advance: dal_models.DalAdvance) -> str:
+    """The idempotency key of the bank transaction granting the advance, so an advance is never granted twice"""
+    return f'advance-grant-{advance.advance_id}'
+
+
+def grant_advance(dal: Dal, accounts_manager_client: AccountsManagerClient,
+                  advance: dal_models.DalAdvance) -> dal_models.DalAdvance:
+    """
+    Gives the money of a pending_transaction advance to its account. If the bank transaction succeeds the advance is
+    activated together with its payments, & if it is denied the advance fails.
+    Granting the same advance again (after a failure) never gives the money twice, thanks to the idempotency key
+    :return: The advance after granting it
+    :raises AccountsManagerError: If accounts-manager failed, in which case the advance is left pending_transaction (the
+        money may have been given)
+    """
+    bank_transaction = accounts_manager_client.perform_bank_transaction(BankTransactionRequest(
+        dst_account_id=advance.dst_account_id,
+        amount=advance.amount,
+        direction=TransactionDirection.credit,
+        reason=f'Advance {advance.advance_id}',
+        idempotency_key=get_advance_grant_idempotency_key(advance)))
+
+    if bank_transaction.status != TransactionStatus.successful:
+        logger.info('Granting the advance was denied', advance_id=advance.advance_id, reason=bank_transaction.reason)
+        return dal.update_advance_status(advance_id=advance.advance_id, status=dal_models.DalAdvanceStatus.failed)
+
+    # The advance is activated together with its payments, in a single transaction
+    activation = dal.activate_advance(advance_id=advance.advance_id)
+    if activation is None:
+        # Activated (or failed) by a concurrent grant of the same advance
+        logger.info('The advance was already granted', advance_id=advance.advance_id)
+        return dal.get_advance(advance.advance_id)
+
+    activated_advance, _ = activation
+    return activated_advance
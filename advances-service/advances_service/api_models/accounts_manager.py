@@ -0,0 +1,44 @@
+"""
+The models of the accounts-manager API, used by the accounts-manager client
+"""
+
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel, PositiveFloat
+
+
+class TransactionDirection(str, Enum):
+    """debit - take the money from the account, credit - give the money to the account"""
+    debit = 'debit'
+    credit = 'credit'
+
+
+class TransactionStatus(str, Enum):
+    successful = 'successful'
+    fail = 'fail'
+
+
+class BankTransactionRequest(BaseModel):
+    """A request to give money to an account from the bank, or take money from an account to the bank"""
+    dst_account_id: str
+    amount: PositiveFloat
+    direction: TransactionDirection
+    # Why the transaction happened (for example: "Advance 3 payment 1")
+    reason: Optional[str]
+    # A unique key of the bank transaction, so retrying it never transfers the funds twice
+    idempotency_key: Optional[str]
+
+
+class BankTransaction(BaseModel):
+    """Money transaction between the bank & an account"""
+    transaction_id: str
+    timestamp: datetime
+    dst_account_id: str
+    amount: PositiveFloat
+    direction: TransactionDirection
+    status: TransactionStatus
+    # The reason the transaction failed. only present when the transaction failed
+    reason: Optional[str]
+    description: Optional[str]
@@ -6,9 +6,15 @@ from pydantic import BaseModel, PositiveFloat
 
 class AdvanceStatus(str, Enum):
     """The state of the advance payment"""
+    # The money of the advance was not given to the account yet
+    pending_transaction = 'pending_transaction'
     active = 'active'
     paid = 'paid'
     overdue = 'overdue'
+    # The money of the advance could not be given to the account
+    failed = 'failed'
+    # Whether the money of the advance was given to the account is checked by hand
+    needs_review = 'needs_review'
 
 
 class AdvanceRequest(BaseModel):
@@ -1,12 +1,15 @@
+from celery import Celery
 from fastapi import FastAPI
 from fastapi_pagination import add_pagination
 import uvicorn
 from structlog import get_logger
 
 from settings import Settings
+from accounts_manager_client import get_accounts_manager_client
 from configure_logging import configure_logging
-from middlewares.request_logging.middleware import add_log_context
+from middlewares.request_logging.middleware import RequestLoggingMiddleware
 from routes.advances import get_router as get_transactions_router
+from routes.metrics import get_router as get_metrics_router
 from dal.dal import Dal
 
 logger = get_logger()
@@ -29,13 +32,26 @@ def get_app() -> FastAPI:
     # Required for paths that return a paginated list of results
     add_pagination(app)
 
-    app.middleware("http")(add_log_context)
+    app.add_middleware(RequestLoggingMiddleware,
+                       sample_rate=settings.request_log_sample_rate,
+                       slow_request_threshold=settings.slow_request_threshold)
 
-    app.include_router(get_transactions_router(dal=dal))
+    # Only sends tasks (by name) to the Celery workers
+    celery_client = Celery('advances_service_api', broker=settings.redis_url) if settings.grant_advances_async else None
+
+    app.include_router(get_transactions_router(dal=dal,
+                                               accounts_manager_client=get_accounts_manager_client(settings),
+                                               celery_client=celery_client))
+    app.include_router(get_metrics_router())
 
     @app.on_event("startup")
     def on_startup():
-        dal.initiate_connection(settings.db_connection_string.get_secret_value())
+        dal.initiate_connection(settings.db_connection_string.get_secret_value(),
+                                engine_profile=settings.get_db_engine_profile())
+
+    @app.on_event("shutdown")
+    def on_shutdown():
+        get_accounts_manager_client(settings).close()
 
     @app.get('/')
     def root() -> str:
@@ -1,33 +1,271 @@
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from celery import group
 from celery.app import Celery
+from structlog import get_logger
 
 from settings import Settings
+from accounts_manager_client import AccountsManagerError, get_accounts_manager_client
+from advance_granting import grant_advance, GRANT_ADVANCE_TASK_NAME
+from api_models.accounts_manager import BankTransactionRequest, TransactionDirection, TransactionStatus
+from dal.dal import Dal
+from dal.dal_models import DalAdvancePayment, DalAdvanceStatus, DalAdvancePaymentStatus
+
+logger = get_logger()
 
 settings = Settings()
 
 celery_app = Celery('advance_service_node', broker=settings.redis_url, backend=settings.redis_url)
 
+# Connected on first use, so every worker process opens its own connections (connections can not be shared across the
+# forked worker processes). The accounts-manager client is created on first use for the same reason
+dal = Dal()
+is_dal_connected = False
+
+
+def get_dal() -> Dal:
+    global is_dal_connected
+    if not is_dal_connected:
+        dal.initiate_connection(settings.db_connection_string.get_secret_value(),
+                                engine_profile=settings.get_db_engine_profile())
+        is_dal_connected = True
+    return dal
+
+
+def get_payment_idempotency_key(payment: DalAdvancePayment) -> str:
+    """The idempotency key of the bank transaction collecting the payment, so a payment is never collected twice"""
+    return f'advance-payment-{payment.advance_id}-{payment.payment_number}'
+
+
+def alert_payments_needing_review(payments: List[DalAdvancePayment]) -> None:
+    """
+    Alerts on every requeued payment that was moved to needs_review, since it was claimed
+    DUE_PAYMENTS_MAX_COLLECTION_ATTEMPTS times without being collected (a critical log record, picked up by the log
+    monitoring)
+    """
+    for payment in payments:
+        if payment.status == DalAdvancePaymentStatus.needs_review:
+            logger.critical('Collecting the payment failed too many times, check whether it was collected',
+                            alert='advance_payment_needs_review',
+                            advance_id=payment.advance_id,
+                            payment_number=payment.payment_number,
+                            collection_attempts=settings.due_payments_max_collection_attempts)
+
 
 @celery_app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(60, find_due_advance_payments.s(), name='find_due_advance_payments every 60 seconds')
+    sender.add_periodic_task(settings.due_payments_interval, find_due_advance_payments.s(),
+                             name='find_due_advance_payments every interval')
+    sender.add_periodic_task(settings.advance_reconciliation_interval, reconcile_advances.s(),
+                             name='reconcile_advances every interval')
+    sender.add_periodic_task(settings.pending_advances_interval, grant_stale_pending_advances.s(),
+                             name='grant_stale_pending_advances every interval')
 
 
 @celery_app.task
 def find_due_advance_payments():
-    # TODO: Get all advance payments where their due date has passed & are still marked as not_due_yet
-    #           (order by advance & payment number)
-    #       for each of these payments
-    #           call the process_due_payment task on it & don't wait for the result
-    #           change the payments status to pending_processing
-    pass
+    """
+    Claims the payments whose due date has passed & are still not_due_yet (moving them to pending_processing), chunk by
+    chunk, & dispatches every claimed chunk to collector tasks without waiting for the results.
+    Claiming skips the payments claimed by concurrent runs, so several workers can run this task in parallel without
+    dispatching a payment twice.
+    Payments stuck in pending_processing / processing (a lost task message, a crashed worker or a collector that failed
+    to complete them) are first returned to not_due_yet, so they are claimed again, unless they were already claimed
+    DUE_PAYMENTS_MAX_COLLECTION_ATTEMPTS times.
+    """
+    stale_payments = get_dal().requeue_stale_payments(
+        stale_after=timedelta(seconds=settings.due_payments_stale_after),
+        max_collection_attempts=settings.due_payments_max_collection_attempts)
+    for payment in stale_payments:
+        logger.warning('Requeued a stale payment', advance_id=payment.advance_id,
+                       payment_number=payment.payment_number, status=payment.status)
+    alert_payments_needing_review(stale_payments)
 
+    due_before = datetime.now()
+    claimed_count = 0
+    task_chunk_size = settings.due_payments_task_chunk_size
 
-@celery_app.task
-def process_due_payment(advance_id: str, payment_number: int):
-    # TODO: make sure that the payment is still in pending_processing status, otherwise don't continue the func
-    #       Deduct the payment from the account via the accounts-manager API
-    #       update the payment status to paid / failed depending on if the deduction worked
+    for _ in range(settings.due_payments_max_chunks_per_run):
+        payments = get_dal().claim_due_advance_payments(due_before=due_before,
+                                                        limit=settings.due_payments_claim_chunk_size)
+        if not payments:
+            break
+
+        try:
+            # Every collector task collects a few payments, with a single request to accounts-manager
+            group(collect_due_payments.s([(payment.advance_id, payment.payment_number)
+                                          for payment in payments[task_chunk_start:task_chunk_start + task_chunk_size]])
+                  for task_chunk_start in range(0, len(payments), task_chunk_size)).apply_async()
+        except Exception:
+            logger.exception('Dispatching the due payments failed, releasing them', payments_count=len(payments))
+            alert_payments_needing_review(get_dal().release_advance_payments(
+                payments, max_collection_attempts=settings.due_payments_max_collection_attempts))
+            raise
+
+        claimed_count += len(payments)
+        if len(payments) < settings.due_payments_claim_chunk_size:
+            break
+
+    logger.info('Due advance payments dispatched', payments_count=claimed_count)
+
+
+@celery_app.task(bind=True, max_retries=settings.due_payments_max_retries,
+                 default_retry_delay=settings.due_payments_retry_delay)
+def collect_due_payments(self, payment_keys: List[Tuple[str, int]]):
+    """
+    Collects a chunk of claimed payments from their accounts with a single bulk bank transactions request to
+    accounts-manager, & writes all the resulting paid / failed statuses with a single update.
+    Only the payments that are still pending_processing are taken (moving them to processing), so a payment is only
+    collected by a single task even if the chunk is delivered more than once. Every bank transaction has the
+    idempotency key of its payment, so collecting a payment again (after a failure) never takes the money twice.
+    :param payment_keys: The (advance_id, payment_number) of the claimed payments
+    """
+    payments = get_dal().start_processing_payments([(advance_id, payment_number)
+                                                    for advance_id, payment_number in payment_keys])
+    if len(payments) < len(payment_keys):
+        logger.info('Some of the due payments were already taken by another collector',
+                    payments_count=len(payment_keys), taken_count=len(payments))
+    if not payments:
+        return
+
+    bank_transaction_requests = [
+        BankTransactionRequest(dst_account_id=payment.dst_account_id,
+                               amount=payment.amount,
+                               direction=TransactionDirection.debit,
+                               reason=f'Advance {payment.advance_id} payment {payment.payment_number + 1}',
+                               idempotency_key=get_payment_idempotency_key(payment))
+        for payment in payments
+    ]
+
+    try:
+        bank_transactions = get_accounts_manager_client(settings).perform_bank_transactions_batch(
+            bank_transaction_requests)
+    except AccountsManagerError as e:
+        # The bank transactions may have been performed, but their idempotency keys make collecting them again safe
+        get_dal().return_payments_to_pending(payments)
+        if self.request.retries >= self.max_retries:
+            logger.error('Collecting the due payments failed, leaving them for the next claim',
+                         payments_count=len(payments), reason=str(e))
+            # Payments that were claimed DUE_PAYMENTS_MAX_COLLECTION_ATTEMPTS times are not claimed again
+            alert_payments_needing_review(get_dal().release_advance_payments(
+                payments, max_collection_attempts=settings.due_payments_max_collection_attempts))
+            raise
+
+        logger.warning('Collecting the due payments failed, retrying', payments_count=len(payments), reason=str(e),
+                       attempt=self.request.retries + 1)
+        raise self.retry(exc=e)
+
+    paid_payments, failed_payments = [], []
+    for payment, bank_transaction in zip(payments, bank_transactions):
+        if bank_transaction.status == TransactionStatus.successful:
+            paid_payments.append(payment)
+        else:
+            failed_payments.append(payment)
 
-    # TODO: If the deduction failed, create another payment in the same time as the next payment.
+    # If this fails the payments stay in processing until find_due_advance_payments requeues them (after
+    # DUE_PAYMENTS_STALE_AFTER), & collecting them again is safe thanks to the idempotency keys
+    get_dal().complete_payments(paid_payments=paid_payments, failed_payments=failed_payments)
+    logger.info('Due advance payments collected', paid_count=len(paid_payments), failed_count=len(failed_payments))
+
+    # Payments that could not be collected because accounts-manager failed are claimed again (see above), but payments
+    # denied by accounts-manager (insufficient funds) are failed & never collected again.
+    # TODO: For every denied (failed) payment, create another payment in the same time as the next payment.
     #       If there is no next payment, set the next payment to a week from this payment
-    pass
+
+
+@celery_app.task(bind=True, name=GRANT_ADVANCE_TASK_NAME, max_retries=settings.advance_grant_max_retries,
+                 default_retry_delay=settings.advance_grant_retry_delay)
+def grant_advance_task(self, advance_id: str):
+    """
+    Grants an advance persisted as pending_transaction by the API (when advances are granted asynchronously): gives its
+    money to the account & activates it together with its payments, or fails it if the grant is denied.
+    Granting is idempotent, so the task can run again (retries, duplicate deliveries) without giving the money twice,
+    as long as accounts-manager keeps the idempotency key: advances older than PENDING_ADVANCES_MAX_AGE are not granted
+    """
+    advance = get_dal().get_advance(advance_id)
+    if advance is None or advance.status != DalAdvanceStatus.pending_transaction:
+        logger.info('The advance is not pending, skipping granting it', advance_id=advance_id,
+                    status=advance.status if advance else None)
+        return
+    if advance.start_timestamp < get_pending_advances_expiry():
+        logger.warning('The advance is too old to be granted again, leaving it to be reviewed', advance_id=advance_id,
+                       start_timestamp=advance.start_timestamp)
+        return
+
+    try:
+        advance = grant_advance(dal=get_dal(), accounts_manager_client=get_accounts_manager_client(settings),
+                                advance=advance)
+    except AccountsManagerError as e:
+        if self.request.retries >= self.max_retries:
+            logger.error('Granting the advance failed, leaving it pending to be granted again later',
+                         advance_id=advance_id, reason=str(e))
+            raise
+
+        logger.warning('Granting the advance failed, retrying', advance_id=advance_id, reason=str(e),
+                       attempt=self.request.retries + 1)
+        raise self.retry(exc=e)
+
+    logger.info('Advance granted', advance_id=advance_id, status=advance.status)
+
+
+def get_pending_advances_expiry() -> datetime:
+    """
+    Advances started before this time are not granted again, as accounts-manager may have deleted the idempotency key
+    of their grant. Compared with the start timestamp of the advance, which is set by the same (local) clock
+    """
+    return datetime.now() - timedelta(seconds=settings.pending_advances_max_age)
+
+
+@celery_app.task
+def grant_stale_pending_advances():
+    """
+    Grants again the advances stuck in pending_transaction: their synchronous grant failed (accounts-manager was
+    unavailable), or their grant_advance task was lost or gave up. Granting again never gives the money twice, thanks to
+    the idempotency key of the grant.
+    Advances older than PENDING_ADVANCES_MAX_AGE are moved to needs_review with an alert instead (a critical log record,
+    picked up by the log monitoring), since accounts-manager may have deleted their idempotency key
+    """
+    pending_advances_expiry = get_pending_advances_expiry()
+    expired_advance_ids = get_dal().flag_expired_pending_advances(started_before=pending_advances_expiry,
+                                                                  limit=settings.pending_advances_claim_limit)
+    for advance_id in expired_advance_ids:
+        logger.critical('The advance was pending for too long to be granted again, check whether it was granted',
+                        alert='pending_advance_needs_review',
+                        advance_id=advance_id)
+
+    advance_ids = get_dal().claim_stale_pending_advances(
+        stale_after=timedelta(seconds=settings.pending_advances_stale_after),
+        started_after=pending_advances_expiry,
+        limit=settings.pending_advances_claim_limit)
+    if not advance_ids:
+        return
+
+    group(grant_advance_task.s(advance_id) for advance_id in advance_ids).apply_async()
+    logger.warning('Granting stuck pending advances again', advances_count=len(advance_ids))
+
+
+@celery_app.task
+def reconcile_advances():
+    """
+    Makes sure no payment is missing: finds the advances touched since the last reconciliation whose paid, not due yet
+    & processing payments do not add up to their amount, with a single grouped aggregate query, & alerts on every one
+    of them (a critical log record, picked up by the log monitoring)
+    """
+    result = get_dal().reconcile_advances(lag=timedelta(seconds=settings.advance_reconciliation_lag),
+                                          tolerance=settings.advance_reconciliation_tolerance)
+
+    for mismatch in result.mismatches:
+        logger.critical('The payments of the advance do not add up to its amount',
+                        alert='advance_payments_mismatch',
+                        advance_id=mismatch.advance_id,
+                        advance_status=mismatch.status,
+                        amount=mismatch.amount,
+                        payments_sum=mismatch.payments_sum,
+                        difference=mismatch.amount - mismatch.payments_sum,
+                        payments_count=mismatch.payments_count)
+
+    logger.info('Advances reconciled',
+                reconciled_since=result.reconciled_since,
+                reconciled_until=result.reconciled_until,
+                mismatches_count=len(result.mismatches))
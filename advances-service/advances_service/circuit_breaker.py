@@ -0,0 +1,79 @@
+import threading
+import time
+from enum import Enum
+
+from structlog import get_logger
+
+logger = get_logger()
+
+
+class CircuitOpenError(Exception):
+    """The circuit is open, so the call is not attempted"""
+
+
+class CircuitState(str, Enum):
+    # Calls are attempted
+    closed = 'closed'
+    # Calls fail fast without being attempted, until the reset timeout passes
+    open = 'open'
+    # A single trial call is attempted, which closes the circuit if it succeeds & opens it again if it fails
+    half_open = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Stops calling a remote service after it failed too many times in a row, so callers fail fast instead of piling
+    more load (& retries) on a saturated service. After the reset timeout a single trial call is let through, & the
+    circuit closes again once a call succeeds. Thread safe.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        :param name: The name of the remote service, for the logs
+        :param failure_threshold: The number of failures in a row that open the circuit
+        :param reset_timeout: How long (seconds) the circuit stays open before a trial call is let through
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.__state = CircuitState.closed
+        self.__failures = 0
+        self.__opened_at = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def state(self) -> CircuitState:
+        return self.__state
+
+    def before_call(self) -> None:
+        """
+        Must be called before every call to the remote service
+        :raises CircuitOpenError: If the circuit is open (or a trial call is already running)
+        """
+        with self.__lock:
+            if self.__state == CircuitState.closed:
+                return
+
+            if self.__state == CircuitState.open and time.monotonic() - self.__opened_at >= self.reset_timeout:
+                logger.info('Trying a call through the open circuit', service=self.name)
+                self.__state = CircuitState.half_open
+                return
+
+            raise CircuitOpenError(f'The circuit of {self.name} is open, failing fast')
+
+    def record_success(self) -> None:
+        with self.__lock:
+            if self.__state != CircuitState.closed:
+                logger.info('Circuit closed', service=self.name)
+            self.__state = CircuitState.closed
+            self.__failures = 0
+
+    def record_failure(self) -> None:
+        with self.__lock:
+            self.__failures += 1
+            if self.__state == CircuitState.half_open or self.__failures >= self.failure_threshold:
+                if self.__state != CircuitState.open:
+                    logger.warning('Circuit opened', service=self.name, failures=self.__failures,
+                                   reset_timeout=self.reset_timeout)
+                self.__state = CircuitState.open
+                self.__opened_at = time.monotonic()
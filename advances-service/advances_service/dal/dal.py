@@ -1,15 +1,21 @@
 from datetime import datetime, timedelta
-from typing import Optional, Tuple, Iterable
+import time
+from typing import Optional, Tuple, Iterable, List
 
 from pydantic import PositiveFloat
 import structlog
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import and_
+from sqlalchemy import and_, update, tuple_, func
 
 from dal import dal_models as dal_models
-from dal.sqlalchemy.configuration import get_sqlalchemy_engine
+from dal.sqlalchemy.configuration import get_sqlalchemy_engine, get_pool_stats, EngineProfile
 from dal.sqlalchemy import models as sqlalchemy_models
+from dal.sqlalchemy import reconciliation, schema
+from dal.sqlalchemy.statements import claim_due_payments_statement, start_processing_payments_statement, \
+    complete_payments_statement, activate_advance_statement, insert_advance_payments_statement, \
+    requeue_stale_payments_statement, claim_stale_pending_advances_statement, flag_expired_pending_advances_statement, \
+    release_payments_statement
 
 
 logger = structlog.get_logger()
@@ -17,28 +23,39 @@ logger = structlog.get_logger()
 
 class Dal:
 
+    __engine = None
     __session_maker = None
-    __session = None
 
     def _get_session(self) -> Session:
-        if not self.__session_maker and not self.__session:
+        """
+        Generates a new session object for a single unit of work (sessions are not thread safe).
+        The session checks out its connection from the pool straight away, so the time spent waiting for a free
+        connection is logged along with the pool usage.
+        """
+        if not self.__session_maker:
             raise ValueError('The session maker is missing. are you sure you initiated the database connection?')
 
-        if self.__session:
-            return self.__session
+        session = self.__session_maker()
 
-        self.__session = self.__session_maker()
+        checkout_start_time = time.perf_counter()
+        session.connection()
+        logger.debug('Database connection checked out',
+                     pool_wait=time.perf_counter() - checkout_start_time,
+                     **get_pool_stats(self.__engine))
 
-        return self.__session
+        return session
 
-    def initiate_connection(self, connection_string: str):
+    def initiate_connection(self, connection_string: str, engine_profile: Optional[EngineProfile] = None):
         logger.debug('Creating sql alchemy engine')
-        engine = get_sqlalchemy_engine(connection_string)
+        self.__engine = get_sqlalchemy_engine(connection_string, profile=engine_profile)
         logger.debug('creating all model schemas in database')
-        sqlalchemy_models.Base.metadata.create_all(engine)
+        sqlalchemy_models.Base.metadata.create_all(self.__engine)
+        # Columns & indexes added to existing tables are not created with the tables
+        schema.add_missing_columns(self.__engine, sqlalchemy_models.Base.metadata)
+        schema.create_missing_indexes(self.__engine, sqlalchemy_models.Base.metadata)
         logger.debug('model schemas created in database')
 
-        self.__session_maker = sessionmaker(bind=engine)
+        self.__session_maker = sessionmaker(bind=self.__engine)
 
     def create_advance(self, dst_account_id: str, amount: float,
                        status: dal_models.DalAdvanceStatus, start_timestamp: datetime) -> dal_models.DalAdvance:
@@ -50,48 +67,234 @@ class Dal:
                 start_timestamp=start_timestamp
             )
             session.add(advance)
-            session.commit()
-
+            # The generated id is returned by the INSERT, so the advance is read before the commit expires it (reading
+            # it after the commit would select it again)
+            session.flush()
             dal_advance = dal_models.DalAdvance.from_orm(advance)
+            session.commit()
 
         return dal_advance
 
+    def get_advance(self, advance_id: str) -> Optional[dal_models.DalAdvance]:
+        """Returns the advance (looked up by its primary key), or None if there is no such advance"""
+        with self._get_session() as session:
+            advance = session.get(sqlalchemy_models.Advance, advance_id)
+            if advance is None:
+                return None
+
+            return dal_models.DalAdvance.from_orm(advance)
+
     def update_advance_status(self, advance_id: str, status: dal_models.DalAdvanceStatus) -> dal_models.DalAdvance:
+        advance = sqlalchemy_models.Advance
         with self._get_session() as session:
-            # Retrieve the source and destination accounts from the database with row-level locking
-            advance = session.query(sqlalchemy_models.Advance).with_for_update().get(advance_id)
+            # A single UPDATE ... RETURNING, instead of locking & reading the advance before updating it
+            updated_advance = session.scalars(
+                update(advance)
+                .where(advance.id == advance_id)
+                .values(status=status.value, updated_at=func.now())
+                .returning(advance)
+                .execution_options(synchronize_session=False)).one()
+            new_advance = dal_models.DalAdvance.from_orm(updated_advance)
+            session.commit()
 
-            advance.status = status.value
+        return new_advance
 
-            # Commit the changes to the database
+    def claim_stale_pending_advances(self, stale_after: timedelta, started_after: datetime, limit: int) -> List[str]:
+        """
+        Claims the advances left pending_transaction for longer than the given time (their grant failed, or its task
+        was lost), so they are granted again. A claimed advance is claimed again only once it is stale again
+        :param started_after: Only advances started after this time are claimed
+        :return: The ids of the claimed advances
+        """
+        with self._get_session() as session:
+            advance_ids = [str(advance_id) for advance_id in session.scalars(
+                claim_stale_pending_advances_statement(stale_after=stale_after, started_after=started_after,
+                                                       limit=limit))]
+            session.commit()
+
+        return advance_ids
+
+    def flag_expired_pending_advances(self, started_before: datetime, limit: int) -> List[str]:
+        """
+        Moves the advances still pending_transaction that started before the given time to needs_review, so they are
+        no longer granted again
+        :return: The ids of the flagged advances
+        """
+        with self._get_session() as session:
+            advance_ids = [str(advance_id) for advance_id in session.scalars(
+                flag_expired_pending_advances_statement(started_before=started_before, limit=limit))]
             session.commit()
 
-            new_advance = dal_models.DalAdvance.from_orm(advance)
+        return advance_ids
+
+    def activate_advance(self, advance_id: str, number_of_payments: int = 12) \
+            -> Optional[Tuple[dal_models.DalAdvance, List[dal_models.DalAdvancePayment]]]:
+        """
+        Activates a pending_transaction advance (after its money was granted) & creates its whole payment schedule, in a
+        single transaction: an active advance always has its payments.
+        :return: The activated advance & its payments, or None if the advance is not pending_transaction (it was
+            already activated, or failed), in which case nothing is changed
+        """
+        with self._get_session() as session:
+            advance = session.scalars(activate_advance_statement(advance_id)).one_or_none()
+            if advance is None:
+                return None
+
+            dal_advance = dal_models.DalAdvance.from_orm(advance)
+            dal_payments = self._insert_advance_payments(session, advance=dal_advance,
+                                                         number_of_payments=number_of_payments)
+            session.commit()
 
-            return new_advance
+        return dal_advance, dal_payments
 
     def create_advance_payments(self, advance: dal_models.DalAdvance,
                                 number_of_payments: int = 12) -> Iterable[dal_models.DalAdvancePayment]:
-        payment_amount = advance.amount / number_of_payments
-        payment_due_date = advance.start_timestamp
+        with self._get_session() as session:
+            dal_payments = self._insert_advance_payments(session, advance=advance,
+                                                         number_of_payments=number_of_payments)
+            session.commit()
 
+        return dal_payments
+
+    @staticmethod
+    def _insert_advance_payments(session: Session, advance: dal_models.DalAdvance,
+                                 number_of_payments: int) -> List[dal_models.DalAdvancePayment]:
+        """Inserts the payment schedule of the advance with a single multi-row INSERT ... RETURNING"""
+        rows = session.execute(insert_advance_payments_statement(advance_id=advance.advance_id,
+                                                                 amount=advance.amount,
+                                                                 start_timestamp=advance.start_timestamp,
+                                                                 number_of_payments=number_of_payments))
+        dal_payments = [dal_models.DalAdvancePayment(**row._mapping) for row in rows]
+        dal_payments.sort(key=lambda payment: payment.payment_number)
+        return dal_payments
+
+    def claim_due_advance_payments(self, due_before: datetime, limit: int) -> List[dal_models.DalAdvancePayment]:
+        """
+        Claims a chunk of the payments that are due & still not_due_yet, by moving them to pending_processing in a
+        single statement. Concurrent claims (of other workers) never claim the same payment.
+        :param due_before: The payments due up to this time are claimed
+        :param limit: The maximum number of payments to claim
+        :return: The claimed payments, the earliest due first. Less than the limit when there are no more due payments
+        """
         with self._get_session() as session:
-            payments = []
-            for payment_number in range(number_of_payments):
-
-                # TODO: Remove magic number
-                payment_due_date = payment_due_date + timedelta(days=7)
-                payment = sqlalchemy_models.AdvancePayment(
-                    advance_id=advance.advance_id,
-                    payment_number=payment_number,
-                    amount=payment_amount,
-                    due_at=payment_due_date,
-                    status=dal_models.DalAdvancePaymentStatus.not_due_yet.value
-                )
-                payments.append(payment)
-            session.add_all(payments)
+            payments = session.scalars(claim_due_payments_statement(due_before=due_before, limit=limit)).all()
+            dal_payments = [dal_models.DalAdvancePayment.from_orm(payment) for payment in payments]
             session.commit()
 
+        dal_payments.sort(key=lambda payment: (payment.due_at, payment.advance_id, payment.payment_number))
+        return dal_payments
+
+    def release_advance_payments(self, payments: Iterable[dal_models.DalAdvancePayment],
+                                 max_collection_attempts: int) -> List[dal_models.DalAdvancePayment]:
+        """
+        Returns claimed payments that could not be processed to not_due_yet, so the next claim picks them up again.
+        Payments already claimed max_collection_attempts times are moved to needs_review instead
+        :return: The released payments, with their new status
+        """
+        payment_keys = [(payment.advance_id, payment.payment_number) for payment in payments]
+        if not payment_keys:
+            return []
+
+        with self._get_session() as session:
+            released_payments = session.scalars(
+                release_payments_statement(payment_keys=payment_keys,
+                                           max_collection_attempts=max_collection_attempts)).all()
+            dal_payments = [dal_models.DalAdvancePayment.from_orm(payment) for payment in released_payments]
+            session.commit()
+
+        return dal_payments
+
+    def requeue_stale_payments(self, stale_after: timedelta,
+                               max_collection_attempts: int) -> List[dal_models.DalAdvancePayment]:
+        """
+        Returns the payments left in pending_processing / processing for longer than the given time (their collector
+        task was lost, crashed or failed to complete them) to not_due_yet, so the next claim collects them again.
+        Payments already claimed max_collection_attempts times are moved to needs_review instead
+        :return: The requeued payments, with their new status
+        """
+        with self._get_session() as session:
+            payments = session.scalars(requeue_stale_payments_statement(
+                stale_after=stale_after, max_collection_attempts=max_collection_attempts)).all()
             dal_payments = [dal_models.DalAdvancePayment.from_orm(payment) for payment in payments]
+            session.commit()
 
         return dal_payments
+
+    def start_processing_payments(self, payment_keys: List[Tuple[str, int]]) -> List[dal_models.DalDuePayment]:
+        """
+        Takes the given claimed payments for processing, by moving the ones that are still pending_processing to
+        processing. A payment can be taken only once, so only a single collector processes every payment, even if the
+        same chunk of payments is delivered to several collectors.
+        :param payment_keys: The (advance_id, payment_number) of the claimed payments
+        :return: The payments taken for processing (with the account to collect them from). The payments taken by other
+            collectors (or already processed) are left out
+        """
+        if not payment_keys:
+            return []
+
+        with self._get_session() as session:
+            dal_payments = [dal_models.DalDuePayment(**row._mapping)
+                            for row in session.execute(start_processing_payments_statement(payment_keys))]
+            session.commit()
+
+        return dal_payments
+
+    def complete_payments(self,
+                          paid_payments: Iterable[dal_models.DalAdvancePayment],
+                          failed_payments: Iterable[dal_models.DalAdvancePayment]) -> None:
+        """Moves the processed payments to paid / failed, with a single statement"""
+        paid_payment_keys = [(payment.advance_id, payment.payment_number) for payment in paid_payments]
+        failed_payment_keys = [(payment.advance_id, payment.payment_number) for payment in failed_payments]
+        if not paid_payment_keys and not failed_payment_keys:
+            return
+
+        with self._get_session() as session:
+            session.execute(complete_payments_statement(paid_payment_keys=paid_payment_keys,
+                                                        failed_payment_keys=failed_payment_keys))
+            session.commit()
+
+    def return_payments_to_pending(self, payments: Iterable[dal_models.DalAdvancePayment]) -> None:
+        """Returns processing payments that could not be processed to pending_processing, so they can be taken again"""
+        payment_keys = [(payment.advance_id, payment.payment_number) for payment in payments]
+        if not payment_keys:
+            return
+
+        advance_payment = sqlalchemy_models.AdvancePayment
+        with self._get_session() as session:
+            session.execute(
+                update(advance_payment)
+                .where(tuple_(advance_payment.advance_id, advance_payment.payment_number).in_(payment_keys))
+                .where(advance_payment.status == dal_models.DalAdvancePaymentStatus.processing.value)
+                .values(status=dal_models.DalAdvancePaymentStatus.pending_processing.value, updated_at=func.now())
+                .execution_options(synchronize_session=False))
+            session.commit()
+
+    def reconcile_advances(self, lag: timedelta, tolerance: float) -> dal_models.DalAdvanceReconciliation:
+        """
+        Finds the advances touched (the advance or its payments) since the reconciliation watermark until `lag` before
+        now, whose paid, not due yet & processing payments do not add up to their amount, & moves the watermark
+        forward. The watermark is locked & moved in the same database transaction, so concurrent reconciliations do not
+        reconcile the same range twice.
+        :param lag: How long after they are touched advances are reconciled. Must be longer than the time it takes to
+            commit a transaction, since advances committed after their time was reconciled are not reconciled
+        :param tolerance: The largest difference between the sum of the payments & the amount that is not a mismatch
+        :return: The reconciled range, & the mismatched advances
+        """
+        with self.__engine.begin() as connection:
+            watermark = reconciliation.lock_watermark(connection)
+            reconciled_until = reconciliation.get_database_time(connection) - lag
+            if watermark is not None and reconciled_until <= watermark:
+                return dal_models.DalAdvanceReconciliation(reconciled_since=watermark,
+                                                           reconciled_until=watermark,
+                                                           mismatches=[])
+
+            rows = reconciliation.find_mismatched_advances(connection,
+                                                           touched_since=watermark,
+                                                           touched_until=reconciled_until,
+                                                           tolerance=tolerance)
+            reconciliation.set_watermark(connection, reconciled_until=reconciled_until)
+
+        return dal_models.DalAdvanceReconciliation(
+            reconciled_since=watermark,
+            reconciled_until=reconciled_until,
+            mismatches=[dal_models.DalAdvanceMismatch(**row._mapping) for row in rows])
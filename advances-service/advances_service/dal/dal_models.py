@@ -0,0 +1,80 @@
+"""
+These are models that are exposed out of the dal layer. Internally the DAL layer will use the appropriate models based
+on the database & code used to interact with it.
+"""
+
+from datetime import datetime
+from enum import Enum
+from typing import Optional, List
+
+from pydantic import BaseModel, PositiveFloat, Field, NonNegativeInt
+
+
+class DalAdvanceStatus(str, Enum):
+    pending_transaction = 'pending_transaction'
+    active = 'active'
+    paid = 'paid'
+    overdue = 'overdue'
+    # The bank transaction granting the advance failed, so the advance was never given
+    failed = 'failed'
+    # The advance was left pending_transaction for too long to be granted again safely (accounts-manager may have
+    # forgotten the idempotency key of its grant), so whether its money was given is checked by hand
+    needs_review = 'needs_review'
+
+
+class DalAdvance(BaseModel):
+    advance_id: str = Field(alias="id")
+    dst_account_id: str
+    amount: PositiveFloat
+    start_timestamp: datetime
+    status: DalAdvanceStatus
+
+    class Config:
+        orm_mode = True
+
+
+class DalAdvancePaymentStatus(str, Enum):
+    not_due_yet = "not_due_yet"
+    pending_processing = "pending_processing"
+    # Taken by a collector task, which is collecting the payment from the account
+    processing = "processing"
+    paid = "paid"
+    failed = "failed"
+    # Collecting the payment failed too many times (accounts-manager kept failing), so whether it was collected is
+    # checked by hand
+    needs_review = "needs_review"
+
+
+class DalAdvancePayment(BaseModel):
+    advance_id: str
+    payment_number: NonNegativeInt
+    amount: PositiveFloat
+    due_at: datetime
+    status: DalAdvancePaymentStatus
+
+    class Config:
+        orm_mode = True
+
+
+class DalDuePayment(DalAdvancePayment):
+    """A payment taken for processing, with the account it is collected from"""
+    dst_account_id: str
+
+
+class DalAdvanceMismatch(BaseModel):
+    """An advance whose paid, not due yet & processing payments do not add up to its amount"""
+    advance_id: str
+    amount: PositiveFloat
+    status: DalAdvanceStatus
+    # The sum of the paid, not due yet & processing payments
+    payments_sum: float
+    # The number of payments of the advance, including failed payments
+    payments_count: NonNegativeInt
+
+
+class DalAdvanceReconciliation(BaseModel):
+    """The result of reconciling the advances touched in a time range"""
+    # None when all the advances were reconciled (the first reconciliation)
+    reconciled_since: Optional[datetime]
+    reconciled_until: datetime
+    mismatches: List[DalAdvanceMismatch]
@@ -1,12 +1,129 @@
-from sqlalchemy import create_engine, Engine
+from enum import Enum
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import create_engine, event, Engine, make_url, URL
+from sqlalchemy.pool import QueuePool
 import structlog
 
+from dal.sqlalchemy.metrics import instrument_engine
+
 logger = structlog.get_logger()
 
 
-def get_sqlalchemy_engine(connection_string: str) -> Engine:
-    logger.debug('Creating database engine')
-    engine = create_engine(connection_string, echo=True)
-    logger.debug('Database engine created', engine=engine)
+class EngineProfileName(str, Enum):
+    """The predefined sets of database engine options"""
+    # Logs every statement
+    development = 'development'
+    production = 'production'
+
+
+class EngineProfile(BaseModel):
+    """The options of a database engine"""
+    # The database driver, replacing the driver of the connection string (for example: psycopg2, a C implemented driver).
+    # None keeps the driver of the connection string
+    driver: Optional[str] = None
+    # Log every statement
+    echo: bool = False
+    # The maximum time (milliseconds) a statement may run before the database cancels it. None means no limit
+    statement_timeout: Optional[int] = None
+    # The number of connections kept open in the pool
+    pool_size: int = 5
+    # The number of connections that can be opened on top of the pool size when it is exhausted
+    max_overflow: int = 10
+    # How long (seconds) to wait for a connection from the pool before giving up
+    pool_timeout: float = 30
+    # Test connections when they are checked out, to replace stale connections
+    pool_pre_ping: bool = True
+    # The maximum age (seconds) of a connection, after which it is replaced by a new one
+    pool_recycle: int = 1800
+    # The number of compiled statements cached by the engine, so repeated statements are not compiled again
+    query_cache_size: int = 500
+    # The number of rows inserted by a single statement when inserting many rows (bulk inserts)
+    insertmanyvalues_page_size: int = 1000
+    # How the psycopg2 driver runs statements with many parameter sets (values_only / values_plus_batch).
+    # Only supported by psycopg2
+    executemany_mode: Optional[str] = None
+
+
+ENGINE_PROFILES: Dict[EngineProfileName, EngineProfile] = {
+    EngineProfileName.development: EngineProfile(echo=True),
+    EngineProfileName.production: EngineProfile(echo=False, query_cache_size=1000),
+}
+
+
+def get_engine_profile(name: EngineProfileName, **overrides) -> EngineProfile:
+    """
+    Returns the engine profile with the given name, with the given options overridden
+    :param name: The name of the engine profile
+    :param overrides: Engine options (see EngineProfile) that override the options of the profile. None values are
+        ignored, so unset settings keep the option of the profile
+    """
+    return ENGINE_PROFILES[name].copy(update={option: value for option, value in overrides.items()
+                                              if value is not None})
+
+
+def _get_url(connection_string: str, driver: Optional[str]) -> URL:
+    """Parses the connection string, & replaces its driver with the given driver (if any)"""
+    url = make_url(connection_string)
+    if driver:
+        url = url.set(drivername=f'{url.get_backend_name()}+{driver}')
+    return url
+
+
+def _set_statement_timeout(engine: Engine, statement_timeout: Optional[int]) -> None:
+    """Sets the statement timeout of every new connection of the engine (works with every driver)"""
+    if statement_timeout is None:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'SET statement_timeout = {int(statement_timeout)}')
+        cursor.close()
+        # Drivers that are not in autocommit mode started a transaction, which would undo the setting on rollback
+        dbapi_connection.commit()
+
+
+def get_sqlalchemy_engine(connection_string: str, profile: Optional[EngineProfile] = None) -> Engine:
+    """
+    Creates the database engine, backed by a connection pool of a fixed size
+    :param connection_string: The connection string to the database, in SQLAlchemy format
+    :param profile: The options of the engine (see EngineProfile). Defaults to the production profile
+    :return: The engine
+    """
+    profile = profile or ENGINE_PROFILES[EngineProfileName.production]
+    url = _get_url(connection_string, driver=profile.driver)
+
+    dialect_options = {}
+    if profile.executemany_mode:
+        dialect_options['executemany_mode'] = profile.executemany_mode
+
+    logger.debug('Creating database engine', driver=url.drivername)
+    engine = create_engine(url,
+                           echo=profile.echo,
+                           poolclass=QueuePool,
+                           pool_size=profile.pool_size,
+                           max_overflow=profile.max_overflow,
+                           pool_timeout=profile.pool_timeout,
+                           pool_pre_ping=profile.pool_pre_ping,
+                           pool_recycle=profile.pool_recycle,
+                           query_cache_size=profile.query_cache_size,
+                           insertmanyvalues_page_size=profile.insertmanyvalues_page_size,
+                           **dialect_options)
+    _set_statement_timeout(engine, statement_timeout=profile.statement_timeout)
+    instrument_engine(engine, engine_name='sync')
+    logger.debug('Database engine created', engine=engine, **get_pool_stats(engine))
 
     return engine
+
+
+def get_pool_stats(engine: Engine) -> Dict:
+    """Returns the current usage of the connection pool of the given engine"""
+    pool = engine.pool
+    return {
+        'pool_size': pool.size(),
+        'pool_checked_out': pool.checkedout(),
+        'pool_checked_in': pool.checkedin(),
+        'pool_overflow': pool.overflow(),
+    }
@@ -1,7 +1,8 @@
 from datetime import datetime
+from typing import Optional
 
-from sqlalchemy import ForeignKey, CheckConstraint, PrimaryKeyConstraint
-from sqlalchemy import String, Float, DateTime, Integer
+from sqlalchemy import ForeignKey, CheckConstraint, Index, PrimaryKeyConstraint
+from sqlalchemy import String, Float, DateTime, Integer, func
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
@@ -18,9 +19,14 @@ class Advance(Base):
     amount: Mapped[float] = mapped_column(Float)
     status: Mapped[str] = mapped_column(String)
     start_timestamp: Mapped[datetime] = mapped_column(DateTime)
+    # When the advance was last inserted / updated, for reconciling only the advances touched since the last
+    # reconciliation. Set by the database on insert, & by every statement that changes the status
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True,
+                                                           server_default=func.now())
 
     __table_args__ = (
         CheckConstraint(amount > 0, name='amount_not_negative'),
+        Index('ix_advance_updated_at', updated_at),
         {})
 
     def __repr__(self) -> str:
@@ -37,9 +43,21 @@ class AdvancePayment(Base):
     due_at: Mapped[datetime] = mapped_column(DateTime)
     amount: Mapped[Float] = mapped_column(Float)
     status: Mapped[str] = mapped_column(String)
+    # How many times the payment was claimed for collecting, so a payment that keeps failing to be collected is not
+    # requeued forever
+    collection_attempts: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+    # When the payment was last inserted / updated, for reconciling only the advances touched since the last
+    # reconciliation (& returning payments stuck in processing). Set by the database on insert, & by every statement
+    # that changes the status
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True,
+                                                           server_default=func.now())
 
     __table_args__ = (
         PrimaryKeyConstraint(advance_id, payment_number),
+        # Serves claiming the payments that are due (see dal/sqlalchemy/statements.py)
+        Index('ix_advance_payment_status_due_at', status, due_at),
+        # Serves finding the advances touched since the last reconciliation (see dal/sqlalchemy/reconciliation.py)
+        Index('ix_advance_payment_updated_at', updated_at),
         {})
 
     def __repr__(self) -> str:
@@ -48,3 +66,14 @@ class AdvancePayment(Base):
                f"due_at={self.due_at!r}, " \
                f"amount={self.amount!r}, " \
                f"status={self.status!r})"
+
+
+class AdvanceReconciliationWatermark(Base):
+    """A single row holding the time up to which (not included) the touched advances were reconciled"""
+    __tablename__ = "advance_reconciliation_watermark"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    # Null until the advances are reconciled for the first time
+    reconciled_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self) -> str:
+        return f"AdvanceReconciliationWatermark(reconciled_until={self.reconciled_until!r})"
@@ -0,0 +1,105 @@
+"""
+Incremental reconciliation of the advances with their payments.
+The payments of an advance that are paid, not due yet, being processed or waiting for review must add up to the amount
+of the advance (a failed payment is supposed to be rescheduled). A background job reconciles the advances touched (the
+advance or any of its payments inserted / updated) between the watermark & a moment shortly before now (rows are
+committed a bit after their updated_at, so the most recent changes may still be uncommitted), & moves the watermark
+forward in the same database transaction. Every run is a single grouped aggregate of the touched advances joined with
+their payments, which returns only the advances whose payments do not add up.
+"""
+
+from datetime import datetime
+from typing import Optional, List
+
+from sqlalchemy import Connection, Select, Row, select, union, func, and_
+from sqlalchemy.dialects.postgresql import insert
+
+from dal.dal_models import DalAdvanceStatus, DalAdvancePaymentStatus
+from dal.sqlalchemy import models as sqlalchemy_models
+
+WATERMARK_ID = 1
+
+# The advances that have a payment schedule
+SCHEDULED_ADVANCE_STATUSES = [DalAdvanceStatus.active.value, DalAdvanceStatus.overdue.value,
+                              DalAdvanceStatus.paid.value]
+# The payments that add up to the amount of their advance
+SCHEDULED_PAYMENT_STATUSES = [DalAdvancePaymentStatus.paid.value, DalAdvancePaymentStatus.not_due_yet.value,
+                              DalAdvancePaymentStatus.pending_processing.value,
+                              DalAdvancePaymentStatus.processing.value,
+                              DalAdvancePaymentStatus.needs_review.value]
+
+
+def lock_watermark(connection: Connection) -> Optional[datetime]:
+    """
+    Locks the watermark row until the end of the database transaction (so concurrent reconciliations do not reconcile
+    the same advances twice) & returns it. Returns None if the advances were never reconciled.
+    """
+    watermark = sqlalchemy_models.AdvanceReconciliationWatermark
+    connection.execute(insert(watermark)
+                       .values(id=WATERMARK_ID, reconciled_until=None)
+                       .on_conflict_do_nothing(index_elements=[watermark.id]))
+    return connection.scalar(select(watermark.reconciled_until)
+                             .where(watermark.id == WATERMARK_ID)
+                             .with_for_update())
+
+
+def set_watermark(connection: Connection, reconciled_until: datetime) -> None:
+    watermark = sqlalchemy_models.AdvanceReconciliationWatermark
+    connection.execute(watermark.__table__.update()
+                       .where(watermark.id == WATERMARK_ID)
+                       .values(reconciled_until=reconciled_until))
+
+
+def get_database_time(connection: Connection) -> datetime:
+    """The current time of the database, which sets the updated_at of the advances & payments"""
+    return connection.scalar(select(func.now()))
+
+
+def find_mismatched_advances_statement(touched_since: Optional[datetime], touched_until: datetime,
+                                       tolerance: float) -> Select:
+    """
+    A single grouped aggregate of the advances touched in the given time range joined with their payments, returning
+    the advances whose paid, not due yet & processing payments do not add up to their amount:
+    (advance_id, amount, status, payments_sum, payments_count)
+    :param touched_since: The start of the range (included). None for all the advances, including the ones touched
+        before updated_at was tracked
+    :param touched_until: The end of the range (not included)
+    :param tolerance: The largest difference between the sum of the payments & the amount that is not a mismatch
+        (the payment amounts are rounded)
+    """
+    advance, advance_payment = sqlalchemy_models.Advance, sqlalchemy_models.AdvancePayment
+
+    advance_touched = advance.updated_at < touched_until
+    payment_touched = advance_payment.updated_at < touched_until
+    if touched_since is not None:
+        advance_touched = and_(advance.updated_at >= touched_since, advance_touched)
+        payment_touched = and_(advance_payment.updated_at >= touched_since, payment_touched)
+    else:
+        advance_touched = advance_touched | advance.updated_at.is_(None)
+        payment_touched = payment_touched | advance_payment.updated_at.is_(None)
+
+    # Both served by the updated_at indexes
+    touched_advance_ids = union(select(advance.id).where(advance_touched),
+                                select(advance_payment.advance_id).where(payment_touched))
+
+    payments_sum = func.coalesce(
+        func.sum(advance_payment.amount).filter(advance_payment.status.in_(SCHEDULED_PAYMENT_STATUSES)), 0)
+
+    return select(advance.id.label('advance_id'),
+                  advance.amount,
+                  advance.status,
+                  payments_sum.label('payments_sum'),
+                  func.count(advance_payment.payment_number).label('payments_count'))\
+        .outerjoin(advance_payment, advance_payment.advance_id == advance.id)\
+        .where(advance.id.in_(touched_advance_ids))\
+        .where(advance.status.in_(SCHEDULED_ADVANCE_STATUSES))\
+        .group_by(advance.id)\
+        .having(func.abs(advance.amount - payments_sum) > tolerance)\
+        .order_by(advance.id)
+
+
+def find_mismatched_advances(connection: Connection, touched_since: Optional[datetime], touched_until: datetime,
+                             tolerance: float) -> List[Row]:
+    return connection.execute(find_mismatched_advances_statement(touched_since=touched_since,
+                                                                 touched_until=touched_until,
+                                                                 tolerance=tolerance)).all()
@@ -0,0 +1,196 @@
+"""
+SQL statements of the DAL
+"""
+
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from sqlalchemy import Update, Insert, ColumnElement, select, update, insert, tuple_, case, func
+
+from dal.dal_models import DalAdvanceStatus, DalAdvancePaymentStatus
+from dal.sqlalchemy import models as sqlalchemy_models
+
+# The time between the start of an advance & its first payment, & between every two payments
+PAYMENT_INTERVAL = timedelta(days=7)
+
+
+def activate_advance_statement(advance_id: str) -> Update:
+    """
+    Moves the advance from pending_transaction to active, & returns it. Returns nothing if the advance is not
+    pending_transaction, so an advance is activated only once
+    """
+    advance = sqlalchemy_models.Advance
+    return update(advance)\
+        .where(advance.id == advance_id)\
+        .where(advance.status == DalAdvanceStatus.pending_transaction.value)\
+        .values(status=DalAdvanceStatus.active.value, updated_at=func.now())\
+        .returning(advance)\
+        .execution_options(synchronize_session=False)
+
+
+def claim_stale_pending_advances_statement(stale_after: timedelta, started_after: datetime, limit: int) -> Update:
+    """
+    Claims up to the given number of advances left pending_transaction for longer than the given time (by the database
+    clock: their grant failed, or its task was lost) for granting them again, by touching their updated_at (so they are
+    not claimed again until they are stale again), & returns their ids. Only advances started after the given time are
+    claimed (older ones are flagged for review instead, see flag_expired_pending_advances_statement).
+    Concurrent claims skip the advances being claimed by each other (SKIP LOCKED)
+    """
+    advance = sqlalchemy_models.Advance
+    stale_advances = select(advance.id)\
+        .where(advance.status == DalAdvanceStatus.pending_transaction.value)\
+        .where(advance.updated_at < func.now() - stale_after)\
+        .where(advance.start_timestamp >= started_after)\
+        .order_by(advance.id)\
+        .limit(limit)\
+        .with_for_update(skip_locked=True)
+
+    return update(advance)\
+        .where(advance.id.in_(stale_advances))\
+        .values(updated_at=func.now())\
+        .returning(advance.id)\
+        .execution_options(synchronize_session=False)
+
+
+def flag_expired_pending_advances_statement(started_before: datetime, limit: int) -> Update:
+    """
+    Moves up to the given number of advances still pending_transaction that started before the given time to
+    needs_review, & returns their ids. Concurrent flagging skips the advances being granted or flagged (SKIP LOCKED)
+    """
+    advance = sqlalchemy_models.Advance
+    expired_advances = select(advance.id)\
+        .where(advance.status == DalAdvanceStatus.pending_transaction.value)\
+        .where(advance.start_timestamp < started_before)\
+        .order_by(advance.id)\
+        .limit(limit)\
+        .with_for_update(skip_locked=True)
+
+    return update(advance)\
+        .where(advance.id.in_(expired_advances))\
+        .where(advance.status == DalAdvanceStatus.pending_transaction.value)\
+        .values(status=DalAdvanceStatus.needs_review.value, updated_at=func.now())\
+        .returning(advance.id)\
+        .execution_options(synchronize_session=False)
+
+
+def insert_advance_payments_statement(advance_id: str, amount: float, start_timestamp: datetime,
+                                      number_of_payments: int) -> Insert:
+    """
+    A single multi-row INSERT of the whole payment schedule of an advance: the amount split into equal payments, every
+    PAYMENT_INTERVAL from the start of the advance. Returns the inserted payments
+    """
+    advance_payment = sqlalchemy_models.AdvancePayment.__table__
+    payment_amount = amount / number_of_payments
+    return insert(advance_payment)\
+        .values([dict(advance_id=advance_id,
+                      payment_number=payment_number,
+                      amount=payment_amount,
+                      due_at=start_timestamp + PAYMENT_INTERVAL * (payment_number + 1),
+                      status=DalAdvancePaymentStatus.not_due_yet.value)
+                 for payment_number in range(number_of_payments)])\
+        .returning(*advance_payment.c)
+
+
+def claim_due_payments_statement(due_before: datetime, limit: int) -> Update:
+    """
+    A single UPDATE that claims up to the given number of payments that are due & still not_due_yet (the earliest due
+    first), by moving them to pending_processing, & returns the claimed payments.
+    The payments are locked with SKIP LOCKED, so concurrent claims skip the payments being claimed by each other instead
+    of waiting for them, & every payment is claimed exactly once.
+    """
+    advance_payment = sqlalchemy_models.AdvancePayment
+    due_payments = select(advance_payment.advance_id, advance_payment.payment_number)\
+        .where(advance_payment.status == DalAdvancePaymentStatus.not_due_yet.value)\
+        .where(advance_payment.due_at <= due_before)\
+        .order_by(advance_payment.due_at, advance_payment.advance_id, advance_payment.payment_number)\
+        .limit(limit)\
+        .with_for_update(skip_locked=True)
+
+    return update(advance_payment)\
+        .where(tuple_(advance_payment.advance_id, advance_payment.payment_number).in_(due_payments))\
+        .values(status=DalAdvancePaymentStatus.pending_processing.value,
+                collection_attempts=advance_payment.collection_attempts + 1,
+                updated_at=func.now())\
+        .returning(advance_payment)\
+        .execution_options(synchronize_session=False)
+
+
+def requeued_payment_status(max_collection_attempts: int) -> ColumnElement:
+    """
+    The status of a payment that is returned to be claimed again: not_due_yet, or needs_review once it was claimed the
+    given number of times
+    """
+    advance_payment = sqlalchemy_models.AdvancePayment
+    return case((advance_payment.collection_attempts >= max_collection_attempts,
+                 DalAdvancePaymentStatus.needs_review.value),
+                else_=DalAdvancePaymentStatus.not_due_yet.value)
+
+
+def release_payments_statement(payment_keys: List[Tuple[str, int]], max_collection_attempts: int) -> Update:
+    """
+    Returns the given claimed payments that are still pending_processing to not_due_yet (or needs_review, see
+    requeued_payment_status), & returns them
+    :param payment_keys: The (advance_id, payment_number) of the payments
+    """
+    advance_payment = sqlalchemy_models.AdvancePayment
+    return update(advance_payment)\
+        .where(tuple_(advance_payment.advance_id, advance_payment.payment_number).in_(payment_keys))\
+        .where(advance_payment.status == DalAdvancePaymentStatus.pending_processing.value)\
+        .values(status=requeued_payment_status(max_collection_attempts), updated_at=func.now())\
+        .returning(advance_payment)\
+        .execution_options(synchronize_session=False)
+
+
+def requeue_stale_payments_statement(stale_after: timedelta, max_collection_attempts: int) -> Update:
+    """
+    Returns the payments stuck in pending_processing / processing to not_due_yet (or needs_review, see
+    requeued_payment_status), so the next claim collects them again, & returns them. A payment is stuck when it was not
+    touched for the given time (by the database clock, which sets updated_at), for example because its task message was
+    lost or its worker crashed.
+    Collecting a payment again is safe, since the bank transaction has the idempotency key of the payment
+    """
+    advance_payment = sqlalchemy_models.AdvancePayment
+    return update(advance_payment)\
+        .where(advance_payment.status.in_([DalAdvancePaymentStatus.pending_processing.value,
+                                           DalAdvancePaymentStatus.processing.value]))\
+        .where(advance_payment.updated_at < func.now() - stale_after)\
+        .values(status=requeued_payment_status(max_collection_attempts), updated_at=func.now())\
+        .returning(advance_payment)\
+        .execution_options(synchronize_session=False)
+
+
+def start_processing_payments_statement(payment_keys: List[Tuple[str, int]]) -> Update:
+    """
+    Moves the given payments that are still pending_processing to processing, & returns them with the account of their
+    advance. Only a single statement can move a payment out of pending_processing, so only a single collector processes
+    every payment.
+    :param payment_keys: The (advance_id, payment_number) of the payments
+    """
+    # A Core statement, as ORM statements only return the columns of the updated table
+    advance_payment, advance = sqlalchemy_models.AdvancePayment.__table__, sqlalchemy_models.Advance.__table__
+    return update(advance_payment)\
+        .where(advance_payment.c.advance_id == advance.c.id)\
+        .where(tuple_(advance_payment.c.advance_id, advance_payment.c.payment_number).in_(payment_keys))\
+        .where(advance_payment.c.status == DalAdvancePaymentStatus.pending_processing.value)\
+        .values(status=DalAdvancePaymentStatus.processing.value, updated_at=func.now())\
+        .returning(*advance_payment.c, advance.c.dst_account_id)
+
+
+def complete_payments_statement(paid_payment_keys: List[Tuple[str, int]],
+                                failed_payment_keys: List[Tuple[str, int]]) -> Update:
+    """
+    A single UPDATE that moves the given processing payments to paid / failed
+    :param paid_payment_keys: The (advance_id, payment_number) of the payments that were collected
+    :param failed_payment_keys: The (advance_id, payment_number) of the payments that could not be collected
+    """
+    advance_payment = sqlalchemy_models.AdvancePayment
+    payment_key = tuple_(advance_payment.advance_id, advance_payment.payment_number)
+    status = DalAdvancePaymentStatus.failed.value
+    if paid_payment_keys:
+        status = case((payment_key.in_(paid_payment_keys), DalAdvancePaymentStatus.paid.value), else_=status)
+
+    return update(advance_payment)\
+        .where(payment_key.in_(paid_payment_keys + failed_payment_keys))\
+        .where(advance_payment.status == DalAdvancePaymentStatus.processing.value)\
+        .values(status=status, updated_at=func.now())\
+        .execution_options(synchronize_session=False)
@@ -0,0 +1,33 @@
+"""
+The metrics of the service, exposed in the Prometheus format on the /metrics path.
+The database statements & connection pool metrics are reported by the dal (see dal/sqlalchemy/metrics.py).
+"""
+
+from typing import Optional
+
+from prometheus_client import Counter, Histogram
+from starlette.types import Scope
+
+# The route of requests that did not match any route, so unknown paths do not create new label values
+UNMATCHED_ROUTE = 'unmatched'
+# The status code of requests that failed before sending a response
+UNHANDLED_ERROR_STATUS_CODE = 500
+
+HTTP_REQUEST_DURATION = Histogram('http_request_duration_seconds',
+                                  'The time it took to handle a request',
+                                  ['method', 'route'])
+HTTP_REQUESTS = Counter('http_requests', 'The number of handled requests', ['method', 'route', 'status_code'])
+
+
+def get_route_name(scope: Scope) -> str:
+    """Returns the path template of the route that handled the request (for example: /api/v1/advance)"""
+    route = scope.get('route')
+    return getattr(route, 'path', UNMATCHED_ROUTE)
+
+
+def observe_request(scope: Scope, status_code: Optional[int], duration: float) -> None:
+    """Records the duration & the status code of a handled request, by its route"""
+    method = scope['method']
+    route = get_route_name(scope)
+    HTTP_REQUEST_DURATION.labels(method=method, route=route).observe(duration)
+    HTTP_REQUESTS.labels(method=method, route=route, status_code=status_code or UNHANDLED_ERROR_STATUS_CODE).inc()
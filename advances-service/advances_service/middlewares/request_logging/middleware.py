@@ -1,59 +1,97 @@
+import random
 import time
 import uuid
-import traceback
+from typing import Optional
 
-from fastapi import Request
-from starlette.middleware.base import RequestResponseEndpoint
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
 from structlog import get_logger
 
+from metrics import observe_request
 from .controller import ContextVars, extract_request_metadata
 
 logger = get_logger()
 
+REQUEST_ID_HEADER = b'x-request-id'
+# Responses with this status code or above are errors, which are always logged
+ERROR_STATUS_CODE = 400
 
-async def add_log_context(request: Request, call_next: RequestResponseEndpoint):
-    request_id = str(uuid.uuid4())
 
-    tracing_params = {
-        'request_id': request_id
-    }
+class RequestLoggingMiddleware:
+    """
+    A pure ASGI middleware that gives every request an ID (returned in the X-Request-ID header & bound to the logs of
+    the request), & logs the start & the completion of the requests.
+    At high request rates the start & completion logs of successful fast requests can be sampled, while failed & slow
+    requests are always logged.
+    The duration & the status code of every request are recorded in the request metrics, regardless of sampling.
+    """
 
-    request_metadata = {
-        **extract_request_metadata(request=request),
-        **tracing_params
-    }
+    def __init__(self, app: ASGIApp, sample_rate: float = 1.0, slow_request_threshold: Optional[float] = None):
+        """
+        :param app: The ASGI app handling the requests
+        :param sample_rate: The fraction (0-1) of the requests whose start & completion are logged
+        :param slow_request_threshold: Requests that take longer than this (seconds) are always logged.
+            None means requests are not logged for being slow
+        """
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_request_threshold = slow_request_threshold
 
-    logger.info('Starting http request', **request_metadata)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
 
-    start_time = end_time = response = e = None
-    try:
-        # Bind the request logging param, so they appear in every log message of the request.
-        with ContextVars(**tracing_params):
-            start_time = time.perf_counter()
-            response = await call_next(request)
-            end_time = time.perf_counter()
-    except Exception as _e:
-        e = _e
-        raise
-    finally:
-        end_time = end_time if end_time else time.perf_counter()
-        duration = end_time - start_time
-        response_status_code = response.status_code if response else None
+        request_id = str(uuid.uuid4())
+        tracing_params = {
+            'request_id': request_id
+        }
 
-        request_metadata['request_duration'] = duration
+        is_sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        if is_sampled:
+            logger.info('Starting http request', **extract_request_metadata(scope), **tracing_params)
 
-        if response_status_code:
-            request_metadata['response_status_code'] = response_status_code
+        response_status_code = None
 
-        if e:
-            request_metadata = {
-                **request_metadata,
-                'exception_msg': str(e),
-                'exception_type': type(e)
-            }
+        async def send_with_request_id(message: Message) -> None:
+            nonlocal response_status_code
+            if message['type'] == 'http.response.start':
+                response_status_code = message['status']
+                message['headers'] = [*message.get('headers', []), (REQUEST_ID_HEADER, request_id.encode())]
+            await send(message)
 
-        logger.info('HTTP request complete', **request_metadata)
+        e = None
+        start_time = time.perf_counter()
+        try:
+            # Bind the request logging param, so they appear in every log message of the request.
+            with ContextVars(**tracing_params):
+                await self.app(scope, receive, send_with_request_id)
+        except Exception as _e:
+            e = _e
+            raise
+        finally:
+            duration = time.perf_counter() - start_time
+            is_failed = e is not None or response_status_code is None or response_status_code >= ERROR_STATUS_CODE
+            is_slow = self.slow_request_threshold is not None and duration >= self.slow_request_threshold
+            observe_request(scope, status_code=response_status_code, duration=duration)
 
-    response.headers['X-Request-ID'] = request_id
+            if is_sampled or is_failed or is_slow:
+                request_metadata = {
+                    **extract_request_metadata(scope),
+                    **tracing_params,
+                    'request_duration': duration,
+                }
 
-    return response
+                if response_status_code:
+                    request_metadata['response_status_code'] = response_status_code
+
+                if is_slow:
+                    request_metadata['is_slow'] = True
+
+                if e:
+                    request_metadata = {
+                        **request_metadata,
+                        'exception_msg': str(e),
+                        'exception_type': type(e)
+                    }
+
+                logger.info('HTTP request complete', **request_metadata)
@@ -1,9 +1,12 @@
 from datetime import datetime
-import math
+from typing import Optional
 
-from fastapi import APIRouter, Query
+from celery import Celery
+from fastapi import APIRouter, HTTPException, Response, status
 from structlog import get_logger
 
+from accounts_manager_client import AccountsManagerClient, AccountsManagerError
+from advance_granting import grant_advance, GRANT_ADVANCE_TASK_NAME
 from api_models.advances import AdvanceRequest, Advance
 from dal.dal import Dal
 from dal import dal_models as dal_models
@@ -11,12 +14,21 @@ from dal import dal_models as dal_models
 logger = get_logger()
 
 
-def get_router(dal: Dal) -> APIRouter:
-    """Generated a bunch of example routes on a router, and returns the resulting router"""
+def get_router(dal: Dal, accounts_manager_client: AccountsManagerClient,
+               celery_client: Optional[Celery] = None) -> APIRouter:
+    """
+    Generated a bunch of example routes on a router, and returns the resulting router
+    :param celery_client: Sends the grant_advance tasks, when advances are granted asynchronously. If missing, advances
+        are granted while handling the request
+    """
     router = APIRouter()
 
-    @router.post('/api/v1/advance', response_model=Advance)
-    def post_advance(advance_request: AdvanceRequest) -> Advance:
+    @router.post('/api/v1/advance', response_model=Advance,
+                 responses={status.HTTP_202_ACCEPTED: {'model': Advance,
+                                                       'description': 'The advance will be granted asynchronously '
+                                                                      '(or again, if granting it failed), poll it '
+                                                                      'with GET /api/v1/advance/{advance_id}'}})
+    def post_advance(advance_request: AdvanceRequest, response: Response) -> Advance:
         # First we register the advance but keep it in a pending state, & only after the money transfer is complete we
         # will change the state
         dal_advance = dal.create_advance(dst_account_id=advance_request.dst_account_id,
@@ -24,15 +36,41 @@ def get_router(dal: Dal) -> APIRouter:
                                          status=dal_models.DalAdvanceStatus.pending_transaction,
                                          start_timestamp=datetime.now())
 
-        # TODO: Call the accounts-manager service to create a transaction, & make sure it completes successfully
+        if celery_client is not None:
+            try:
+                celery_client.send_task(GRANT_ADVANCE_TASK_NAME, args=[dal_advance.advance_id])
+            except Exception:
+                # The advance is left pending, & granted by the grant_stale_pending_advances task
+                logger.exception('Dispatching the advance grant failed, it will be granted later',
+                                 advance_id=dal_advance.advance_id)
 
-        dal_advance = dal.update_advance_status(advance_id=dal_advance.advance_id,
-                                                status=dal_models.DalAdvanceStatus.active)
+            response.status_code = status.HTTP_202_ACCEPTED
+            return Advance.from_orm(dal_advance)
 
-        _ = dal.create_advance_payments(advance=dal_advance)
+        try:
+            dal_advance = grant_advance(dal=dal, accounts_manager_client=accounts_manager_client, advance=dal_advance)
+        except AccountsManagerError as e:
+            # The advance may have been granted (if the request timed out), so it is left pending, & granted again by
+            # the grant_stale_pending_advances task. Granting it again with the same idempotency key never gives the
+            # money twice
+            logger.error('Granting the advance failed, it will be granted again later',
+                         advance_id=dal_advance.advance_id, reason=str(e))
+            response.status_code = status.HTTP_202_ACCEPTED
 
         advance = Advance.from_orm(dal_advance)
 
         return advance
 
+    @router.get('/api/v1/advance/{advance_id}', response_model=Advance)
+    def get_advance(advance_id: int) -> Advance:
+        """
+        Returns the advance, for polling the status of advances that are granted asynchronously
+        (pending_transaction until granted, then active / failed)
+        """
+        dal_advance = dal.get_advance(str(advance_id))
+        if dal_advance is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Advance {advance_id} not found')
+
+        return Advance.from_orm(dal_advance)
+
     return router
@@ -1,15 +1,146 @@
-from pydantic import BaseSettings, DirectoryPath, SecretStr
+from typing import Optional
+
+from pydantic import BaseSettings, DirectoryPath, SecretStr, PositiveInt, NonNegativeInt, PositiveFloat, \
+    NonNegativeFloat, confloat
+
+from dal.sqlalchemy.configuration import EngineProfileName, EngineProfile, get_engine_profile
 
 
 class Settings(BaseSettings):
     title: str = 'Advances service'
     logs_dir: DirectoryPath = './logs'
     console_color_logs: bool = True
+    # Write the logs to the console as well as to the log files
+    log_to_console: bool = True
+    # Add the function name & line number of the log call to every log record. Walks the stack on every log call
+    log_callsite: bool = True
+    # Hand the log records to a background thread that formats & writes them, so requests never wait for log I/O.
+    # Recommended for production
+    log_non_blocking: bool = False
+    # The maximum number of log records waiting to be written when logging is non-blocking. Records logged while the
+    # queue is full are dropped
+    log_queue_size: PositiveInt = 10000
+
+    # The fraction (0-1) of the requests whose start & completion are logged. Failed requests & slow requests are
+    # always logged
+    request_log_sample_rate: confloat(ge=0, le=1) = 1
+    # Requests that take longer than this (seconds) are always logged
+    slow_request_threshold: NonNegativeFloat = 1
 
     db_connection_string: SecretStr
 
+    # The predefined set of database engine options to use (see dal/sqlalchemy/configuration.py).
+    # The development profile logs every statement
+    db_engine_profile: EngineProfileName = EngineProfileName.production
+    # The settings below override the options of the engine profile, unset settings keep the options of the profile
+    # The database driver, replacing the driver of the connection string (for example: psycopg2, implemented in C)
+    db_driver: Optional[str] = None
+    # Log every statement
+    db_echo: Optional[bool] = None
+    # The maximum time (milliseconds) a statement may run before the database cancels it
+    db_statement_timeout: Optional[PositiveInt] = None
+    # The number of database connections kept open in the connection pool
+    db_pool_size: Optional[PositiveInt] = None
+    # The number of connections that can be opened on top of the pool size, when all pooled connections are in use
+    db_max_overflow: Optional[NonNegativeInt] = None
+    # How long (seconds) a request waits for a free database connection before failing
+    db_pool_timeout: Optional[PositiveFloat] = None
+    # Test connections when they are taken from the pool, so stale connections are replaced instead of failing requests
+    db_pool_pre_ping: Optional[bool] = None
+    # The maximum age (seconds) of a pooled connection, after which it is replaced
+    db_pool_recycle: Optional[int] = None
+    # The number of compiled statements cached, so repeated statements are not compiled again
+    db_query_cache_size: Optional[NonNegativeInt] = None
+    # The number of rows inserted by a single statement in bulk inserts
+    db_insertmanyvalues_page_size: Optional[PositiveInt] = None
+    # How statements with many parameter sets are run (values_only / values_plus_batch), only supported by psycopg2
+    db_executemany_mode: Optional[str] = None
+
     redis_url: str
 
+    # How often (seconds) the due advance payments are claimed & dispatched for processing
+    due_payments_interval: PositiveFloat = 60
+    # The number of due payments claimed by a single statement
+    due_payments_claim_chunk_size: PositiveInt = 1000
+    # The maximum number of chunks claimed by a single run, so a run does not overlap the next one. The payments left
+    # are claimed by the next run
+    due_payments_max_chunks_per_run: PositiveInt = 100
+    # The number of payments collected by a single collector task, with a single bulk bank transactions request
+    due_payments_task_chunk_size: PositiveInt = 100
+    # How long (seconds) to wait before collecting a chunk of payments again, when accounts-manager failed
+    due_payments_retry_delay: PositiveFloat = 30
+    # How many times a chunk of payments is collected again, before its payments are left for the next claim
+    due_payments_max_retries: NonNegativeInt = 5
+    # Payments left in pending_processing / processing for longer than this (seconds) are returned to not_due_yet &
+    # collected again (their task was lost, or its worker crashed). Must be longer than a collector task takes,
+    # including its retries
+    due_payments_stale_after: PositiveFloat = 1800
+    # How many times a payment is claimed for collecting. A payment that was not collected by then (accounts-manager
+    # kept failing) is moved to needs_review with an alert instead of being requeued again
+    due_payments_max_collection_attempts: PositiveInt = 10
+
+    # How often (seconds) the advances touched since the last reconciliation are reconciled with their payments
+    advance_reconciliation_interval: PositiveFloat = 300
+    # How long (seconds) after they are touched advances are reconciled. Must be longer than the longest database
+    # transaction, since changes committed after their time was reconciled are not reconciled
+    advance_reconciliation_lag: NonNegativeFloat = 60
+    # The largest difference between the sum of the payments of an advance & its amount that is not reported (the
+    # payment amounts are rounded)
+    advance_reconciliation_tolerance: NonNegativeFloat = 0.01
+
+    # Grant advances with the grant_advance Celery task: the API persists the advance as pending_transaction & responds
+    # with 202 Accepted straight away, instead of waiting for accounts-manager to give the money
+    grant_advances_async: bool = False
+    # How long (seconds) to wait before granting an advance again, when accounts-manager failed
+    advance_grant_retry_delay: PositiveFloat = 10
+    # How many times granting an advance is retried, before the advance is left pending_transaction
+    advance_grant_max_retries: NonNegativeInt = 10
+    # How often (seconds) the advances stuck in pending_transaction are granted again
+    pending_advances_interval: PositiveFloat = 60
+    # Advances left pending_transaction for longer than this (seconds) are granted again (their grant failed, or its
+    # task was lost). Must be longer than granting an advance takes, including the retries of the client
+    pending_advances_stale_after: PositiveFloat = 300
+    # Advances still pending_transaction this long (seconds) after they started are not granted again, but moved to
+    # needs_review (with an alert): accounts-manager deletes idempotency keys after IDEMPOTENCY_KEYS_RETENTION_HOURS
+    # (24 hours by default), after which granting again could give the money twice. Must be shorter than that retention
+    pending_advances_max_age: PositiveFloat = 72000
+    # The maximum number of stuck advances granted again by a single run
+    pending_advances_claim_limit: PositiveInt = 1000
+
+    # The URL of the accounts-manager API
+    accounts_manager_url: str = 'http://localhost:8000'
+    # How long (seconds) to wait for a connection to the accounts-manager API
+    accounts_manager_connect_timeout: PositiveFloat = 2
+    # How long (seconds) to wait for a response of the accounts-manager API
+    accounts_manager_read_timeout: PositiveFloat = 30
+    # The number of keep-alive connections to accounts-manager kept open by every process (API worker / Celery worker
+    # child). Should match the number of threads of the process sending requests concurrently
+    accounts_manager_pool_size: PositiveInt = 10
+    # How many times a request to accounts-manager is retried (with a jittered exponential backoff) when
+    # accounts-manager can not be reached or is saturated. Only requests with idempotency keys are retried
+    accounts_manager_max_retries: NonNegativeInt = 2
+    # The base delay (seconds) of the backoff between retries, doubled on every retry
+    accounts_manager_retry_base_delay: NonNegativeFloat = 0.2
+    # The number of failed requests in a row after which requests to accounts-manager fail fast (the circuit opens)
+    accounts_manager_circuit_failure_threshold: PositiveInt = 5
+    # How long (seconds) requests to accounts-manager fail fast before a single trial request is sent
+    accounts_manager_circuit_reset_timeout: PositiveFloat = 30
+
+    def get_db_engine_profile(self) -> EngineProfile:
+        """The options of the database engine: the engine profile, overridden by the database settings"""
+        return get_engine_profile(self.db_engine_profile,
+                                  driver=self.db_driver,
+                                  echo=self.db_echo,
+                                  statement_timeout=self.db_statement_timeout,
+                                  pool_size=self.db_pool_size,
+                                  max_overflow=self.db_max_overflow,
+                                  pool_timeout=self.db_pool_timeout,
+                                  pool_pre_ping=self.db_pool_pre_ping,
+                                  pool_recycle=self.db_pool_recycle,
+                                  query_cache_size=self.db_query_cache_size,
+                                  insertmanyvalues_page_size=self.db_insertmanyvalues_page_size,
+                                  executemany_mode=self.db_executemany_mode)
+
     class Config:
         env_file = '.env'
         env_file_encoding = 'utf-8'
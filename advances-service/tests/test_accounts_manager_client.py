@@ -0,0 +1,139 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+from typing import Iterator, List
+
+import pytest
+
+import accounts_manager_stub
+from accounts_manager_client import AccountsManagerClient, AccountsManagerError, AccountsManagerUnavailableError
+from accounts_manager_stub import StubState, run_stub_server
+from api_models.accounts_manager import BankTransactionRequest, TransactionDirection, TransactionStatus
+from circuit_breaker import CircuitBreaker, CircuitState
+
+
+class ScriptedRandom:
+    """Replaces the random numbers of the stub, so the test decides which requests fail"""
+
+    def __init__(self, values: List[float]):
+        self.__values = iter(values)
+
+    def random(self) -> float:
+        return next(self.__values, 0.5)
+
+
+@pytest.fixture
+def stub_state() -> StubState:
+    return StubState(latency=0, unavailable_rate=0, deny_rate=0)
+
+
+@pytest.fixture
+def stub_url(stub_state: StubState) -> Iterator[str]:
+    server = run_stub_server('127.0.0.1', 0, stub_state)
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def get_client(base_url: str, max_retries: int = 2, failure_threshold: int = 5) -> AccountsManagerClient:
+    return AccountsManagerClient(base_url=base_url,
+                                 connect_timeout=1,
+                                 read_timeout=1,
+                                 max_retries=max_retries,
+                                 retry_base_delay=0,
+                                 circuit_breaker=CircuitBreaker(name='test',
+                                                                failure_threshold=failure_threshold,
+                                                                reset_timeout=60))
+
+
+def get_bank_transaction_request(idempotency_key=None) -> BankTransactionRequest:
+    return BankTransactionRequest(dst_account_id='1',
+                                  amount=100,
+                                  direction=TransactionDirection.credit,
+                                  reason='Advance 1',
+                                  idempotency_key=idempotency_key)
+
+
+def test_performs_a_bank_transaction_once_per_idempotency_key(stub_url, stub_state):
+    client = get_client(stub_url)
+
+    bank_transaction = client.perform_bank_transaction(get_bank_transaction_request(idempotency_key='key-1'))
+    replayed_bank_transaction = client.perform_bank_transaction(get_bank_transaction_request(idempotency_key='key-1'))
+
+    assert bank_transaction.status == TransactionStatus.successful
+    assert replayed_bank_transaction.transaction_id == bank_transaction.transaction_id
+    assert len(stub_state.bank_transactions) == 1
+
+
+def test_retries_server_errors(stub_url, stub_state, monkeypatch):
+    # The first request is answered with 503, the second one succeeds
+    stub_state.unavailable_rate = 0.1
+    monkeypatch.setattr(accounts_manager_stub, 'random', ScriptedRandom([0.0]))
+    client = get_client(stub_url)
+
+    bank_transaction = client.perform_bank_transaction(get_bank_transaction_request(idempotency_key='key-1'))
+
+    assert bank_transaction.status == TransactionStatus.successful
+    assert stub_state.requests_count == 2
+    assert client.circuit_breaker.state == CircuitState.closed
+
+
+def test_server_errors_fail_after_the_retries_and_open_the_circuit(stub_url, stub_state):
+    stub_state.unavailable_rate = 1
+    client = get_client(stub_url, max_retries=2, failure_threshold=3)
+
+    with pytest.raises(AccountsManagerUnavailableError):
+        client.perform_bank_transaction(get_bank_transaction_request(idempotency_key='key-1'))
+    assert stub_state.requests_count == 3
+    assert client.circuit_breaker.state == CircuitState.open
+
+    # The open circuit fails fast, without sending the request
+    with pytest.raises(AccountsManagerUnavailableError):
+        client.perform_bank_transaction(get_bank_transaction_request(idempotency_key='key-2'))
+    assert stub_state.requests_count == 3
+
+
+def test_requests_without_idempotency_keys_are_not_retried(stub_url, stub_state):
+    stub_state.unavailable_rate = 1
+    client = get_client(stub_url, max_retries=2)
+
+    with pytest.raises(AccountsManagerUnavailableError):
+        client.perform_bank_transaction(get_bank_transaction_request())
+    assert stub_state.requests_count == 1
+
+
+def test_client_errors_are_not_retried_and_do_not_open_the_circuit(stub_url, stub_state):
+    client = get_client(stub_url, max_retries=2, failure_threshold=1)
+
+    with pytest.raises(AccountsManagerError) as exc_info:
+        client._post('/api/v1/unknown', body={}, is_idempotent=True)
+    assert not isinstance(exc_info.value, AccountsManagerUnavailableError)
+    assert stub_state.requests_count == 1
+    assert client.circuit_breaker.state == CircuitState.closed
+
+
+class InvalidJsonRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        response_body = b'<html>Not JSON</html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_invalid_json_responses_raise_an_accounts_manager_error():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), InvalidJsonRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = get_client(f'http://127.0.0.1:{server.server_address[1]}')
+        with pytest.raises(AccountsManagerError, match='invalid JSON'):
+            client.perform_bank_transaction(get_bank_transaction_request(idempotency_key='key-1'))
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,104 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CircuitOpenError, CircuitState
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', fake_clock.monotonic)
+    return fake_clock
+
+
+def fail_calls(breaker: CircuitBreaker, count: int) -> None:
+    for _ in range(count):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_stays_closed_below_the_failure_threshold(clock):
+    breaker = CircuitBreaker(name='test', failure_threshold=3, reset_timeout=10)
+    fail_calls(breaker, 2)
+
+    assert breaker.state == CircuitState.closed
+    breaker.before_call()
+
+
+def test_opens_after_the_failure_threshold_and_fails_fast(clock):
+    breaker = CircuitBreaker(name='test', failure_threshold=3, reset_timeout=10)
+    fail_calls(breaker, 3)
+
+    assert breaker.state == CircuitState.open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_a_success_resets_the_failures(clock):
+    breaker = CircuitBreaker(name='test', failure_threshold=3, reset_timeout=10)
+    fail_calls(breaker, 2)
+    breaker.record_success()
+    fail_calls(breaker, 2)
+
+    assert breaker.state == CircuitState.closed
+
+
+def test_stays_open_until_the_reset_timeout(clock):
+    breaker = CircuitBreaker(name='test', failure_threshold=1, reset_timeout=10)
+    fail_calls(breaker, 1)
+
+    clock.now += 9.9
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.state == CircuitState.open
+
+
+def test_lets_a_single_trial_call_through_after_the_reset_timeout(clock):
+    breaker = CircuitBreaker(name='test', failure_threshold=1, reset_timeout=10)
+    fail_calls(breaker, 1)
+
+    clock.now += 10
+    breaker.before_call()
+    assert breaker.state == CircuitState.half_open
+
+    # Other calls fail fast while the trial call is running
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_a_successful_trial_call_closes_the_circuit(clock):
+    breaker = CircuitBreaker(name='test', failure_threshold=2, reset_timeout=10)
+    fail_calls(breaker, 2)
+    clock.now += 10
+    breaker.before_call()
+    breaker.record_success()
+
+    assert breaker.state == CircuitState.closed
+    # The failures were reset, so a single failure does not open the circuit again
+    fail_calls(breaker, 1)
+    assert breaker.state == CircuitState.closed
+
+
+def test_a_failed_trial_call_opens_the_circuit_again(clock):
+    breaker = CircuitBreaker(name='test', failure_threshold=2, reset_timeout=10)
+    fail_calls(breaker, 2)
+    clock.now += 10
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitState.open
+    # The reset timeout starts over from the failed trial call
+    clock.now += 9.9
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 0.1
+    breaker.before_call()
+    assert breaker.state == CircuitState.half_open
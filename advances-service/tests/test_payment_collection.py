@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert, select
+
+from dal.dal_models import DalAdvancePaymentStatus
+from dal.sqlalchemy import models as sqlalchemy_models
+from dal.sqlalchemy.statements import claim_due_payments_statement, release_payments_statement
+
+NOW = datetime.now()
+MAX_COLLECTION_ATTEMPTS = 3
+
+
+@pytest.fixture
+def connection():
+    engine = create_engine('sqlite://')
+    with engine.connect() as connection:
+        sqlalchemy_models.AdvancePayment.__table__.create(connection)
+        connection.execute(insert(sqlalchemy_models.AdvancePayment.__table__), [
+            dict(advance_id=1, payment_number=payment_number, amount=10, due_at=NOW - timedelta(days=1),
+                 status=DalAdvancePaymentStatus.not_due_yet.value)
+            for payment_number in range(2)])
+        yield connection
+
+
+def claim_and_release(connection) -> dict:
+    """Claims the due payments & releases them, as a collector does when accounts-manager keeps failing"""
+    payments = connection.execute(claim_due_payments_statement(due_before=NOW, limit=10)).all()
+    released_payments = connection.execute(release_payments_statement(
+        payment_keys=[(payment.advance_id, payment.payment_number) for payment in payments],
+        max_collection_attempts=MAX_COLLECTION_ATTEMPTS)).all()
+    return {payment.payment_number: payment.status for payment in released_payments}
+
+
+def test_claiming_counts_the_collection_attempts(connection):
+    connection.execute(claim_due_payments_statement(due_before=NOW, limit=1))
+
+    advance_payment = sqlalchemy_models.AdvancePayment
+    assert dict(connection.execute(select(advance_payment.payment_number, advance_payment.collection_attempts))
+                .all()) == {0: 1, 1: 0}
+
+
+def test_released_payments_are_claimed_again_until_the_collection_attempts_run_out(connection):
+    for _ in range(MAX_COLLECTION_ATTEMPTS - 1):
+        assert claim_and_release(connection) == {0: DalAdvancePaymentStatus.not_due_yet.value,
+                                                 1: DalAdvancePaymentStatus.not_due_yet.value}
+
+    assert claim_and_release(connection) == {0: DalAdvancePaymentStatus.needs_review.value,
+                                             1: DalAdvancePaymentStatus.needs_review.value}
+    # Payments that need a review are not claimed again
+    assert claim_and_release(connection) == {}
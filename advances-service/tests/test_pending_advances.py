@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert, select
+
+from dal.dal_models import DalAdvanceStatus
+from dal.sqlalchemy import models as sqlalchemy_models
+from dal.sqlalchemy.statements import flag_expired_pending_advances_statement
+
+NOW = datetime.now()
+EXPIRY = NOW - timedelta(hours=20)
+
+
+@pytest.fixture
+def connection():
+    engine = create_engine('sqlite://')
+    with engine.connect() as connection:
+        sqlalchemy_models.Advance.__table__.create(connection)
+        # 1 is pending for too long to be granted again, 2 is not, & 3 was granted
+        connection.execute(insert(sqlalchemy_models.Advance.__table__), [
+            dict(id=1, dst_account_id='1', amount=100, status=DalAdvanceStatus.pending_transaction.value,
+                 start_timestamp=EXPIRY - timedelta(minutes=1), updated_at=NOW - timedelta(hours=1)),
+            dict(id=2, dst_account_id='1', amount=100, status=DalAdvanceStatus.pending_transaction.value,
+                 start_timestamp=EXPIRY + timedelta(minutes=1), updated_at=NOW - timedelta(hours=1)),
+            dict(id=3, dst_account_id='1', amount=100, status=DalAdvanceStatus.active.value,
+                 start_timestamp=EXPIRY - timedelta(minutes=1), updated_at=NOW - timedelta(hours=1))])
+        yield connection
+
+
+def get_statuses(connection) -> dict:
+    advance = sqlalchemy_models.Advance
+    return dict(connection.execute(select(advance.id, advance.status)).all())
+
+
+def test_expired_pending_advances_are_flagged_for_review(connection):
+    flagged_advance_ids = connection.scalars(flag_expired_pending_advances_statement(started_before=EXPIRY,
+                                                                                     limit=10)).all()
+
+    assert flagged_advance_ids == [1]
+    assert get_statuses(connection) == {1: DalAdvanceStatus.needs_review.value,
+                                        2: DalAdvanceStatus.pending_transaction.value,
+                                        3: DalAdvanceStatus.active.value}
+
@@ -0,0 +1,90 @@
+"""
+Measures the throughput (records per second) of the logging configurations of the services: the blocking configuration
+(every record is formatted & written by the logging thread), & the non-blocking production configuration (records are
+queued & written by a background thread).
+Every configuration is measured twice: as seen by the logging threads (the time spent in the log calls, which is what
+requests wait for), & end to end (until all the records are written to the log files).
+
+Run it from the directory of a service, so its logging configuration is used:
+    cd accounts-manager/accounts_manager && python3 ../../benchmarks/logging_throughput.py
+"""
+
+import argparse
+import atexit
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Tuple
+
+sys.path.insert(0, os.getcwd())
+
+import structlog  # noqa: E402
+
+from configure_logging import configure_logging  # noqa: E402
+from settings import Settings  # noqa: E402
+
+# The logging settings of every measured configuration
+CONFIGURATIONS: Dict[str, Dict] = {
+    'blocking': dict(log_non_blocking=False, log_callsite=True),
+    'blocking, no callsite': dict(log_non_blocking=False, log_callsite=False),
+    'non-blocking, no callsite': dict(log_non_blocking=True, log_callsite=False),
+}
+
+
+def log_records(records: int) -> None:
+    logger = structlog.get_logger()
+    for index in range(records):
+        logger.info('Transaction complete', index=index, is_successful=True, reason=None)
+
+
+def measure(configuration: Dict, records: int, threads: int, log_to_console: bool) -> Tuple[float, float]:
+    """
+    Logs the records from the given number of threads with the given logging configuration
+    :return: (callers_rate, end_to_end_rate) The records per second of the log calls, & until the records were written
+    """
+    with tempfile.TemporaryDirectory() as logs_dir:
+        settings = Settings.construct(logs_dir=logs_dir,
+                                      console_color_logs=False,
+                                      log_to_console=log_to_console,
+                                      # Large enough for all the records, so no record is dropped
+                                      log_queue_size=records * threads,
+                                      **configuration)
+        listener = configure_logging(settings)
+
+        logging_threads = [threading.Thread(target=log_records, args=(records,)) for _ in range(threads)]
+        start_time = time.perf_counter()
+        for logging_thread in logging_threads:
+            logging_thread.start()
+        for logging_thread in logging_threads:
+            logging_thread.join()
+        callers_duration = time.perf_counter() - start_time
+
+        if listener:
+            # Waits for the queued records to be written
+            listener.stop()
+            atexit.unregister(listener.stop)
+        end_to_end_duration = time.perf_counter() - start_time
+
+    total_records = records * threads
+    return total_records / callers_duration, total_records / end_to_end_duration
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000, help='The number of records logged by every thread')
+    parser.add_argument('--threads', type=int, default=4, help='The number of logging threads')
+    parser.add_argument('--console', action='store_true', help='Write the logs to the console as well')
+    args = parser.parse_args()
+
+    results = {name: measure(configuration, records=args.records, threads=args.threads, log_to_console=args.console)
+               for name, configuration in CONFIGURATIONS.items()}
+
+    print(f'{"configuration":<28}{"callers records/s":>20}{"end to end records/s":>24}')
+    for name, (callers_rate, end_to_end_rate) in results.items():
+        print(f'{name:<28}{callers_rate:>20,.0f}{end_to_end_rate:>24,.0f}')
+
+
+if __name__ == '__main__':
+    main()